@@ -3,29 +3,79 @@
 @description
 """
 import argparse
+import json
+import threading
 import time
 
-from Andrutil.ObserverObservable import Observable, Observer
+from Andrutil.ObserverObservable import Observable
 
 from auto_drone.drone.tello_drone import TelloDrone
+from auto_drone.frame_bus import FrameBus, Subscription
 
 
-class AutoControl(Observer, Observable):
+class AutoControl(Observable):
+    # seconds to wait for a frame before checking whether the control thread should stop
+    POLL_INTERVAL = 0.1
 
-    def __init__(self, observable_list: list):
-        Observer.__init__(self, sub_list=observable_list)
+    def __init__(self, frame_bus: FrameBus, frame_policy: str = Subscription.LATEST, name: str = 'auto_control'):
+        """
+        Subscribes to the frames and telemetry published on `frame_bus`, such as that of a TelloDrone, and
+        passes each frame taken on to its own observers as a 'video' message. By default, only the newest
+        frame is kept, so the controller always acts on the latest view of the drone. Only the newest state
+        is ever kept.
+
+        :param frame_bus:
+        :param frame_policy: delivery policy of the frame subscription, see Subscription
+        :param name: name the subscriptions are reported under
+        """
         Observable.__init__(self)
+        self.name = name
+        self.frame_subscription = frame_bus.subscribe(FrameBus.FRAMES, f'{name}_frames', policy=frame_policy)
+        self.telemetry_subscription = frame_bus.subscribe(
+            FrameBus.TELEMETRY, f'{name}_telemetry', policy=Subscription.LATEST
+        )
+        self.last_state = None
+        self.running = False
+        self.control_thread = None
+        return
+
+    def start(self):
+        self.running = True
+        self.control_thread = threading.Thread(target=self.__control_loop, daemon=True)
+        self.control_thread.start()
         return
 
-    def update(self, source, update_message):
-        if isinstance(source, TelloDrone):
-            message_type = update_message['type']
-            message_value = update_message['value']
-            if message_type == 'video':
+    def stop(self):
+        self.running = False
+        self.frame_subscription.close()
+        self.telemetry_subscription.close()
+        if self.control_thread is not None:
+            self.control_thread.join()
+        return
+
+    def __control_loop(self):
+        while self.running:
+            frame_message, _ = self.frame_subscription.get(timeout=self.POLL_INTERVAL)
+            state_message, _ = self.telemetry_subscription.get(timeout=0)
+            if state_message is not None:
+                self.last_state = state_message['value']
+            if frame_message is not None:
                 # todo
-                self.set_changed_message({'timestamp': time.time(), 'type': 'video', 'value': message_value})
+                self.set_changed_message({'timestamp': time.time(), 'type': 'video', 'value': frame_message['value']})
         return
 
+    def get_stats(self):
+        """
+        Lag and drops of the frame and telemetry subscriptions.
+
+        :return:
+        """
+        stats = {
+            'frames': self.frame_subscription.get_stats(),
+            'telemetry': self.telemetry_subscription.get_stats()
+        }
+        return stats
+
 
 def main(main_args):
     send_delay = main_args.get('send_delay', 0.1)
@@ -36,9 +86,12 @@ def main(main_args):
     tello_drone.SEND_DELAY = send_delay
     tello_drone.connect()
     ###################################
-    auto_control = AutoControl(observable_list=[tello_drone])
+    auto_control = AutoControl(frame_bus=tello_drone.frame_bus)
+    auto_control.start()
     ###################################
     time.sleep(10)
+    auto_control.stop()
+    print(json.dumps(auto_control.get_stats(), indent=2))
     tello_drone.cleanup()
     return
 
@@ -3,16 +3,20 @@
 @description
 """
 import argparse
+import json
 import os
 import threading
 import time
 from datetime import datetime
-from queue import Queue
 
 import cv2
 import numpy as np
 
 from auto_drone import DATA_DIR
+from auto_drone.frame_bus import FrameBus, Subscription
+from auto_drone.frame_views import FrameViewStats, as_frame_view
+from auto_drone.latency_trace import LatencyTracer
+from auto_drone.running_stats import RunningStats, StageStats
 
 
 def unit_vector(vector):
@@ -39,12 +43,43 @@ def angle_between(v1, v2):
 
 
 class GestureControl:
-
-    def __init__(self, display_feed: bool):
+    # rc speed the drone is steered at in the direction of a detected gesture
+    RC_SPEED = 20
+    # level of the frame pyramid processed, where each level halves the width and height of the frame
+    PYRAMID_LEVEL = 2
+
+    def __init__(self, display_feed: bool, control_drone=None, latency_tracer: LatencyTracer = None,
+                 frame_bus: FrameBus = None, frame_policy: str = Subscription.DROP_OLDEST, queue_size: int = None,
+                 latest_frame: bool = False, steer_drone: bool = False):
         """
         todo save processed video feed
 
+        Frames are taken from a subscription to the FRAMES topic of `frame_bus`, delivered according to
+        `frame_policy` and `queue_size`; by default every frame is kept until it is processed. In latest
+        frame mode, only the newest frame is kept, so each frame processed is the newest one received and
+        frames arriving while the previous one is processed are skipped. The flow vector is then measured
+        across the skipped frames and scaled back to a single frame interval, so the magnitude threshold
+        and rc speed mean the same whichever frames are processed. Without a frame bus, the controller
+        subscribes to a bus of its own, which frames are published on by add_frame. Frames are FrameViews,
+        so the downscaled and grayscale frames processed are shared with any other consumer of the same
+        frames; plain frames are wrapped in a FrameView when added.
+
+        Each frame is followed by a latency trace, the one it was added with if any, which is marked as the
+        frame is queued, taken from the queue and processed, and dropped if the frame is.
+
+        Steering is off by default. With `steer_drone` set and a `control_drone` given, gestures exceeding
+        the magnitude threshold steer the drone through its `set_rc`, passing the trace of the frame along.
+        Every other frame processed, including one where the tracked features are lost, sets a zero rc
+        setpoint, as does cleanup, so the drone stops once the gesture does.
+
         :param display_feed:
+        :param control_drone: drone steered by the detected gestures, if steering is enabled
+        :param latency_tracer: defaults to the tracer of the control drone, if it has one
+        :param frame_bus: bus the frames are published on, such as that of a TelloDrone
+        :param frame_policy: delivery policy of the frame subscription, see Subscription
+        :param queue_size: frames held by the frame subscription; unbounded if None
+        :param latest_frame: always process the newest frame, overriding `frame_policy` with LATEST
+        :param steer_drone: steer the control drone with the detected gestures
         """
         current_time = time.time()
         date_time = datetime.fromtimestamp(time.time())
@@ -58,7 +93,7 @@ class GestureControl:
         if not os.path.isdir(self.save_directory):
             os.makedirs(self.save_directory)
 
-        self.__frame_queue = Queue()
+        self.frame_view_stats = FrameViewStats()
         self.running = False
         self.process_thread = None
         self.window_name = 'Gesture Control'
@@ -67,15 +102,139 @@ class GestureControl:
 
         self.history = []
         self.smoothing_factor = 30
+
+        self.control_drone = control_drone
+        self.steer_drone = steer_drone and control_drone is not None
+        if latency_tracer is None and control_drone is not None:
+            latency_tracer = getattr(control_drone, 'latency_tracer', None)
+        self.latency_tracer = latency_tracer if latency_tracer is not None else LatencyTracer()
+
+        self.process_stats = StageStats('gesture')
+        self.frame_age_stats = RunningStats()
+        self.last_frame_seq = None
+        self.last_frame_time = None
+        self.last_frame_age = None
+
+        if latest_frame:
+            frame_policy = Subscription.LATEST
+        self.frame_bus = frame_bus if frame_bus is not None else FrameBus()
+        self.frame_subscription = self.frame_bus.subscribe(
+            FrameBus.FRAMES, self.id, policy=frame_policy, maxsize=queue_size, latency_tracer=self.latency_tracer
+        )
         return
 
     def cleanup(self):
         self.running = False
+        # wakes the process thread if it is waiting on an empty queue
+        self.frame_subscription.close()
         self.process_thread.join()
+        self.__stop_steering()
+        return
+
+    def add_frame(self, new_frame, trace_id: int = None):
+        """
+        Publishes a frame on the frame bus of the controller.
+
+        :param new_frame:
+        :param trace_id:
+        :return:
+        """
+        new_view = as_frame_view(new_frame, self.frame_view_stats)
+        self.frame_bus.publish(FrameBus.FRAMES, new_view, timestamp=new_view.timestamp, trace_id=trace_id)
+        return
+
+    def queue_depth(self):
+        return len(self.frame_subscription)
+
+    def get_subscription_stats(self):
+        """
+        Lag, drops and frame age of the frame subscription.
+
+        :return:
+        """
+        return self.frame_subscription.get_stats()
+
+    def get_latency_stats(self):
+        return self.latency_tracer.get_stats()
+
+    def get_processing_stats(self):
+        """
+        Rate and duration of processing, frames skipped and the age of each frame when its processing
+        finished, measured from the time the frame was received.
+
+        Skipped frames are those published on the frame bus but never processed, either because they were
+        dropped by the frame subscription or because no features could be tracked in them.
+
+        :return:
+        """
+        stats = {
+            'frame_policy': self.frame_subscription.policy,
+            'processing': self.process_stats.summary(),
+            'process_rate': self.process_stats.throughput,
+            'frames_skipped': self.process_stats.num_dropped,
+            'frame_age': self.frame_age_stats.summary(),
+            'last_frame_age': self.last_frame_age
+        }
+        return stats
+
+    def get_frame_view_stats(self):
+        """
+        Hits and misses of the views of the frames wrapped by this controller. Views of frames added as
+        FrameViews are counted by the stats of their source.
+
+        :return:
+        """
+        return self.frame_view_stats.get_stats()
+
+    def __next_frame(self):
+        """
+        Takes the next frame from the frame subscription, counting the frames skipped since the last one.
+
+        :return: (frame view, trace id, sequence number of the frame on the bus), or (None, None, None) once
+            closed
+        """
+        frame_message, trace_id = self.frame_subscription.get()
+        if frame_message is None:
+            return None, None, None
+        frame_seq = frame_message['seq']
+        if self.last_frame_seq is not None:
+            self.process_stats.drop(frame_seq - self.last_frame_seq - 1)
+        self.last_frame_seq = frame_seq
+        self.last_frame_time = frame_message['timestamp']
+        return as_frame_view(frame_message['value'], self.frame_view_stats), trace_id, frame_seq
+
+    def __steer(self, feature_vector, vector_mag, trace_id):
+        """
+        Steers the control drone in the direction of the gesture, or ends the trace of the frame if
+        steering is off.
+
+        :param feature_vector:
+        :param vector_mag:
+        :param trace_id:
+        :return:
+        """
+        if not self.steer_drone:
+            self.latency_tracer.finish(trace_id)
+            return
+        if vector_mag == 0:
+            self.__stop_steering(trace_id)
+            return
+        left_right = int(np.clip(self.RC_SPEED * feature_vector[0] / vector_mag, -100, 100))
+        up_down = int(np.clip(self.RC_SPEED * feature_vector[1] / vector_mag, -100, 100))
+        self.control_drone.set_rc(left_right, 0, up_down, 0, trace_id=trace_id)
         return
 
-    def add_frame(self, new_frame):
-        self.__frame_queue.put(new_frame)
+    def __stop_steering(self, trace_id: int = None):
+        """
+        Sets a zero rc setpoint on the control drone, if steering is on, or ends the trace of the frame.
+
+        :param trace_id:
+        :return:
+        """
+        if not self.steer_drone:
+            self.latency_tracer.finish(trace_id)
+            return
+        self.control_drone.set_rc(0, 0, 0, 0, trace_id=trace_id)
         return
 
     def get_last_flow(self):
@@ -114,7 +273,7 @@ class GestureControl:
         num_initial = 10
         len_history = 10
         magnitude_threshold = 3
-        frame_resize_factor = 0.25
+        pyramid_level = self.PYRAMID_LEVEL
         draw_color = (0, 255, 0)
         text_color = (0, 0, 255)
         text_font = cv2.FONT_HERSHEY_SIMPLEX
@@ -149,10 +308,11 @@ class GestureControl:
         }
 
         # use first frame to compute image characteristics
-        first_frame = self.__frame_queue.get(block=True)
-        frame_width = int(first_frame.shape[1] * frame_resize_factor)
-        frame_height = int(first_frame.shape[0] * frame_resize_factor)
-        frame_dims = (frame_width, frame_height)
+        first_frame, trace_id, _ = self.__next_frame()
+        self.latency_tracer.drop(trace_id)
+        if first_frame is None:
+            return
+        frame_height, frame_width = first_frame.scaled(pyramid_level).shape[:2]
 
         fps = 15
         codec_str = 'MJPG'
@@ -161,22 +321,30 @@ class GestureControl:
             fps, (frame_width * 2, frame_height * 2)
         )
 
-        prev_frame = cv2.resize(first_frame, frame_dims, interpolation=cv2.INTER_AREA)
+        prev_view = first_frame
         for frame_idx in range(num_initial):
-            frame = self.__frame_queue.get(block=True)
-            prev_frame = cv2.resize(frame, frame_dims, interpolation=cv2.INTER_AREA)
-
-        prev_gray = cv2.cvtColor(prev_frame, cv2.COLOR_BGR2GRAY)
+            prev_view, trace_id, prev_seq = self.__next_frame()
+            self.latency_tracer.drop(trace_id)
+            if prev_view is None:
+                self.video_writer.release()
+                return
+        prev_frame = prev_view.scaled(pyramid_level)
+
+        prev_gray = prev_view.gray(pyramid_level)
         prev_features = cv2.goodFeaturesToTrack(prev_gray, mask=None, **shi_tomasi_params)
         base_angle = [1, 0]
         self.running = True
         while self.running:
-            next_frame = self.__frame_queue.get(block=True)
-            next_frame = cv2.resize(next_frame, frame_dims, interpolation=cv2.INTER_AREA)
+            next_view, trace_id, next_seq = self.__next_frame()
+            if next_view is None:
+                break
+            frame_time = self.last_frame_time
+            process_start = time.perf_counter()
+            next_frame = next_view.scaled(pyramid_level)
             next_mask = np.zeros_like(prev_frame)
             total_mask = np.zeros_like(prev_frame)
 
-            next_gray = cv2.cvtColor(next_frame, cv2.COLOR_BGR2GRAY)
+            next_gray = next_view.gray(pyramid_level)
             next_features, status, error = cv2.calcOpticalFlowPyrLK(
                 prev_gray, next_gray, prev_features, None, **lucas_kanade_params
             )
@@ -189,6 +357,9 @@ class GestureControl:
             num_good_new = shape_good_new[0]
             if num_good_old == 0 or num_good_new == 0:
                 # todo if hit this point, reinitialize system
+                self.latency_tracer.mark(trace_id, LatencyTracer.PROCESSED)
+                self.__stop_steering(trace_id)
+                self.process_stats.drop()
                 continue
 
             num_points = min(len(self.history), len_history)
@@ -199,16 +370,19 @@ class GestureControl:
                 ]
                 for idx, feature in enumerate(recent_feature_list):
                     feature_x, feature_y = feature.ravel()
-                    total_mask = cv2.circle(total_mask, (feature_x, feature_y), 3, draw_color, -1)
+                    total_mask = cv2.circle(total_mask, (int(feature_x), int(feature_y)), 3, draw_color, -1)
 
             overlay_frame = cv2.add(next_frame, total_mask)
             first_feature_old = good_features_old[0, :]
             first_feature_new = good_features_new[0, :]
             old_x, old_y = first_feature_old.ravel()
             new_x, new_y = first_feature_new.ravel()
-            feature_vector = (new_x - old_x, -1 * (new_y - old_y))
+            # displacement per frame interval, as frames may have been skipped since the frame the features
+            # were tracked from, whether by the subscription or because no features could be tracked
+            frame_gap = max(next_seq - prev_seq, 1)
+            feature_vector = ((new_x - old_x) / frame_gap, -1 * (new_y - old_y) / frame_gap)
 
-            next_mask = cv2.circle(next_mask, (new_x, new_y), 3, draw_color, -1)
+            next_mask = cv2.circle(next_mask, (int(new_x), int(new_y)), 3, draw_color, -1)
             vector_mag = np.linalg.norm(feature_vector)
             x_end, y_end = start_arrow
             vector_unit = feature_vector / np.linalg.norm(feature_vector) if vector_mag != 0 else [0, 0]
@@ -228,6 +402,11 @@ class GestureControl:
                 'angle': vector_angle,
                 'exceeds_threshold': vector_mag > magnitude_threshold
             })
+            self.latency_tracer.mark(trace_id, LatencyTracer.PROCESSED)
+            if vector_mag > magnitude_threshold:
+                self.__steer(feature_vector, vector_mag, trace_id)
+            else:
+                self.__stop_steering(trace_id)
 
             text_list = [
                 {'field': f'Magnitude', 'value': f'{vector_mag:0.2f}'},
@@ -242,7 +421,9 @@ class GestureControl:
                     img=overlay_frame, text=f'{text_field}: {text_val}', org=(text_x0, text_y0 + text_dy * (idx + 1)),
                     fontFace=text_font, fontScale=text_scale, color=text_color, thickness=text_thickness
                 )
-            prev_gray = next_gray.copy()
+            # views are read-only, so the gray frame can be kept without copying it
+            prev_gray = next_gray
+            prev_seq = next_seq
             prev_features = good_features_new.reshape(-1, 1, 2)
 
             top_layer = np.concatenate((next_frame, overlay_frame), axis=1)
@@ -253,8 +434,12 @@ class GestureControl:
                 cv2.imshow(self.window_name, frame_stack)
                 self.video_writer.write(frame_stack.astype('uint8'))
                 cv2.waitKey(10)
+            self.last_frame_age = time.time() - frame_time
+            self.frame_age_stats.add(self.last_frame_age)
+            self.process_stats.add(time.perf_counter() - process_start, time.perf_counter())
         self.video_writer.release()
-        cv2.destroyWindow(self.window_name)
+        if self.display_feed:
+            cv2.destroyWindow(self.window_name)
         return
 
 
@@ -263,14 +448,16 @@ def main(main_args):
     ###################################
     playback_file = main_args.get('playback_file', os.path.join(DATA_DIR, 'video', 'webcam_test_0.mp4'))
     video_length = main_args.get('length', 20)
+    latest_frame = main_args.get('latest_frame', False)
     ###################################
-    gesture_control = GestureControl(display_feed=True)
-    observable_video = ObservableVideo(output=gesture_control, video_fname=playback_file)
+    observable_video = ObservableVideo(video_fname=playback_file)
+    gesture_control = GestureControl(display_feed=True, frame_bus=observable_video.frame_bus, latest_frame=latest_frame)
     gesture_control.start_process_thread()
     ###################################
     observable_video.start_video_thread()
     time.sleep(video_length)
     gesture_control.cleanup()
+    print(json.dumps(gesture_control.get_processing_stats(), indent=2))
     return
 
 
@@ -280,6 +467,8 @@ if __name__ == '__main__':
                         help='')
     parser.add_argument('--length', type=int, default=21,
                         help='')
+    parser.add_argument('--latest_frame', action='store_true',
+                        help='always process the newest frame, skipping stale ones')
 
     args = parser.parse_args()
     main(vars(args))
@@ -0,0 +1,402 @@
+"""
+@title
+@description
+"""
+import argparse
+import json
+import math
+import os
+import time
+
+import numpy as np
+
+from auto_drone import DATA_DIR, TERMINAL_COLUMNS
+from auto_drone.drone.rc_scheduler import RcScheduler
+from auto_drone.running_stats import RunningStats
+
+
+class StabilityMonitor:
+    """
+    Decides from the state stream whether the drone has settled after a command.
+
+    The drone is settled once, over the last `settle_window` seconds of states, its velocity and attitude
+    have stopped changing and its acceleration is back to gravity alone. The rates of change are the
+    least-squares slopes of the window, and the acceleration is the mean over the window, so each check
+    costs O(log n) for locating the window, however many states it holds. A steady motion, such as a
+    constant forward speed, is settled: it is the response to the command that is waited on, not a
+    return to hover.
+
+    Only states received after the command count towards settling, so a window that still holds states
+    from before the drone could respond is never taken as settled.
+    """
+
+    SETTLE_WINDOW = 0.3
+    MIN_STATES = 3
+    # cm/s per second
+    MAX_VELOCITY_RATE = 10.0
+    # degrees per second
+    MAX_ATTITUDE_RATE = 5.0
+    # difference of the magnitude of the acceleration from 1 g, in thousandths of a g
+    MAX_ACCEL_DEVIATION = 50.0
+    GRAVITY = 1000.0
+
+    VELOCITY_FIELDS = ('vgx', 'vgy', 'vgz')
+    ATTITUDE_FIELDS = ('pitch', 'roll')
+    ACCEL_FIELDS = ('agx', 'agy', 'agz')
+
+    def __init__(self, settle_window: float = SETTLE_WINDOW, min_states: int = MIN_STATES,
+                 max_velocity_rate: float = MAX_VELOCITY_RATE, max_attitude_rate: float = MAX_ATTITUDE_RATE,
+                 max_accel_deviation: float = MAX_ACCEL_DEVIATION):
+        """
+
+        :param settle_window: seconds of states the drone must have been steady for
+        :param min_states: fewest states received after the command a decision is made on
+        :param max_velocity_rate:
+        :param max_attitude_rate:
+        :param max_accel_deviation:
+        """
+        self.settle_window = settle_window
+        self.min_states = min_states
+        self.max_velocity_rate = max_velocity_rate
+        self.max_attitude_rate = max_attitude_rate
+        self.max_accel_deviation = max_accel_deviation
+        return
+
+    @staticmethod
+    def __max_abs_slope(telemetry_window, field_list):
+        slope_list = [telemetry_window.slope(each_field) for each_field in field_list]
+        slope_list = [abs(each_slope) for each_slope in slope_list if each_slope is not None]
+        return max(slope_list) if len(slope_list) > 0 else None
+
+    def check(self, telemetry_store, since: float = None, end_time: float = None):
+        """
+        Checks whether the drone was settled at `end_time`.
+
+        :param telemetry_store: TelemetryStore of the drone
+        :param since: time of the command being settled from; states received before it are not considered
+        :param end_time: time to check at; the most recent state if None
+        :return: True if settled, and the measures the decision was made on
+        """
+        telemetry_window = telemetry_store.window(seconds=self.settle_window, end_time=end_time)
+        measures = {'num_states': len(telemetry_window)}
+        if len(telemetry_window) < self.min_states:
+            return False, measures
+        if since is not None and telemetry_window.start_time < since:
+            return False, measures
+
+        accel_list = [telemetry_window.mean(each_field) for each_field in self.ACCEL_FIELDS]
+        if None in accel_list:
+            accel_deviation = None
+        else:
+            accel_deviation = abs(math.sqrt(sum(each_accel ** 2 for each_accel in accel_list)) - self.GRAVITY)
+        measures.update({
+            'velocity_rate': self.__max_abs_slope(telemetry_window, self.VELOCITY_FIELDS),
+            'attitude_rate': self.__max_abs_slope(telemetry_window, self.ATTITUDE_FIELDS),
+            'accel_deviation': accel_deviation
+        })
+        limit_list = [
+            (measures['velocity_rate'], self.max_velocity_rate),
+            (measures['attitude_rate'], self.max_attitude_rate),
+            (measures['accel_deviation'], self.max_accel_deviation)
+        ]
+        settled = all(each_value is not None and each_value <= each_limit for each_value, each_limit in limit_list)
+        return settled, measures
+
+
+class PacingLog:
+    """
+    Records, for each command, how long the drone took to settle after it, and compares the pacing this
+    allows against sending commands a fixed delay apart.
+
+    Two fixed-delay baselines are reported. The configured baseline sends every command `baseline_delay`
+    after the last; commands that took longer than that to settle would have been sent on to a drone
+    still reacting, and are counted as early. The safe baseline is the shortest fixed delay that would
+    have waited for every command logged to settle, which is the delay a fixed pacing needs to match the
+    adaptive pacing for safety. The throughput gain is the ratio of the time the safe baseline would take
+    to send the commands to the time taken by settling.
+    """
+
+    def __init__(self, baseline_delay: float):
+        """
+
+        :param baseline_delay: seconds between commands of the fixed-delay baseline
+        """
+        self.baseline_delay = baseline_delay
+        self.records = []
+        self.settle_stats = RunningStats()
+        self.num_timeouts = 0
+        return
+
+    def add(self, command: str, sent_time: float, settle_time: float, timed_out: bool):
+        """
+
+        :param command:
+        :param sent_time: time the command was sent
+        :param settle_time: seconds from sending the command until the drone settled, or the wait timed out
+        :param timed_out: the drone did not settle before the maximum delay
+        :return:
+        """
+        self.records.append({
+            'command': command, 'timestamp': sent_time, 'settle_time': settle_time, 'timed_out': timed_out
+        })
+        self.settle_stats.add(settle_time)
+        if timed_out:
+            self.num_timeouts += 1
+        return
+
+    def get_stats(self):
+        """
+
+        :return:
+        """
+        settle_times = np.asarray([each_record['settle_time'] for each_record in self.records], dtype=np.float64)
+        num_commands = len(settle_times)
+        adaptive_total = float(np.sum(settle_times))
+        safe_delay = float(np.max(settle_times)) if num_commands > 0 else 0.0
+        stats = {
+            'num_commands': num_commands,
+            'num_timeouts': self.num_timeouts,
+            'settle_time': self.settle_stats.summary(),
+            'adaptive_total': adaptive_total,
+            'adaptive_rate': num_commands / adaptive_total if adaptive_total > 0 else 0,
+            'baseline_delay': self.baseline_delay,
+            'baseline_total': num_commands * self.baseline_delay,
+            'baseline_num_early': int(np.count_nonzero(settle_times > self.baseline_delay)),
+            'safe_delay': safe_delay,
+            'safe_total': num_commands * safe_delay,
+            'throughput_gain': num_commands * safe_delay / adaptive_total if adaptive_total > 0 else 0
+        }
+        return stats
+
+    def dump(self, fname: str):
+        """
+        Writes the statistics and the record of every command to a JSON file.
+
+        :param fname:
+        :return:
+        """
+        with open(fname, 'w+') as dump_file:
+            json.dump({'stats': self.get_stats(), 'records': self.records}, dump_file, indent=2)
+        return
+
+
+class AdaptivePacer:
+    """
+    Sends commands to a drone as soon as it has settled after the previous command.
+
+    Before each command, the pacer waits until the StabilityMonitor reports the drone as settled since
+    the previous command was sent, but at least `min_delay` and at most `max_delay` seconds. A drone that
+    has not settled by `max_delay` is sent the next command anyway, and the wait is logged as timed out.
+    The time each command took to settle is added to a PacingLog.
+
+    The rc scheduler of the drone zeroes a setpoint that is not refreshed within its maximum setpoint
+    age, which is shorter than `max_delay`. While waiting after an rc setpoint, sent through the `set_rc`
+    of the drone, the pacer sets it again every `refresh_interval` seconds, so the drone keeps flying
+    the setpoint being settled on instead of stopping partway through the wait.
+    """
+
+    MIN_DELAY = 0.05
+    MAX_DELAY = 3.0
+    POLL_INTERVAL = 0.01
+    REFRESH_INTERVAL = RcScheduler.MAX_SETPOINT_AGE / 2
+
+    def __init__(self, drone, stability_monitor: StabilityMonitor = None, baseline_delay: float = None,
+                 min_delay: float = MIN_DELAY, max_delay: float = MAX_DELAY, poll_interval: float = POLL_INTERVAL,
+                 refresh_interval: float = REFRESH_INTERVAL):
+        """
+
+        :param drone: TelloDrone, or any object with a TelemetryStore as `telemetry`
+        :param stability_monitor:
+        :param baseline_delay: delay of the fixed-delay baseline; the SEND_DELAY of the drone if None
+        :param min_delay:
+        :param max_delay:
+        :param poll_interval: seconds between checks of whether the drone has settled
+        :param refresh_interval: seconds between refreshes of an rc setpoint while waiting for it to settle
+        """
+        self.drone = drone
+        self.stability_monitor = stability_monitor if stability_monitor is not None else StabilityMonitor()
+        if baseline_delay is None:
+            baseline_delay = getattr(drone, 'SEND_DELAY', self.MIN_DELAY)
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.refresh_interval = refresh_interval
+        self.pacing_log = PacingLog(baseline_delay)
+
+        self.last_command = None
+        self.last_sent_time = None
+        self.refresh_args = None
+        self.num_refreshes = 0
+        return
+
+    def wait_settled(self):
+        """
+        Waits until the drone has settled after the last command, and logs the time it took.
+
+        :return: seconds waited since the last command was sent
+        """
+        if self.last_sent_time is None:
+            return 0.0
+        telemetry_store = self.drone.telemetry
+        last_refresh = self.last_sent_time
+        while True:
+            now = time.time()
+            elapsed = now - self.last_sent_time
+            if elapsed >= self.min_delay:
+                settled, _ = self.stability_monitor.check(telemetry_store, since=self.last_sent_time)
+                if settled or elapsed >= self.max_delay:
+                    break
+            if self.refresh_args is not None and now - last_refresh >= self.refresh_interval:
+                self.drone.set_rc(*self.refresh_args)
+                self.num_refreshes += 1
+                last_refresh = now
+            time.sleep(self.poll_interval)
+        self.pacing_log.add(self.last_command, self.last_sent_time, elapsed, timed_out=not settled)
+        self.last_command = None
+        self.last_sent_time = None
+        self.refresh_args = None
+        return elapsed
+
+    def send(self, command: str, command_func, *command_args):
+        """
+        Waits for the drone to settle after the previous command, then sends the next.
+
+        :param command: name the command is logged under
+        :param command_func: function sending the command, e.g. `drone.set_rc`
+        :param command_args: arguments of `command_func`
+        :return: the result of `command_func`
+        """
+        self.wait_settled()
+        self.last_command = command
+        self.last_sent_time = time.time()
+        is_rc = command_func == getattr(self.drone, 'set_rc', None)
+        self.refresh_args = command_args if is_rc else None
+        return command_func(*command_args)
+
+    def get_stats(self):
+        return {**self.pacing_log.get_stats(), 'num_refreshes': self.num_refreshes}
+
+
+def evaluate_commands(telemetry_store, command_list: list, stability_monitor: StabilityMonitor = None,
+                      baseline_delay: float = 0.1, max_delay: float = AdaptivePacer.MAX_DELAY):
+    """
+    Measures, from the states of a recorded or replayed session, how long the drone took to settle after
+    each of its commands, as if the states were being watched by an AdaptivePacer.
+
+    :param telemetry_store: TelemetryStore holding every state of the session
+    :param command_list: (time sent, command) of each command, in order
+    :param stability_monitor:
+    :param baseline_delay:
+    :param max_delay:
+    :return: PacingLog
+    """
+    stability_monitor = stability_monitor if stability_monitor is not None else StabilityMonitor()
+    pacing_log = PacingLog(baseline_delay)
+    time_values = telemetry_store.column('timestamp')
+    for each_time, each_command in command_list:
+        state_idx = int(np.searchsorted(time_values, each_time, side='right'))
+        settle_time = max_delay
+        timed_out = True
+        while state_idx < len(time_values) and time_values[state_idx] - each_time < max_delay:
+            state_time = float(time_values[state_idx])
+            settled, _ = stability_monitor.check(telemetry_store, since=each_time, end_time=state_time)
+            if settled:
+                settle_time = state_time - each_time
+                timed_out = False
+                break
+            state_idx += 1
+        pacing_log.add(each_command, each_time, settle_time, timed_out)
+    return pacing_log
+
+
+def changed_commands(command_times, command_names):
+    """
+    Selects the commands that changed what the drone was asked to do, skipping repeats of the same
+    command, such as an rc setpoint resent at the rc rate.
+
+    :param command_times:
+    :param command_names:
+    :return: (time sent, command) of each selected command
+    """
+    command_list = []
+    last_command = None
+    for each_time, each_command in zip(command_times, command_names):
+        each_command = each_command.decode() if isinstance(each_command, bytes) else str(each_command)
+        if each_command != last_command and each_command != 'command' and not math.isnan(each_time):
+            command_list.append((float(each_time), each_command))
+        last_command = each_command
+    return command_list
+
+
+def main(main_args):
+    from auto_drone.drone.tello_drone import TelloDrone
+    from auto_drone.drone.tello_simulator import TelloSimulator
+    ###################################
+    session_dir = main_args.get('session_dir', None)
+    num_commands = main_args.get('num_commands', 10)
+    rc_speed = main_args.get('rc_speed', 30)
+    baseline_delay = main_args.get('baseline_delay', TelloDrone.SEND_DELAY)
+    ###################################
+    if session_dir is not None:
+        from auto_drone.drone.replay_drone import ReplayDrone
+        replay_drone = ReplayDrone(session_dir=session_dir, speed=ReplayDrone.AS_FAST_AS_POSSIBLE)
+        replay_drone.connect()
+        replay_drone.wait()
+        replay_drone.cleanup()
+        command_list = changed_commands(replay_drone.commands['timestamp'], replay_drone.commands['command'])
+        pacing_log = evaluate_commands(replay_drone.telemetry, command_list, baseline_delay=baseline_delay)
+        save_dir = session_dir
+    else:
+        simulator = TelloSimulator(host='127.0.0.1', command_port=18889, state_port=18890, video_port=18891)
+        simulator.start()
+        tello_drone = TelloDrone(
+            host='127.0.0.1', command_port=18889, local_host='127.0.0.1', local_command_port=0,
+            state_port=18890, video_port=18891, video_relay_port=18892, record_mode=TelloDrone.RECORD_NONE
+        )
+        while not tello_drone.connect():
+            time.sleep(1)
+        tello_drone.control_takeoff()
+        adaptive_pacer = AdaptivePacer(tello_drone, baseline_delay=baseline_delay)
+        # alternate between moving forward, holding, and moving back
+        rc_cycle = [(0, rc_speed, 0, 0), (0, 0, 0, 0), (0, -rc_speed, 0, 0), (0, 0, 0, 0)]
+        for command_idx in range(num_commands):
+            rc_values = rc_cycle[command_idx % len(rc_cycle)]
+            adaptive_pacer.send(f'rc {" ".join(str(each_val) for each_val in rc_values)}',
+                                tello_drone.set_rc, *rc_values)
+        adaptive_pacer.wait_settled()
+        tello_drone.control_land()
+        tello_drone.cleanup()
+        simulator.stop()
+        pacing_log = adaptive_pacer.pacing_log
+        save_dir = tello_drone.save_directory
+    ###################################
+    pacing_stats = pacing_log.get_stats()
+    print('-' * TERMINAL_COLUMNS)
+    print(f'commands:       {pacing_stats["num_commands"]} | timeouts: {pacing_stats["num_timeouts"]}')
+    print(f'settle time:    {pacing_stats["settle_time"]}')
+    print(f'adaptive:       {pacing_stats["adaptive_total"]:0.2f} s | {pacing_stats["adaptive_rate"]:0.2f} cmd/s')
+    print(f'baseline:       {pacing_stats["baseline_total"]:0.2f} s | '
+          f'{pacing_stats["baseline_num_early"]} sent before settled')
+    print(f'safe baseline:  {pacing_stats["safe_total"]:0.2f} s | delay: {pacing_stats["safe_delay"]:0.3f} s')
+    print(f'gain:           {pacing_stats["throughput_gain"]:0.2f}x')
+    print('-' * TERMINAL_COLUMNS)
+    pacing_fname = os.path.join(save_dir if save_dir is not None else DATA_DIR, 'pacing.json')
+    pacing_log.dump(pacing_fname)
+    print(f'Pacing log saved to: {pacing_fname}')
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluates adaptive command pacing on a simulated drone, '
+                                                 'or on the commands and states of a recorded session.')
+    parser.add_argument('--session_dir', type=str, default=None,
+                        help='Recorded session to evaluate. A simulated drone is flown if not given.')
+    parser.add_argument('--num_commands', type=int, default=10,
+                        help='Number of rc commands sent to the simulated drone.')
+    parser.add_argument('--rc_speed', type=int, default=30,
+                        help='Forward speed of the rc commands sent to the simulated drone.')
+    parser.add_argument('--baseline_delay', type=float, default=0.1,
+                        help='Delay between commands of the fixed-delay baseline.')
+
+    args = parser.parse_args()
+    main(vars(args))
@@ -0,0 +1,209 @@
+"""
+@title
+@description
+"""
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from auto_drone.running_stats import Histogram, RunningStats
+
+
+class CommandTransport:
+    """
+    Sends text commands over a UDP socket and correlates the replies with the commands awaiting them.
+
+    The Tello replies to commands with a bare `ok`/`error` (or a value for read commands) and never
+    echoes the command it is replying to. Replies are therefore matched to in-flight commands in the
+    order the commands were sent. Only commands sent with `expect_response=True` take part in this
+    matching; unacknowledged commands (e.g. `rc`) are sent immediately and never wait on, or get
+    matched against, earlier commands.
+
+    Each command that expects a response is given its own deadline. A command that is not answered
+    before its deadline is completed with a `None` response without blocking the commands behind it.
+    A reply that arrives after its command has expired cannot be told apart from the reply to the
+    next command, so late replies will be attributed to the next command in flight, if there is one.
+    """
+
+    RECEIVE_POLL = 0.05
+    DEFAULT_TIMEOUT = 4
+    # upper bounds of the round-trip time histogram, in seconds
+    RTT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, command_socket: socket.socket, address: tuple, buffer_size: int = 1024):
+        """
+
+        :param command_socket: bound UDP socket used for both sending commands and receiving replies
+        :param address: (host, port) the commands are sent to
+        :param buffer_size:
+        """
+        self.command_socket = command_socket
+        self.address = address
+        self.buffer_size = buffer_size
+
+        self.pending = deque()
+        self.pending_lock = threading.Lock()
+
+        self.rtt_stats = RunningStats()
+        self.rtt_histogram = Histogram(self.RTT_BUCKETS)
+        self.num_sent = 0
+        self.num_replies = 0
+        self.num_timeouts = 0
+        self.num_unmatched = 0
+        self.num_errors = 0
+
+        self.receive_thread = None
+        self.running = False
+        return
+
+    def start(self):
+        """
+        Starts the receive thread. Not needed when `handle_datagram` and `expire` are driven by an
+        external event loop.
+
+        :return:
+        """
+        self.command_socket.settimeout(self.RECEIVE_POLL)
+        self.running = True
+        self.receive_thread = threading.Thread(target=self.__receive_loop, daemon=True)
+        self.receive_thread.start()
+        return
+
+    def stop(self):
+        """
+        Stops the receive thread and completes all commands still in flight with a `None` response.
+
+        :return:
+        """
+        self.running = False
+        if self.receive_thread is not None and self.receive_thread.ident:
+            self.receive_thread.join()
+        self.expire(now=float('inf'))
+        return
+
+    def send(self, command: str, expect_response: bool = True, timeout: float = DEFAULT_TIMEOUT):
+        """
+        Sends a command without blocking.
+
+        The returned future resolves to a dictionary describing the command:
+            timestamp:      time the command was sent
+            command:        the command string
+            response:       the decoded reply, or None if no reply was expected or it timed out
+            response_time:  time the reply was received, or None
+            rtt:            round-trip time in seconds, or None
+
+        :param command:
+        :param expect_response: whether the drone replies to this command
+        :param timeout: seconds to wait for the reply before completing the command with a None response
+        :return: concurrent.futures.Future
+        """
+        future = Future()
+        send_time = time.time()
+        entry = {
+            'timestamp': send_time, 'command': command, 'deadline': send_time + timeout, 'future': future
+        }
+        if expect_response:
+            # queued before sending so a fast reply can never arrive ahead of its command
+            with self.pending_lock:
+                self.pending.append(entry)
+        try:
+            self.command_socket.sendto(command.encode(encoding='utf-8'), self.address)
+            self.num_sent += 1
+        except OSError:
+            self.num_errors += 1
+            if expect_response:
+                with self.pending_lock:
+                    if entry in self.pending:
+                        self.pending.remove(entry)
+            self.__complete(entry, None, None)
+            return future
+
+        if not expect_response:
+            self.__complete(entry, None, None)
+        return future
+
+    def handle_datagram(self, response_bytes: bytes, receive_time: float):
+        """
+        Matches a reply to the oldest command still awaiting one.
+
+        :param response_bytes:
+        :param receive_time:
+        :return:
+        """
+        try:
+            response_str = response_bytes.decode('utf-8').strip()
+        except UnicodeDecodeError:
+            self.num_errors += 1
+            return
+
+        self.expire(now=receive_time)
+        with self.pending_lock:
+            entry = self.pending.popleft() if len(self.pending) > 0 else None
+        if entry is None:
+            self.num_unmatched += 1
+            return
+        self.num_replies += 1
+        self.rtt_stats.add(receive_time - entry['timestamp'])
+        self.rtt_histogram.add(receive_time - entry['timestamp'])
+        self.__complete(entry, response_str, receive_time)
+        return
+
+    def expire(self, now: float = None):
+        """
+        Completes every command whose deadline has passed with a None response.
+
+        :param now:
+        :return:
+        """
+        now = time.time() if now is None else now
+        with self.pending_lock:
+            expired_list = [each_entry for each_entry in self.pending if each_entry['deadline'] <= now]
+            for each_entry in expired_list:
+                self.pending.remove(each_entry)
+        for each_entry in expired_list:
+            self.num_timeouts += 1
+            self.__complete(each_entry, None, None)
+        return
+
+    def num_in_flight(self):
+        return len(self.pending)
+
+    def get_stats(self):
+        """
+
+        :return:
+        """
+        stats = {
+            'num_sent': self.num_sent,
+            'num_replies': self.num_replies,
+            'num_timeouts': self.num_timeouts,
+            'num_unmatched': self.num_unmatched,
+            'num_errors': self.num_errors,
+            'num_in_flight': self.num_in_flight(),
+            'rtt': self.rtt_stats.summary()
+        }
+        return stats
+
+    @staticmethod
+    def __complete(entry: dict, response: str, response_time: float):
+        rtt = response_time - entry['timestamp'] if response_time is not None else None
+        send_info = {
+            'timestamp': entry['timestamp'], 'command': entry['command'],
+            'response_time': response_time, 'response': response, 'rtt': rtt
+        }
+        entry['future'].set_result(send_info)
+        return
+
+    def __receive_loop(self):
+        while self.running:
+            try:
+                response_bytes, _ = self.command_socket.recvfrom(self.buffer_size)
+                self.handle_datagram(response_bytes, time.time())
+            except socket.timeout:
+                pass
+            except OSError:
+                self.num_errors += 1
+            self.expire()
+        return
@@ -0,0 +1,217 @@
+"""
+@title
+@description
+"""
+import os
+import struct
+
+import numpy as np
+
+# frame number within the recording, receive time of the frame
+FRAME_STRUCT = struct.Struct('<qd')
+FRAME_DTYPE = np.dtype([('frame', '<i8'), ('timestamp', '<f8')])
+
+
+class FrameTimestampWriter:
+    """
+    Writes the receive time of every frame of a recording to a sidecar file, as fixed-width FRAME_STRUCT
+    entries, so the time of any frame of the recording can be looked up after the fact.
+    """
+
+    FILE_BUFFER_SIZE = 1 << 16
+
+    def __init__(self, timestamp_fname: str):
+        """
+
+        :param timestamp_fname:
+        """
+        self.timestamp_fname = timestamp_fname
+        self.timestamp_file = None
+        self.num_frames = 0
+        return
+
+    def write(self, timestamp: float):
+        """
+        Records the time of the next frame of the recording. The file is opened on the first frame.
+
+        :param timestamp:
+        :return: number of the frame within the recording
+        """
+        if self.timestamp_file is None:
+            self.timestamp_file = open(self.timestamp_fname, 'wb', buffering=self.FILE_BUFFER_SIZE)
+        frame_number = self.num_frames
+        self.timestamp_file.write(FRAME_STRUCT.pack(frame_number, timestamp))
+        self.num_frames += 1
+        return frame_number
+
+    def close(self):
+        if self.timestamp_file is not None:
+            self.timestamp_file.close()
+            self.timestamp_file = None
+        return
+
+
+def read_frame_timestamps(timestamp_fname: str):
+    """
+    Reads a frame timestamp sidecar written by FrameTimestampWriter.
+
+    :param timestamp_fname:
+    :return: structured array with fields frame and timestamp
+    """
+    if not os.path.isfile(timestamp_fname):
+        return np.empty(0, dtype=FRAME_DTYPE)
+    return np.fromfile(timestamp_fname, dtype=FRAME_DTYPE)
+
+
+def estimate_fps(timestamps, default: float = 30):
+    """
+    Estimates the frame rate from the receive times of consecutive frames, using the median interval so
+    that stalls in the stream do not skew the estimate.
+
+    :param timestamps:
+    :param default: returned when there are too few frames to estimate the rate
+    :return:
+    """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    if len(timestamps) < 2:
+        return default
+    intervals = np.diff(timestamps)
+    intervals = intervals[intervals > 0]
+    if len(intervals) == 0:
+        return default
+    return float(1 / np.median(intervals))
+
+
+class StateAligner:
+    """
+    Looks up the state received closest to a given time, e.g. the time a frame was received.
+
+    The aligner wraps the timestamp column of a set of state records, sorted by time, along with the
+    columns of the fields to look up. Lookups are binary searches over the timestamps, so they cost
+    O(log n) and never copy the columns. Nothing is precomputed, so an aligner can be built on the
+    records of a live TelemetryStore, or on the memory-mapped columns of a SessionArchive, for every
+    lookup.
+    """
+
+    def __init__(self, timestamps, columns: dict):
+        """
+
+        :param timestamps: receive times of the states, in increasing order
+        :param columns: field name -> values of the field, aligned with `timestamps`
+        """
+        self.timestamps = timestamps
+        self.columns = columns
+        return
+
+    @classmethod
+    def from_store(cls, telemetry_store):
+        """
+        Aligner over the records received so far by a TelemetryStore.
+
+        :param telemetry_store:
+        :return:
+        """
+        records = telemetry_store.records()
+        return cls(records['timestamp'], {each_field: records[each_field] for each_field in records.dtype.names})
+
+    @classmethod
+    def from_archive(cls, session_archive, table: str = 'states'):
+        """
+        Aligner over the states table of a SessionArchive.
+
+        :param session_archive:
+        :param table:
+        :return:
+        """
+        columns = {each_column: session_archive.column(table, each_column)
+                   for each_column in session_archive.columns(table)}
+        return cls(columns['timestamp'], columns)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def nearest_index(self, timestamp: float, max_gap: float = None):
+        """
+        Index of the state received closest in time to `timestamp`.
+
+        :param timestamp:
+        :param max_gap: seconds; if the closest state is further away than this, None is returned
+        :return:
+        """
+        num_states = len(self.timestamps)
+        if num_states == 0:
+            return None
+        after_idx = int(np.searchsorted(self.timestamps, timestamp, side='left'))
+        if after_idx == 0:
+            nearest_idx = 0
+        elif after_idx == num_states:
+            nearest_idx = num_states - 1
+        elif timestamp - self.timestamps[after_idx - 1] <= self.timestamps[after_idx] - timestamp:
+            nearest_idx = after_idx - 1
+        else:
+            nearest_idx = after_idx
+        if max_gap is not None and abs(self.timestamps[nearest_idx] - timestamp) > max_gap:
+            return None
+        return nearest_idx
+
+    def nearest(self, timestamp: float, max_gap: float = None):
+        """
+        The state received closest in time to `timestamp`.
+
+        :param timestamp:
+        :param max_gap:
+        :return: field name -> value, or None
+        """
+        nearest_idx = self.nearest_index(timestamp, max_gap=max_gap)
+        if nearest_idx is None:
+            return None
+        return {each_field: float(each_column[nearest_idx]) for each_field, each_column in self.columns.items()}
+
+    def interpolate(self, timestamp: float, field_list: list = None):
+        """
+        The state at `timestamp`, linearly interpolated between the states received either side of it.
+        Outside the span of the states, the first or last state is returned.
+
+        :param timestamp:
+        :param field_list: fields to interpolate; every field if None
+        :return: field name -> value, or None if there are no states
+        """
+        num_states = len(self.timestamps)
+        if num_states == 0:
+            return None
+        field_list = field_list if field_list is not None else list(self.columns.keys())
+        after_idx = int(np.searchsorted(self.timestamps, timestamp, side='left'))
+        if after_idx == 0 or after_idx == num_states:
+            state_idx = min(after_idx, num_states - 1)
+            return {each_field: float(self.columns[each_field][state_idx]) for each_field in field_list}
+
+        before_time = float(self.timestamps[after_idx - 1])
+        after_time = float(self.timestamps[after_idx])
+        weight = (timestamp - before_time) / (after_time - before_time) if after_time > before_time else 0.0
+        state = {}
+        for each_field in field_list:
+            before_value = float(self.columns[each_field][after_idx - 1])
+            after_value = float(self.columns[each_field][after_idx])
+            state[each_field] = before_value + weight * (after_value - before_value)
+        state['timestamp'] = timestamp
+        return state
+
+    def align(self, frame_timestamps):
+        """
+        Index of the nearest state for each of many frame times at once.
+
+        :param frame_timestamps:
+        :return: array of state indices, or an empty array if there are no states
+        """
+        frame_timestamps = np.asarray(frame_timestamps, dtype=np.float64)
+        num_states = len(self.timestamps)
+        if num_states == 0:
+            return np.empty(0, dtype=np.int64)
+        after_idx = np.clip(np.searchsorted(self.timestamps, frame_timestamps, side='left'), 1, num_states - 1)
+        if num_states == 1:
+            return np.zeros(len(frame_timestamps), dtype=np.int64)
+        before_idx = after_idx - 1
+        before_gap = frame_timestamps - self.timestamps[before_idx]
+        after_gap = self.timestamps[after_idx] - frame_timestamps
+        choose_before = before_gap <= after_gap
+        return np.where(choose_before, before_idx, after_idx).astype(np.int64)
@@ -0,0 +1,200 @@
+"""
+@title
+@description
+"""
+import threading
+
+import numpy as np
+
+
+class FrameBuffer:
+    """
+    Fixed-capacity ring buffer of video frames backed by a single preallocated array.
+
+    The backing array is allocated when the first frame arrives, as the frame dimensions are not
+    known until the stream is decoded. Once full, each new frame overwrites the oldest one.
+
+    Frames are identified by a sequence number that increases monotonically for the lifetime of
+    the buffer: frame `seq` lives in slot `seq % capacity` until it is overwritten.
+
+    If the frame dimensions change, e.g. after the stream is restarted at another resolution, `reallocate`
+    replaces the backing array; the frames held until then are discarded, but sequence numbers carry on.
+    """
+
+    DEFAULT_CAPACITY = 60
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY):
+        """
+
+        :param capacity: number of frames retained before the oldest is overwritten
+        """
+        if capacity <= 0:
+            raise ValueError(f'Frame buffer capacity must be positive: {capacity}')
+        self.capacity = capacity
+        self.frames = None
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.buffer_lock = threading.Lock()
+
+        # running counters
+        self.num_written = 0
+        self.num_overwritten = 0
+        self.num_reallocations = 0
+        # first sequence number written to the current backing array
+        self.reset_seq = 0
+        self.first_timestamp = None
+        self.last_timestamp = None
+        return
+
+    def __len__(self):
+        return self.num_written - self.oldest_seq
+
+    @property
+    def oldest_seq(self):
+        """
+        Sequence number of the oldest frame still held in the buffer.
+
+        :return:
+        """
+        return max(self.num_written - self.capacity, self.reset_seq)
+
+    @property
+    def newest_seq(self):
+        """
+        Sequence number of the most recently written frame, or -1 if no frame has been written.
+
+        :return:
+        """
+        return self.num_written - 1
+
+    def append(self, frame: np.ndarray, timestamp: float):
+        """
+        Copies the frame into the next slot of the buffer, overwriting the oldest frame once full.
+
+        Raises ValueError if the frame does not match the dimensions of the buffer; see `reallocate`.
+
+        :param frame:
+        :param timestamp:
+        :return: sequence number assigned to the frame
+        """
+        if self.frames is None:
+            self.frames = np.empty((self.capacity, *frame.shape), dtype=frame.dtype)
+        elif frame.shape != self.frames.shape[1:]:
+            raise ValueError(f'Frame shape {frame.shape} does not match buffer shape {self.frames.shape[1:]}')
+
+        with self.buffer_lock:
+            seq = self.num_written
+            slot = seq % self.capacity
+            np.copyto(self.frames[slot], frame)
+            self.timestamps[slot] = timestamp
+            if seq - self.reset_seq >= self.capacity:
+                self.num_overwritten += 1
+            if self.first_timestamp is None:
+                self.first_timestamp = timestamp
+            self.last_timestamp = timestamp
+            self.num_written += 1
+        return seq
+
+    def reallocate(self, frame_shape: tuple, dtype=np.uint8):
+        """
+        Replaces the backing array with one for frames of a new shape, discarding the frames retained.
+        Views returned before the reallocation keep referencing the old array.
+
+        :param frame_shape:
+        :param dtype:
+        :return:
+        """
+        new_frames = np.empty((self.capacity, *frame_shape), dtype=dtype)
+        with self.buffer_lock:
+            self.frames = new_frames
+            self.reset_seq = self.num_written
+            self.num_reallocations += 1
+        return
+
+    def get_last_frame(self):
+        """
+        Gets a view of the most recently written frame.
+
+        The view references the backing array and will be overwritten after `capacity` further frames
+        are written. Copy the frame if it must be kept longer than that.
+
+        :return:
+        """
+        with self.buffer_lock:
+            if self.num_written == self.reset_seq:
+                return None
+            slot = (self.num_written - 1) % self.capacity
+            return self.frames[slot]
+
+    def get_frame(self, seq: int):
+        """
+        Gets a view of the frame with the given sequence number, or None if it has been overwritten
+        or not yet written.
+
+        :param seq:
+        :return:
+        """
+        with self.buffer_lock:
+            if seq < self.oldest_seq or seq >= self.num_written:
+                return None
+            return self.frames[seq % self.capacity]
+
+    def get_timestamp(self, seq: int):
+        """
+        Gets the receive time of the frame with the given sequence number, or None if it has been
+        overwritten or not yet written.
+
+        :param seq:
+        :return:
+        """
+        with self.buffer_lock:
+            if seq < self.oldest_seq or seq >= self.num_written:
+                return None
+            return float(self.timestamps[seq % self.capacity])
+
+    def get_frames(self, since: int = 0):
+        """
+        Gets views of all retained frames with a sequence number of at least `since`, oldest first.
+
+        The returned frames and timestamps are a list of one or two contiguous segments of the backing
+        arrays: a window that wraps around the end of the buffer is split into two views rather than
+        copied into a new array.
+
+        :param since: first sequence number of interest; clamped to the oldest retained frame
+        :return: (first_seq, frame_segments, timestamp_segments)
+        """
+        with self.buffer_lock:
+            start_seq = max(since, self.oldest_seq)
+            end_seq = self.num_written
+            if self.frames is None or start_seq >= end_seq:
+                return start_seq, [], []
+
+            start_slot = start_seq % self.capacity
+            end_slot = end_seq % self.capacity
+            if start_slot < end_slot:
+                slice_list = [slice(start_slot, end_slot)]
+            elif end_slot == 0:
+                slice_list = [slice(start_slot, self.capacity)]
+            else:
+                slice_list = [slice(start_slot, self.capacity), slice(0, end_slot)]
+            frame_segments = [self.frames[each_slice] for each_slice in slice_list]
+            time_segments = [self.timestamps[each_slice] for each_slice in slice_list]
+        return start_seq, frame_segments, time_segments
+
+    def get_stats(self):
+        """
+        Running counters describing the buffer contents.
+
+        :return:
+        """
+        elapsed = (self.last_timestamp - self.first_timestamp) if self.num_written > 1 else 0
+        stats = {
+            'capacity': self.capacity,
+            'num_frames': self.num_written,
+            'num_retained': len(self),
+            'num_overwritten': self.num_overwritten,
+            'num_reallocations': self.num_reallocations,
+            'first_timestamp': self.first_timestamp,
+            'last_timestamp': self.last_timestamp,
+            'fps': (self.num_written - 1) / elapsed if elapsed > 0 else 0,
+        }
+        return stats
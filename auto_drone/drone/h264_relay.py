@@ -0,0 +1,416 @@
+"""
+@title
+@description
+"""
+import argparse
+import os
+import shutil
+import socket
+import struct
+import subprocess
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# receive time, byte offset into the capture, packet size
+INDEX_STRUCT = struct.Struct('<dQI')
+INDEX_DTYPE = np.dtype([('timestamp', '<f8'), ('offset', '<u8'), ('size', '<u4')])
+
+NAL_START_CODE = b'\x00\x00\x01'
+# bytes of a packet carried into the scan of the next one: enough for a start code and a NAL header
+NAL_CARRY_SIZE = len(NAL_START_CODE) + 1
+NAL_SLICE = 1
+NAL_IDR_SLICE = 5
+NAL_SPS = 7
+NAL_PPS = 8
+
+
+def nal_unit_headers(packet: bytes, carry: bytes = b''):
+    """
+    Finds the header byte of every NAL unit that starts within a packet of an Annex B elementary stream.
+    See `nal_unit_starts`.
+
+    :param packet:
+    :param carry: last NAL_CARRY_SIZE bytes of the previous packet of the stream
+    :return: list of NAL header bytes; the type of each is the low five bits
+    """
+    return [each_header for each_header, _ in nal_unit_starts(packet, carry)]
+
+
+def nal_unit_starts(packet: bytes, carry: bytes = b''):
+    """
+    Finds the header byte, and the first byte after it, of every NAL unit of an Annex B elementary stream
+    whose first payload byte is in a packet.
+
+    The last NAL_CARRY_SIZE bytes of the previous packet are scanned ahead of the packet, so a start code
+    or header split across the two packets is still found. A NAL unit whose header is the last byte of
+    the packet is found when the next packet is scanned, and one that only starts in the carried bytes
+    was already found in the previous packet.
+
+    :param packet:
+    :param carry: last NAL_CARRY_SIZE bytes of the previous packet of the stream
+    :return: list of (header byte, first payload byte)
+    """
+    scan_bytes = carry + packet if len(carry) > 0 else packet
+    start_list = []
+    search_idx = scan_bytes.find(NAL_START_CODE)
+    while search_idx != -1:
+        header_idx = search_idx + len(NAL_START_CODE)
+        if header_idx + 1 >= len(scan_bytes):
+            break
+        if header_idx + 1 >= len(carry):
+            start_list.append((scan_bytes[header_idx], scan_bytes[header_idx + 1]))
+        search_idx = scan_bytes.find(NAL_START_CODE, header_idx)
+    return start_list
+
+
+def starts_picture(nal_header: int, payload_byte: int):
+    """
+    Checks whether a NAL unit is the first slice of a coded picture, and so starts an access unit. The
+    slice header opens with first_mb_in_slice, an Exp-Golomb code that is zero, the single bit 1, only
+    for the first slice of a picture.
+
+    :param nal_header:
+    :param payload_byte:
+    :return:
+    """
+    is_slice = (nal_header & 0x1F) in (NAL_SLICE, NAL_IDR_SLICE)
+    return is_slice and (payload_byte & 0x80) != 0
+
+
+class H264Relay:
+    """
+    Receives the raw H.264 elementary stream sent by the drone, writes it to disk untouched and
+    forwards every packet to a loopback port where it is decoded independently.
+
+    Recording the stream as received costs a file write per packet instead of a decode and a
+    re-encode per frame. Alongside the capture, an index file records the receive time, offset and
+    size of every packet as fixed-width INDEX_STRUCT entries.
+
+    The headers of the NAL units in each packet are inspected as it is relayed, so the arrival of every
+    keyframe (an IDR slice) is known before it is decoded, and NAL units with the forbidden bit set,
+    which only a corrupted stream contains, are counted.
+
+    If a frame timestamp writer is given, the receive time of the packet starting each access unit of the
+    capture is written to it, so the frame timestamp sidecar holds an entry for every picture of the
+    capture, in order, whether or not the picture was decoded live. A decoder drops the pictures that
+    arrive before it has seen an SPS, a PPS and a keyframe, so no entries are written for those pictures;
+    they are counted as skipped instead.
+    """
+
+    BUFFER_SIZE = 2048
+    FILE_BUFFER_SIZE = 1 << 20
+    RECEIVE_TIMEOUT = 0.5
+
+    def __init__(self, listen_address: tuple, forward_address: tuple, capture_fname: str = None,
+                 index_fname: str = None, keyframe_callback=None, frame_timestamp_writer=None):
+        """
+
+        :param listen_address: (host, port) the drone sends the video stream to
+        :param forward_address: (host, port) the decoder reads the stream from; not forwarded if None
+        :param capture_fname: file the raw stream is written to; nothing is recorded if None
+        :param index_fname: file the packet index is written to
+        :param keyframe_callback: called with the receive time of each packet starting a keyframe
+        :param frame_timestamp_writer: FrameTimestampWriter the receive time of each recorded access unit is
+            written to
+        """
+        self.listen_address = listen_address
+        self.forward_address = forward_address
+        self.capture_fname = capture_fname
+        self.index_fname = index_fname
+        self.keyframe_callback = keyframe_callback
+        self.frame_timestamp_writer = frame_timestamp_writer
+
+        self.video_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.video_socket.bind(listen_address)
+        self.forward_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        self.capture_file = None
+        self.index_file = None
+        self.capture_offset = 0
+
+        self.relay_thread = None
+        self.running = False
+
+        self.num_packets = 0
+        self.num_bytes = 0
+        self.num_errors = 0
+        self.num_keyframes = 0
+        self.num_access_units = 0
+        self.num_skipped_pictures = 0
+        self.num_corrupt_nals = 0
+        self.nal_carry = b''
+        self.has_sps = False
+        self.has_pps = False
+        self.is_decodable = False
+        self.last_keyframe_time = None
+        self.first_time = None
+        self.last_time = None
+        return
+
+    def open_capture(self):
+        """
+        Opens the capture and index files. Called by `start`, or directly when `handle_packet` is driven by
+        an external event loop instead of the relay thread.
+
+        :return:
+        """
+        if self.capture_fname is not None and self.capture_file is None:
+            self.capture_file = open(self.capture_fname, 'wb', buffering=self.FILE_BUFFER_SIZE)
+            if self.index_fname is not None:
+                self.index_file = open(self.index_fname, 'wb', buffering=self.FILE_BUFFER_SIZE)
+        return
+
+    def start(self):
+        """
+
+        :return:
+        """
+        self.open_capture()
+        self.video_socket.settimeout(self.RECEIVE_TIMEOUT)
+        self.running = True
+        self.relay_thread = threading.Thread(target=self.__relay, daemon=True)
+        self.relay_thread.start()
+        return
+
+    def stop(self):
+        """
+
+        :return:
+        """
+        self.running = False
+        if self.relay_thread is not None and self.relay_thread.ident:
+            self.relay_thread.join()
+        if self.capture_file is not None:
+            self.capture_file.close()
+        if self.index_file is not None:
+            self.index_file.close()
+        self.video_socket.close()
+        self.forward_socket.close()
+        return
+
+    def handle_packet(self, packet: bytes, receive_time: float):
+        """
+        Records and forwards a single packet of the stream.
+
+        :param packet:
+        :param receive_time:
+        :return:
+        """
+        if self.capture_file is not None:
+            self.capture_file.write(packet)
+            if self.index_file is not None:
+                self.index_file.write(INDEX_STRUCT.pack(receive_time, self.capture_offset, len(packet)))
+            self.capture_offset += len(packet)
+        if self.forward_address is not None:
+            try:
+                self.forward_socket.sendto(packet, self.forward_address)
+            except OSError:
+                self.num_errors += 1
+
+        self.__inspect_nal_units(packet, receive_time, self.capture_file is not None)
+
+        self.num_packets += 1
+        self.num_bytes += len(packet)
+        if self.first_time is None:
+            self.first_time = receive_time
+        self.last_time = receive_time
+        return
+
+    def __inspect_nal_units(self, packet: bytes, receive_time: float, recorded: bool):
+        for each_header, each_payload in nal_unit_starts(packet, self.nal_carry):
+            if each_header & 0x80:
+                self.num_corrupt_nals += 1
+                continue
+            nal_type = each_header & 0x1F
+            if nal_type == NAL_SPS:
+                self.has_sps = True
+            elif nal_type == NAL_PPS:
+                self.has_pps = True
+            if not starts_picture(each_header, each_payload):
+                continue
+            self.num_access_units += 1
+            if nal_type == NAL_IDR_SLICE and self.has_sps and self.has_pps:
+                self.is_decodable = True
+            if recorded and self.frame_timestamp_writer is not None:
+                if self.is_decodable:
+                    self.frame_timestamp_writer.write(receive_time)
+                else:
+                    self.num_skipped_pictures += 1
+            if nal_type == NAL_IDR_SLICE:
+                self.num_keyframes += 1
+                self.last_keyframe_time = receive_time
+                if self.keyframe_callback is not None:
+                    self.keyframe_callback(receive_time)
+        self.nal_carry = (self.nal_carry + packet)[-NAL_CARRY_SIZE:]
+        return
+
+    def get_stats(self):
+        """
+
+        :return:
+        """
+        elapsed = (self.last_time - self.first_time) if self.num_packets > 1 else 0
+        stats = {
+            'num_packets': self.num_packets,
+            'num_bytes': self.num_bytes,
+            'num_errors': self.num_errors,
+            'num_keyframes': self.num_keyframes,
+            'num_access_units': self.num_access_units,
+            'num_skipped_pictures': self.num_skipped_pictures,
+            'num_corrupt_nals': self.num_corrupt_nals,
+            'packet_rate': self.num_packets / elapsed if elapsed > 0 else 0,
+            'bitrate': 8 * self.num_bytes / elapsed if elapsed > 0 else 0,
+            'capture_fname': self.capture_fname,
+            'index_fname': self.index_fname
+        }
+        return stats
+
+    def __relay(self):
+        while self.running:
+            try:
+                packet, _ = self.video_socket.recvfrom(self.BUFFER_SIZE)
+            except socket.timeout:
+                continue
+            except OSError:
+                self.num_errors += 1
+                continue
+            self.handle_packet(packet, time.time())
+        return
+
+
+def read_capture_index(index_fname: str):
+    """
+    Reads a packet index written by H264Relay.
+
+    :param index_fname:
+    :return: structured array with fields timestamp, offset and size
+    """
+    return np.fromfile(index_fname, dtype=INDEX_DTYPE)
+
+
+def estimate_capture_fps(capture_fname: str, index_fname: str = None):
+    """
+    Estimates the frame rate of a capture by counting its frames and dividing by the time spanned by its
+    packet index. Falls back to the frame rate reported by the decoder if there is no index.
+
+    :param capture_fname:
+    :param index_fname:
+    :return:
+    """
+    video_capture = cv2.VideoCapture(capture_fname, cv2.CAP_FFMPEG)
+    reported_fps = video_capture.get(cv2.CAP_PROP_FPS)
+    num_frames = 0
+    while video_capture.grab():
+        num_frames += 1
+    video_capture.release()
+
+    if index_fname is not None and os.path.isfile(index_fname):
+        capture_index = read_capture_index(index_fname)
+        if len(capture_index) > 1:
+            duration = capture_index['timestamp'][-1] - capture_index['timestamp'][0]
+            if duration > 0 and num_frames > 1:
+                return (num_frames - 1) / duration
+    return reported_fps if reported_fps > 0 else 30
+
+
+def decode_capture(capture_fname: str, output_fname: str, index_fname: str = None, fps: float = None):
+    """
+    Decodes a raw capture and re-encodes it to an MJPG video.
+
+    :param capture_fname:
+    :param output_fname:
+    :param index_fname: packet index used to estimate the frame rate when `fps` is not given
+    :param fps:
+    :return: number of frames written
+    """
+    if fps is None:
+        fps = estimate_capture_fps(capture_fname, index_fname)
+
+    video_capture = cv2.VideoCapture(capture_fname, cv2.CAP_FFMPEG)
+    if not video_capture.isOpened():
+        raise RuntimeError(f'Could not open capture: {capture_fname}')
+
+    video_writer = None
+    num_frames = 0
+    while True:
+        read_success, video_frame = video_capture.read()
+        if not read_success:
+            break
+        if video_writer is None:
+            frame_height, frame_width = video_frame.shape[:2]
+            codec_str = 'MJPG'
+            video_writer = cv2.VideoWriter(
+                output_fname, cv2.VideoWriter_fourcc(*codec_str), fps, (frame_width, frame_height)
+            )
+        video_writer.write(video_frame)
+        num_frames += 1
+    video_capture.release()
+    if video_writer is not None:
+        video_writer.release()
+    return num_frames
+
+
+def remux_capture(capture_fname: str, output_fname: str, index_fname: str = None, fps: float = None):
+    """
+    Copies the H.264 stream of a raw capture into a container (e.g. mp4 or mkv) without re-encoding.
+
+    Requires the ffmpeg executable to be on the path.
+
+    :param capture_fname:
+    :param output_fname:
+    :param index_fname: packet index used to estimate the frame rate when `fps` is not given
+    :param fps:
+    :return:
+    """
+    ffmpeg_path = shutil.which('ffmpeg')
+    if ffmpeg_path is None:
+        raise RuntimeError(f'Could not find ffmpeg on the path')
+    if fps is None:
+        fps = estimate_capture_fps(capture_fname, index_fname)
+
+    command_list = [
+        ffmpeg_path, '-y', '-loglevel', 'error',
+        '-framerate', f'{fps:0.3f}', '-f', 'h264', '-i', capture_fname,
+        '-c:v', 'copy', output_fname
+    ]
+    subprocess.run(command_list, check=True)
+    return
+
+
+def main(main_args):
+    capture_fname = main_args['capture']
+    output_fname = main_args['output']
+    mode = main_args.get('mode', 'decode')
+    fps = main_args.get('fps', None)
+    index_fname = main_args.get('index', None)
+    if index_fname is None:
+        capture_base, _ = os.path.splitext(capture_fname)
+        index_fname = f'{capture_base}.idx'
+    ###################################
+    if mode == 'remux':
+        remux_capture(capture_fname, output_fname, index_fname=index_fname, fps=fps)
+        print(f'Remuxed {capture_fname} to {output_fname}')
+    else:
+        num_frames = decode_capture(capture_fname, output_fname, index_fname=index_fname, fps=fps)
+        print(f'Decoded {num_frames} frames from {capture_fname} to {output_fname}')
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Decode or remux a raw H.264 capture recorded from the Tello.')
+    parser.add_argument('--capture', type=str, required=True,
+                        help='raw H.264 capture file')
+    parser.add_argument('--output', type=str, required=True,
+                        help='output video file')
+    parser.add_argument('--mode', type=str, default='decode', choices=['decode', 'remux'],
+                        help='decode and re-encode to MJPG, or copy the stream into a container using ffmpeg')
+    parser.add_argument('--index', type=str, default=None,
+                        help='packet index file, defaults to the capture file with an .idx extension')
+    parser.add_argument('--fps', type=float, default=None,
+                        help='frame rate of the output, estimated from the capture if not given')
+
+    args = parser.parse_args()
+    main(vars(args))
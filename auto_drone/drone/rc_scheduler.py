@@ -0,0 +1,184 @@
+"""
+@title
+@description
+"""
+import threading
+import time
+
+from auto_drone.drone.command_transport import CommandTransport
+from auto_drone.latency_trace import LatencyTracer
+from auto_drone.running_stats import RunningStats
+
+
+class RcScheduler:
+    """
+    Streams the most recent rc setpoint to the drone at a fixed rate.
+
+    Callers update the setpoint as often as they like; updates made between two sends are coalesced
+    and only the latest is sent. As the drone receives an rc command every period, the stream also
+    serves as the keepalive that prevents the drone from auto-landing after 15 seconds without a
+    command.
+
+    Sends are scheduled against absolute deadlines on a monotonic clock, so the rate does not drift
+    with the time spent sending. If the thread falls more than a period behind, the missed sends are
+    skipped rather than sent in a burst.
+
+    A setpoint expires `max_setpoint_age` seconds after it was last updated, after which the scheduler
+    falls back to streaming `rc 0 0 0 0`, so a caller that stalls or crashes after a non-zero setpoint
+    does not leave the drone moving. The zero setpoint still serves as the keepalive.
+
+    A setpoint may carry the id of a LatencyTracer trace. The trace is finished when the setpoint is
+    first sent, or dropped if the setpoint is replaced before it is sent.
+    """
+
+    DEFAULT_RATE = 20
+    MAX_SETPOINT_AGE = 1.0
+    ZERO_SETPOINT = (0, 0, 0, 0)
+
+    def __init__(self, transport: CommandTransport, rate: float = DEFAULT_RATE, expect_response: bool = False,
+                 latency_tracer: LatencyTracer = None, max_setpoint_age: float = MAX_SETPOINT_AGE):
+        """
+
+        :param transport:
+        :param rate: sends per second, typically between 20 and 50
+        :param expect_response: whether the drone acknowledges rc commands
+        :param latency_tracer: tracer the traces of setpoints are finished in
+        :param max_setpoint_age: seconds a setpoint is streamed without being updated before it is zeroed
+        """
+        if rate <= 0:
+            raise ValueError(f'RC send rate must be positive: {rate}')
+        if max_setpoint_age <= 0:
+            raise ValueError(f'Maximum setpoint age must be positive: {max_setpoint_age}')
+        self.transport = transport
+        self.rate = rate
+        self.period = 1 / rate
+        self.expect_response = expect_response
+        self.max_setpoint_age = max_setpoint_age
+
+        self.setpoint = self.ZERO_SETPOINT
+        self.setpoint_time = time.perf_counter()
+        self.setpoint_sent = True
+        self.setpoint_trace = None
+        self.setpoint_lock = threading.Lock()
+        self.latency_tracer = latency_tracer
+
+        self.schedule_thread = None
+        self.running = False
+
+        self.num_updates = 0
+        self.num_coalesced = 0
+        self.num_sent = 0
+        self.num_missed = 0
+        self.num_expired = 0
+        self.lateness_stats = RunningStats()
+        self.interval_stats = RunningStats()
+        return
+
+    def start(self):
+        """
+
+        :return:
+        """
+        self.running = True
+        self.schedule_thread = threading.Thread(target=self.__schedule_loop, daemon=True)
+        self.schedule_thread.start()
+        return
+
+    def stop(self):
+        """
+
+        :return:
+        """
+        self.running = False
+        if self.schedule_thread is not None and self.schedule_thread.ident:
+            self.schedule_thread.join()
+        return
+
+    def update(self, left_right: int, forward_back: int, up_down: int, yaw: int, trace_id: int = None):
+        """
+        Sets the rc setpoint sent on the next tick, replacing any setpoint not yet sent.
+
+        :param left_right:
+        :param forward_back:
+        :param up_down:
+        :param yaw:
+        :param trace_id: latency trace of the frame the setpoint was computed from, if any
+        :return:
+        """
+        with self.setpoint_lock:
+            replaced_trace = None
+            if not self.setpoint_sent:
+                self.num_coalesced += 1
+                replaced_trace = self.setpoint_trace
+            self.setpoint = (left_right, forward_back, up_down, yaw)
+            self.setpoint_time = time.perf_counter()
+            self.setpoint_trace = trace_id
+            self.setpoint_sent = False
+            self.num_updates += 1
+        if self.latency_tracer is not None:
+            self.latency_tracer.drop(replaced_trace)
+        return
+
+    def get_stats(self):
+        """
+        Send counters and timing statistics. Lateness is how far each send was behind its scheduled
+        time; interval is the measured time between consecutive sends.
+
+        :return:
+        """
+        stats = {
+            'rate': self.rate,
+            'num_updates': self.num_updates,
+            'num_coalesced': self.num_coalesced,
+            'num_sent': self.num_sent,
+            'num_missed': self.num_missed,
+            'num_expired': self.num_expired,
+            'lateness': self.lateness_stats.summary(),
+            'interval': self.interval_stats.summary(),
+            'jitter': self.interval_stats.std
+        }
+        return stats
+
+    def __schedule_loop(self):
+        next_send = time.perf_counter()
+        last_send = None
+        while self.running:
+            sleep_time = next_send - time.perf_counter()
+            if sleep_time > 0:
+                time.sleep(sleep_time)
+
+            with self.setpoint_lock:
+                setpoint_expired = (
+                    self.setpoint != self.ZERO_SETPOINT
+                    and time.perf_counter() - self.setpoint_time > self.max_setpoint_age
+                )
+                if setpoint_expired:
+                    self.setpoint = self.ZERO_SETPOINT
+                    self.num_expired += 1
+                    if self.latency_tracer is not None:
+                        # a setpoint left unsent until it expired is never sent
+                        self.latency_tracer.drop(self.setpoint_trace)
+                    self.setpoint_trace = None
+                left_right, forward_back, up_down, yaw = self.setpoint
+                setpoint_trace = self.setpoint_trace
+                self.setpoint_trace = None
+                self.setpoint_sent = True
+            send_time = time.perf_counter()
+            self.transport.send(
+                f'rc {left_right} {forward_back} {up_down} {yaw}', expect_response=self.expect_response
+            )
+            if self.latency_tracer is not None:
+                self.latency_tracer.finish(setpoint_trace, LatencyTracer.RC_SENT)
+            self.num_sent += 1
+            self.lateness_stats.add(send_time - next_send)
+            if last_send is not None:
+                self.interval_stats.add(send_time - last_send)
+            last_send = send_time
+
+            next_send += self.period
+            behind = time.perf_counter() - next_send
+            if behind > self.period:
+                num_skipped = int(behind // self.period)
+                self.num_missed += num_skipped
+                next_send += num_skipped * self.period
+        return
@@ -0,0 +1,366 @@
+"""
+@title
+@description
+"""
+import argparse
+import glob
+import json
+import math
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from auto_drone.drone.frame_alignment import StateAligner, estimate_fps, read_frame_timestamps
+from auto_drone.drone.frame_buffer import FrameBuffer
+from auto_drone.drone.h264_relay import read_capture_index
+from auto_drone.drone.session_archive import command_columns, load_records, state_columns
+from auto_drone.drone.telemetry import STATE_DTYPE, TelemetryGetters, TelemetryStore, record_to_dict
+from auto_drone.frame_bus import FrameBus
+from auto_drone.frame_views import FrameView, FrameViewStats
+from auto_drone.latency_trace import LatencyTracer
+from auto_drone.running_stats import RunningStats
+
+
+class ReplayDrone(TelemetryGetters):
+    """
+    Replays a recorded TelloDrone session through the same interface as TelloDrone.
+
+    States and video frames are released in the order, and with the timestamps, they were recorded,
+    so consumers see the same data on every run. The replay runs at `speed` times real time, or as fast
+    as frames can be decoded when `speed` is AS_FAST_AS_POSSIBLE. Commands sent to the replay are not
+    executed but captured, stamped with the session time at which they were issued.
+
+    Frames are pushed to every object in `output_list` through its `add_frame` method, as done by
+    ObservableVideo, along with the id of a latency trace, as done by TelloDrone, and published on
+    `frame_bus` along with the replayed states. The trace of a captured rc command is finished when the
+    command is captured.
+    """
+
+    AS_FAST_AS_POSSIBLE = 0
+    DEFAULT_FPS = 30
+
+    def __init__(self, session_dir: str, speed: float = 1.0, output_list: list = None,
+                 frame_buffer_depth: int = FrameBuffer.DEFAULT_CAPACITY):
+        """
+
+        :param session_dir: directory of a session recorded by TelloDrone
+        :param speed: replay speed relative to real time; AS_FAST_AS_POSSIBLE to not wait between records
+        :param output_list: objects with an add_frame method that receive each replayed frame
+        :param frame_buffer_depth:
+        """
+        if speed < 0:
+            raise ValueError(f'Replay speed must not be negative: {speed}')
+        self.session_dir = session_dir
+        self.speed = speed
+        self.output_list = output_list if output_list is not None else []
+        self.frame_bus = FrameBus()
+        self.frame_view_stats = FrameViewStats()
+        self.name = 'Replay'
+        self.id = os.path.basename(os.path.normpath(session_dir))
+
+        self.metadata = {}
+        metadata_fname = self.__find_file('metadata_', ['.json'])
+        if metadata_fname is not None:
+            with open(metadata_fname, 'r') as metadata_file:
+                self.metadata = json.load(metadata_file)
+
+        state_fname = self.__find_file('states_', ['.jsonl', '.json'])
+        state_columns_dict = state_columns(load_records(state_fname)) if state_fname is not None else {}
+        self.states = np.empty(len(state_columns_dict.get('timestamp', [])), dtype=STATE_DTYPE)
+        for field_name, field_values in state_columns_dict.items():
+            self.states[field_name] = field_values
+        self.states.sort(order='timestamp')
+
+        # commands sent during the recorded session, as opposed to those sent to the replay
+        message_fname = self.__find_file('messages_', ['.jsonl', '.json'])
+        self.commands = command_columns(load_records(message_fname) if message_fname is not None else [])
+
+        self.video_fname = self.__find_file(f'{self.id}', ['.avi', '.h264'])
+        frame_times_fname = self.__find_file('frames_', ['.ts'])
+        frame_times = read_frame_timestamps(frame_times_fname) if frame_times_fname is not None else []
+        self.frame_times = np.sort(frame_times['timestamp']) if len(frame_times) > 0 else np.empty(0)
+        self.frame_start_time, self.frame_period = self.__frame_timing()
+
+        # drone interface
+        self.sdk_mode = True
+        self.is_flying = False
+        self.telemetry = TelemetryStore()
+        self.frame_buffer = FrameBuffer(capacity=frame_buffer_depth)
+        self.send_history = []
+        self.message_lock = threading.Lock()
+        self.latency_tracer = LatencyTracer()
+
+        # replay state
+        self.session_time = None
+        self.session_start_time = None
+        self.replay_thread = None
+        self.running = False
+        self.finished = threading.Event()
+        self.wall_start_time = None
+        self.wall_end_time = None
+        self.num_states_replayed = 0
+        self.num_frames_replayed = 0
+        self.lateness_stats = RunningStats()
+        return
+
+    def __find_file(self, prefix: str, extension_list: list):
+        for each_extension in extension_list:
+            fname_list = sorted(glob.glob(os.path.join(self.session_dir, f'{prefix}*{each_extension}')))
+            if len(fname_list) > 0:
+                return fname_list[0]
+        return None
+
+    def __frame_timing(self):
+        """
+        Works out when the first frame of the recording was received and the time between frames, using
+        the frame timestamp sidecar, the session metadata, the packet index of a raw capture, or, failing
+        those, the first state and the frame rate reported by the video file. Frames with a recorded
+        timestamp are replayed at that time; the period only applies to frames past the end of the sidecar.
+
+        :return: (first frame time, frame period)
+        """
+        if len(self.frame_times) > 0:
+            return float(self.frame_times[0]), 1 / estimate_fps(self.frame_times, default=self.DEFAULT_FPS)
+        start_time = self.metadata.get('video_start_time', -1)
+        fps = self.metadata.get('video_fps', 0)
+        if self.video_fname is not None and self.video_fname.endswith('.h264'):
+            index_fname = f'{os.path.splitext(self.video_fname)[0]}.idx'
+            if os.path.isfile(index_fname):
+                capture_index = read_capture_index(index_fname)
+                if len(capture_index) > 0:
+                    start_time = float(capture_index['timestamp'][0])
+        if start_time is None or start_time < 0:
+            start_time = float(self.states['timestamp'][0]) if len(self.states) > 0 else 0.0
+        if not fps or fps <= 0:
+            fps = self.DEFAULT_FPS
+            if self.video_fname is not None:
+                video_capture = cv2.VideoCapture(self.video_fname)
+                reported_fps = video_capture.get(cv2.CAP_PROP_FPS)
+                video_capture.release()
+                fps = reported_fps if reported_fps > 0 else fps
+        return start_time, 1 / fps
+
+    def __frame_time(self, frame_idx: int):
+        if frame_idx < len(self.frame_times):
+            return float(self.frame_times[frame_idx])
+        if len(self.frame_times) > 0:
+            return float(self.frame_times[-1]) + (frame_idx - len(self.frame_times) + 1) * self.frame_period
+        return self.frame_start_time + frame_idx * self.frame_period
+
+    def connect(self):
+        """
+        Starts the replay.
+
+        :return:
+        """
+        self.running = True
+        self.finished.clear()
+        self.replay_thread = threading.Thread(target=self.__replay, daemon=True)
+        self.replay_thread.start()
+        return True
+
+    def wait(self, timeout: float = None):
+        """
+        Blocks until the whole session has been replayed.
+
+        :param timeout:
+        :return: True if the replay finished
+        """
+        return self.finished.wait(timeout)
+
+    def cleanup(self):
+        """
+
+        :return:
+        """
+        self.running = False
+        if self.replay_thread is not None and self.replay_thread.ident:
+            self.replay_thread.join()
+        return
+
+    def __replay(self):
+        video_capture = cv2.VideoCapture(self.video_fname) if self.video_fname is not None else None
+        frames_remaining = video_capture is not None and video_capture.isOpened()
+
+        first_time_list = [self.frame_start_time] if frames_remaining else []
+        if len(self.states) > 0:
+            first_time_list.append(float(self.states['timestamp'][0]))
+        session_start = min(first_time_list) if len(first_time_list) > 0 else 0
+        self.session_start_time = session_start
+        self.wall_start_time = time.perf_counter()
+
+        state_idx = 0
+        frame_idx = 0
+        while self.running:
+            next_state_time = float(self.states['timestamp'][state_idx]) if state_idx < len(self.states) else math.inf
+            next_frame_time = self.__frame_time(frame_idx) if frames_remaining else math.inf
+            next_time = min(next_state_time, next_frame_time)
+            if next_time == math.inf:
+                break
+
+            if self.speed != self.AS_FAST_AS_POSSIBLE:
+                target_time = self.wall_start_time + (next_time - session_start) / self.speed
+                sleep_time = target_time - time.perf_counter()
+                if sleep_time > 0:
+                    time.sleep(sleep_time)
+                self.lateness_stats.add(max(time.perf_counter() - target_time, 0))
+
+            if next_state_time <= next_frame_time:
+                self.session_time = next_time
+                self.telemetry.append(self.states[state_idx])
+                if self.frame_bus.has_subscribers(FrameBus.TELEMETRY):
+                    self.frame_bus.publish(FrameBus.TELEMETRY, record_to_dict(self.states[state_idx]), next_time)
+                state_idx += 1
+                self.num_states_replayed += 1
+                continue
+
+            read_success, video_frame = video_capture.read()
+            if not read_success:
+                frames_remaining = False
+                continue
+            self.session_time = next_time
+            frame_seq = self.frame_buffer.append(video_frame, next_time)
+            frame_idx += 1
+            self.num_frames_replayed += 1
+            frame_view = FrameView(video_frame, next_time, frame_seq, self.frame_view_stats)
+            for each_output in self.output_list:
+                each_output.add_frame(frame_view, trace_id=self.latency_tracer.start(LatencyTracer.DECODED))
+            self.frame_bus.publish(FrameBus.FRAMES, frame_view, timestamp=next_time)
+
+        self.wall_end_time = time.perf_counter()
+        if video_capture is not None:
+            video_capture.release()
+        self.finished.set()
+        return
+
+    def get_replay_stats(self):
+        """
+        Progress and throughput of the replay. Lateness is how far behind schedule each record was released.
+
+        :return:
+        """
+        wall_end = self.wall_end_time if self.wall_end_time is not None else time.perf_counter()
+        wall_elapsed = wall_end - self.wall_start_time if self.wall_start_time is not None else 0
+        session_elapsed = (self.session_time - self.session_start_time) if self.session_time is not None else 0
+        stats = {
+            'speed': self.speed,
+            'num_states': len(self.states),
+            'num_states_replayed': self.num_states_replayed,
+            'num_frames_replayed': self.num_frames_replayed,
+            'wall_time': wall_elapsed,
+            'session_time': session_elapsed,
+            'replay_fps': self.num_frames_replayed / wall_elapsed if wall_elapsed > 0 else 0,
+            'speedup': session_elapsed / wall_elapsed if wall_elapsed > 0 else 0,
+            'lateness': self.lateness_stats.summary(),
+            'frame_views': self.frame_view_stats.get_stats(),
+            'bus': self.frame_bus.get_stats(),
+            'finished': self.finished.is_set()
+        }
+        return stats
+
+    def get_latency_stats(self):
+        return self.latency_tracer.get_stats()
+
+    def __capture_command(self, command: str):
+        send_info = {
+            'timestamp': self.session_time, 'command': command, 'response_time': None, 'response': None, 'rtt': None
+        }
+        with self.message_lock:
+            self.send_history.append(send_info)
+        return send_info
+
+    def get_last_state(self):
+        return self.telemetry.last()
+
+    def get_snapshot(self):
+        return self.telemetry.snapshot()
+
+    def get_telemetry_column(self, field_name: str):
+        return self.telemetry.column(field_name)
+
+    def get_window(self, seconds: float = None, count: int = None):
+        return self.telemetry.window(seconds=seconds, count=count)
+
+    def get_frame_state(self, seq: int = None, interpolate: bool = False, max_gap: float = None):
+        seq = self.frame_buffer.newest_seq if seq is None else seq
+        frame_time = self.frame_buffer.get_timestamp(seq)
+        if frame_time is None:
+            return None
+        state_aligner = StateAligner.from_store(self.telemetry)
+        if interpolate:
+            return state_aligner.interpolate(frame_time)
+        return state_aligner.nearest(frame_time, max_gap=max_gap)
+
+    def get_last_frame(self):
+        return self.frame_buffer.get_last_frame()
+
+    def get_frames(self, since: int = 0):
+        return self.frame_buffer.get_frames(since=since)
+
+    def control_takeoff(self):
+        self.__capture_command('takeoff')
+        self.is_flying = True
+        return
+
+    def control_land(self):
+        self.__capture_command('land')
+        self.is_flying = False
+        return
+
+    def control_emergency(self):
+        return self.__capture_command('emergency')
+
+    def set_speed(self, speed_cms):
+        self.__capture_command(f'speed {int(speed_cms)}')
+        return
+
+    def set_rc(self, left_right, forward_back, up_down, yaw, trace_id: int = None):
+        self.latency_tracer.mark(trace_id, LatencyTracer.RC_QUEUED)
+        self.__capture_command(f'rc {left_right} {forward_back} {up_down} {yaw}')
+        self.latency_tracer.finish(trace_id, LatencyTracer.RC_SENT)
+        return
+
+
+def main(main_args):
+    from auto_drone.ai_control.gesture_control import GestureControl
+    ###################################
+    session_dir = main_args['session_dir']
+    speed = main_args.get('speed', 1.0)
+    latest_frame = main_args.get('latest_frame', False)
+    ###################################
+    replay_drone = ReplayDrone(session_dir=session_dir, speed=speed)
+    gesture_control = GestureControl(
+        display_feed=False, control_drone=replay_drone, frame_bus=replay_drone.frame_bus, latest_frame=latest_frame,
+        steer_drone=True
+    )
+    gesture_control.start_process_thread()
+    replay_start = time.time()
+    replay_drone.connect()
+    replay_drone.wait()
+    replay_end = time.time()
+    gesture_control.cleanup()
+    ###################################
+    replay_stats = replay_drone.get_replay_stats()
+    num_processed = len(gesture_control.history)
+    replay_stats['num_frames_processed'] = num_processed
+    replay_stats['processed_fps'] = num_processed / max(replay_end - replay_start, 1e-9)
+    replay_stats['latency'] = replay_drone.get_latency_stats()
+    replay_stats['processing'] = gesture_control.get_processing_stats()
+    print(json.dumps(replay_stats, indent=2))
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a recorded TelloDrone session through GestureControl.')
+    parser.add_argument('--session_dir', type=str, required=True,
+                        help='directory of a recorded session')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed relative to real time, 0 to replay as fast as possible')
+    parser.add_argument('--latest_frame', action='store_true',
+                        help='process only the newest frame, skipping frames that arrive while processing')
+
+    args = parser.parse_args()
+    main(vars(args))
@@ -0,0 +1,335 @@
+"""
+@title
+@description
+"""
+import argparse
+import glob
+import json
+import math
+import os
+
+import numpy as np
+
+from auto_drone.drone.frame_alignment import StateAligner, read_frame_timestamps
+from auto_drone.drone.h264_relay import read_capture_index
+from auto_drone.drone.telemetry import STATE_DTYPE
+from auto_drone.session_log import read_session_log
+
+SCHEMA_FNAME = 'schema.json'
+
+COMMAND_LENGTH = 32
+RESPONSE_LENGTH = 32
+EVENT_TYPE_LENGTH = 16
+EVENT_VALUE_LENGTH = 256
+
+
+class SessionArchive:
+    """
+    Read access to a session archive.
+
+    An archive is a directory holding one `.npy` file per column of each table, plus a schema
+    listing the tables and their columns. Columns are opened as read-only memory maps, so opening an
+    archive reads nothing but the schema and the array headers; data is paged in only for the rows and
+    columns that are accessed. Every table has a `timestamp` column sorted in ascending order, which is
+    used to select rows by time.
+    """
+
+    def __init__(self, archive_dir: str):
+        """
+
+        :param archive_dir:
+        """
+        self.archive_dir = archive_dir
+        with open(os.path.join(archive_dir, SCHEMA_FNAME), 'r') as schema_file:
+            self.schema = json.load(schema_file)
+        self.__column_cache = {}
+        return
+
+    def tables(self):
+        return list(self.schema['tables'].keys())
+
+    def columns(self, table_name: str):
+        return list(self.schema['tables'][table_name]['columns'].keys())
+
+    def num_rows(self, table_name: str):
+        return self.schema['tables'][table_name]['num_rows']
+
+    def column(self, table_name: str, column_name: str):
+        """
+        Gets a column as a read-only memory map.
+
+        :param table_name:
+        :param column_name:
+        :return:
+        """
+        column_key = (table_name, column_name)
+        if column_key not in self.__column_cache:
+            if column_name not in self.schema['tables'][table_name]['columns']:
+                raise KeyError(f'Unknown column of table {table_name}: {column_name}')
+            column_fname = os.path.join(self.archive_dir, column_fname_for(table_name, column_name))
+            self.__column_cache[column_key] = np.load(column_fname, mmap_mode='r')
+        return self.__column_cache[column_key]
+
+    def row_range(self, table_name: str, start_time: float = None, end_time: float = None):
+        """
+        Finds the rows of a table with a timestamp in [start_time, end_time) in O(log n).
+
+        :param table_name:
+        :param start_time: inclusive; the start of the table if None
+        :param end_time: exclusive; the end of the table if None
+        :return: (first row, last row + 1)
+        """
+        timestamps = self.column(table_name, 'timestamp')
+        start_idx = 0 if start_time is None else int(np.searchsorted(timestamps, start_time, side='left'))
+        end_idx = len(timestamps) if end_time is None else int(np.searchsorted(timestamps, end_time, side='left'))
+        return start_idx, max(start_idx, end_idx)
+
+    def read(self, table_name: str, columns: list = None, start_time: float = None, end_time: float = None):
+        """
+        Reads a time range of a subset of the columns of a table.
+
+        The returned arrays are slices of the memory maps; no data is read until they are accessed.
+
+        :param table_name:
+        :param columns: names of the columns to read; all columns if None
+        :param start_time:
+        :param end_time:
+        :return: column name -> array
+        """
+        column_list = self.columns(table_name) if columns is None else columns
+        start_idx, end_idx = self.row_range(table_name, start_time, end_time)
+        return {
+            each_column: self.column(table_name, each_column)[start_idx:end_idx]
+            for each_column in column_list
+        }
+
+    def frame_state_index(self, states_table: str = 'states', frames_table: str = 'frames'):
+        """
+        Index into the states table of the state received closest to each frame of the recording.
+
+        :param states_table:
+        :param frames_table:
+        :return: array with one state row per frame row
+        """
+        state_aligner = StateAligner.from_archive(self, states_table)
+        return state_aligner.align(self.column(frames_table, 'timestamp'))
+
+
+def column_fname_for(table_name: str, column_name: str):
+    return f'{table_name}.{column_name}.npy'
+
+
+def write_table(archive_dir: str, table_name: str, columns: dict):
+    """
+    Writes a table to an archive, replacing any existing table of the same name.
+
+    Rows are sorted by the `timestamp` column, which every table must have.
+
+    :param archive_dir:
+    :param table_name:
+    :param columns: column name -> 1-D array; all columns must have the same length
+    :return:
+    """
+    if 'timestamp' not in columns:
+        raise ValueError(f'Table {table_name} has no timestamp column')
+    num_rows_set = {len(each_values) for each_values in columns.values()}
+    if len(num_rows_set) != 1:
+        raise ValueError(f'Columns of table {table_name} have different lengths: {num_rows_set}')
+    if not os.path.isdir(archive_dir):
+        os.makedirs(archive_dir)
+
+    sort_order = np.argsort(columns['timestamp'], kind='stable')
+    column_schema = {}
+    for column_name, column_values in columns.items():
+        column_values = np.ascontiguousarray(np.asarray(column_values)[sort_order])
+        np.save(os.path.join(archive_dir, column_fname_for(table_name, column_name)), column_values)
+        column_schema[column_name] = column_values.dtype.str
+
+    schema_fname = os.path.join(archive_dir, SCHEMA_FNAME)
+    schema = {'tables': {}}
+    if os.path.isfile(schema_fname):
+        with open(schema_fname, 'r') as schema_file:
+            schema = json.load(schema_file)
+    schema['tables'][table_name] = {'num_rows': len(sort_order), 'columns': column_schema}
+    with open(schema_fname, 'w+') as schema_file:
+        json.dump(fp=schema_file, obj=schema, indent=2)
+    return
+
+
+def load_records(record_fname: str):
+    """
+    Loads the records of a session log, written either as a JSON list (.json) or as JSON Lines (.jsonl).
+
+    :param record_fname:
+    :return:
+    """
+    if record_fname.endswith('.jsonl'):
+        return list(read_session_log(record_fname))
+    with open(record_fname, 'r') as record_file:
+        return json.load(record_file)
+
+
+def __to_float(value):
+    if value is None:
+        return math.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def __to_bytes(value, max_length: int):
+    value_str = '' if value is None else str(value)
+    return value_str.encode('utf-8', errors='replace')[:max_length]
+
+
+def state_columns(state_records: list):
+    """
+    Builds the columns of the states table. Values may be numbers or, as in older sessions, strings.
+
+    :param state_records:
+    :return:
+    """
+    state_array = np.empty(len(state_records), dtype=STATE_DTYPE)
+    for each_field in STATE_DTYPE.names:
+        state_array[each_field] = [__to_float(each_record.get(each_field)) for each_record in state_records]
+    return {each_field: state_array[each_field] for each_field in STATE_DTYPE.names}
+
+
+def command_columns(command_records: list):
+    """
+    Builds the columns of the commands table.
+
+    :param command_records:
+    :return:
+    """
+    timestamps = np.array([__to_float(each_record.get('timestamp')) for each_record in command_records])
+    response_times = np.array([__to_float(each_record.get('response_time')) for each_record in command_records])
+    columns = {
+        'timestamp': timestamps,
+        'response_time': response_times,
+        'rtt': response_times - timestamps,
+        'command': np.array(
+            [__to_bytes(each_record.get('command'), COMMAND_LENGTH) for each_record in command_records],
+            dtype=f'S{COMMAND_LENGTH}'
+        ),
+        'response': np.array(
+            [__to_bytes(each_record.get('response'), RESPONSE_LENGTH) for each_record in command_records],
+            dtype=f'S{RESPONSE_LENGTH}'
+        ),
+    }
+    return columns
+
+
+def event_columns(event_records: list):
+    """
+    Builds the columns of the events table. State events are skipped, as they duplicate the states table.
+    Events logged before severities were recorded have an empty severity.
+    Event values are truncated to EVENT_VALUE_LENGTH bytes.
+
+    :param event_records:
+    :return:
+    """
+    event_records = [each_record for each_record in event_records if each_record.get('type') != 'state']
+    columns = {
+        'timestamp': np.array([__to_float(each_record.get('timestamp')) for each_record in event_records]),
+        'type': np.array(
+            [__to_bytes(each_record.get('type'), EVENT_TYPE_LENGTH) for each_record in event_records],
+            dtype=f'S{EVENT_TYPE_LENGTH}'
+        ),
+        'severity': np.array(
+            [__to_bytes(each_record.get('severity'), EVENT_TYPE_LENGTH) for each_record in event_records],
+            dtype=f'S{EVENT_TYPE_LENGTH}'
+        ),
+        'value': np.array(
+            [__to_bytes(each_record.get('value'), EVENT_VALUE_LENGTH) for each_record in event_records],
+            dtype=f'S{EVENT_VALUE_LENGTH}'
+        ),
+    }
+    return columns
+
+
+def packet_columns(capture_index):
+    """
+    Builds the columns of the packets table from the index of a raw video capture.
+
+    :param capture_index:
+    :return:
+    """
+    return {each_field: capture_index[each_field] for each_field in capture_index.dtype.names}
+
+
+def frame_columns(frame_timestamps):
+    """
+    Builds the columns of the frames table from the frame timestamp sidecar of a recording.
+
+    :param frame_timestamps:
+    :return:
+    """
+    return {each_field: frame_timestamps[each_field] for each_field in frame_timestamps.dtype.names}
+
+
+def __find_session_file(session_dir: str, prefix: str, extension_list: list):
+    for each_extension in extension_list:
+        fname_list = sorted(glob.glob(os.path.join(session_dir, f'{prefix}*{each_extension}')))
+        if len(fname_list) > 0:
+            return fname_list[0]
+    return None
+
+
+def convert_session(session_dir: str, archive_dir: str = None):
+    """
+    Converts a recorded TelloDrone session directory to a session archive.
+
+    Reads the states_*, messages_* and event_log_* files, in either the JSON list or the JSON Lines format,
+    the packet index of a raw video capture and the frame timestamp sidecar of the recording, if present.
+
+    :param session_dir:
+    :param archive_dir: defaults to an 'archive' directory inside the session directory
+    :return: path of the archive
+    """
+    if archive_dir is None:
+        archive_dir = os.path.join(session_dir, 'archive')
+
+    state_fname = __find_session_file(session_dir, 'states_', ['.jsonl', '.json'])
+    if state_fname is not None:
+        write_table(archive_dir, 'states', state_columns(load_records(state_fname)))
+
+    message_fname = __find_session_file(session_dir, 'messages_', ['.jsonl', '.json'])
+    if message_fname is not None:
+        write_table(archive_dir, 'commands', command_columns(load_records(message_fname)))
+
+    event_fname = __find_session_file(session_dir, 'event_log_', ['.jsonl', '.json'])
+    if event_fname is not None:
+        write_table(archive_dir, 'events', event_columns(load_records(event_fname)))
+
+    index_fname = __find_session_file(session_dir, '', ['.idx'])
+    if index_fname is not None:
+        write_table(archive_dir, 'packets', packet_columns(read_capture_index(index_fname)))
+
+    frame_fname = __find_session_file(session_dir, 'frames_', ['.ts'])
+    if frame_fname is not None:
+        write_table(archive_dir, 'frames', frame_columns(read_frame_timestamps(frame_fname)))
+    return archive_dir
+
+
+def main(main_args):
+    session_dir = main_args['session_dir']
+    archive_dir = main_args.get('archive_dir', None)
+    ###################################
+    archive_dir = convert_session(session_dir, archive_dir)
+    session_archive = SessionArchive(archive_dir)
+    for each_table in session_archive.tables():
+        print(f'{each_table}: {session_archive.num_rows(each_table)} rows | {session_archive.columns(each_table)}')
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a recorded TelloDrone session to a session archive.')
+    parser.add_argument('--session_dir', type=str, required=True,
+                        help='directory of the recorded session')
+    parser.add_argument('--archive_dir', type=str, default=None,
+                        help='directory to write the archive to, defaults to <session_dir>/archive')
+
+    args = parser.parse_args()
+    main(vars(args))
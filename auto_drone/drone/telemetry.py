@@ -0,0 +1,652 @@
+"""
+@title
+@description
+"""
+import math
+import threading
+
+import numpy as np
+
+# fields of the state string sent by the drone to port 8890, in the order they are sent (SDK 1.3)
+STATE_FIELDS = (
+    'pitch', 'roll', 'yaw',
+    'vgx', 'vgy', 'vgz',
+    'templ', 'temph',
+    'tof', 'h', 'bat', 'baro', 'time',
+    'agx', 'agy', 'agz',
+)
+# float64 so decimal values such as an agx of 0.3 read back as sent, and so missing fields can be held as NaN
+STATE_DTYPE = np.dtype([('timestamp', np.float64)] + [(each_field, np.float64) for each_field in STATE_FIELDS])
+FIELD_INDEX = {each_field: field_idx for field_idx, each_field in enumerate(STATE_FIELDS)}
+
+# columns of the running sums kept by TelemetryStore: sum of t and t^2 over all records, then the sum of
+# y, t*y and the number of valid (non-NaN) values of each field, where t is the time since the first record
+SUM_T = 0
+SUM_TT = 1
+SUM_Y = slice(2, 2 + len(STATE_FIELDS))
+SUM_TY = slice(2 + len(STATE_FIELDS), 2 + 2 * len(STATE_FIELDS))
+SUM_N = slice(2 + 2 * len(STATE_FIELDS), 2 + 3 * len(STATE_FIELDS))
+NUM_SUMS = 2 + 3 * len(STATE_FIELDS)
+
+
+def parse_state(state_bytes: bytes, receive_time: float):
+    """
+    Parses a raw state packet into a record matching STATE_DTYPE.
+
+    Fields missing from the packet are set to NaN. Fields not part of the SDK 1.3 schema (e.g. the
+    mission pad fields sent by the Tello EDU) are ignored.
+
+    :param state_bytes:
+    :param receive_time:
+    :return: tuple of (timestamp, *STATE_FIELDS)
+    """
+    state_str = state_bytes.decode('utf-8').strip()
+    value_dict = {}
+    for state_entry in state_str.split(';'):
+        field_name, _, field_value = state_entry.partition(':')
+        if len(field_value) > 0:
+            value_dict[field_name] = field_value
+    record = (receive_time, *(float(value_dict.get(each_field, 'nan')) for each_field in STATE_FIELDS))
+    return record
+
+
+def record_to_dict(record):
+    """
+    Converts a state record to a JSON-serializable dictionary. NaN values are converted to None.
+
+    :param record:
+    :return:
+    """
+    record_dict = {}
+    for each_field in STATE_DTYPE.names:
+        each_value = float(record[each_field])
+        record_dict[each_field] = None if math.isnan(each_value) else each_value
+    return record_dict
+
+
+class TelloState:
+    """
+    Immutable snapshot of a single state record.
+
+    The fields of the record are converted to Python floats once, when the snapshot is built, and read as
+    attributes, e.g. `state.bat`. Derived quantities are computed the first time they are read and cached
+    on the snapshot, so reading them again costs an attribute lookup.
+    """
+
+    __slots__ = ('timestamp', *STATE_FIELDS, '_speed', '_acceleration', '_temp_range', '_attitude_radians')
+
+    def __init__(self, record):
+        """
+
+        :param record: record matching STATE_DTYPE, or a tuple of (timestamp, *STATE_FIELDS)
+        """
+        if isinstance(record, tuple):
+            value_list = record
+        else:
+            value_list = [record[each_field] for each_field in STATE_DTYPE.names]
+        for each_field, each_value in zip(STATE_DTYPE.names, value_list):
+            object.__setattr__(self, each_field, float(each_value))
+        for each_cache in ('_speed', '_acceleration', '_temp_range', '_attitude_radians'):
+            object.__setattr__(self, each_cache, None)
+        return
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'TelloState is immutable: {name}')
+
+    def __repr__(self):
+        return f'TelloState(timestamp={self.timestamp}, h={self.h}, bat={self.bat})'
+
+    @property
+    def speed(self):
+        """
+        Magnitude of the velocity.
+
+        :return:
+        """
+        if self._speed is None:
+            object.__setattr__(self, '_speed', math.sqrt(self.vgx ** 2 + self.vgy ** 2 + self.vgz ** 2))
+        return self._speed
+
+    @property
+    def acceleration(self):
+        """
+        Magnitude of the acceleration.
+
+        :return:
+        """
+        if self._acceleration is None:
+            object.__setattr__(self, '_acceleration', math.sqrt(self.agx ** 2 + self.agy ** 2 + self.agz ** 2))
+        return self._acceleration
+
+    @property
+    def temp_range(self):
+        if self._temp_range is None:
+            object.__setattr__(self, '_temp_range', self.temph - self.templ)
+        return self._temp_range
+
+    @property
+    def attitude_radians(self):
+        """
+        Pitch, roll and yaw in radians.
+
+        :return:
+        """
+        if self._attitude_radians is None:
+            object.__setattr__(
+                self, '_attitude_radians', (math.radians(self.pitch), math.radians(self.roll), math.radians(self.yaw))
+            )
+        return self._attitude_radians
+
+    def to_dict(self):
+        """
+        Converts the snapshot to a JSON-serializable dictionary. NaN values are converted to None.
+
+        :return:
+        """
+        record_dict = {}
+        for each_field in STATE_DTYPE.names:
+            each_value = getattr(self, each_field)
+            record_dict[each_field] = None if math.isnan(each_value) else each_value
+        return record_dict
+
+
+class TelemetryWindow:
+    """
+    Aggregates over a contiguous range of the records of a TelemetryStore.
+
+    Sums, means and least-squares slopes are computed in O(1) from the running sums kept by the store,
+    whatever the length of the window. Min, max and derivatives are computed with NumPy over a view of
+    the window, without copying it. Fields containing NaN values within the window fall back to
+    NaN-aware NumPy reductions over the view. Times are in seconds, so slopes are per second.
+    """
+
+    def __init__(self, data, prefix_sums, base_time: float, start_idx: int, end_idx: int):
+        """
+
+        :param data: records of the store
+        :param prefix_sums: running sums of the store, where row i holds the sums over the first i records
+        :param base_time: timestamp of the first record of the store
+        :param start_idx: index of the first record in the window
+        :param end_idx: index one past the last record in the window
+        """
+        self.data = data
+        self.prefix_sums = prefix_sums
+        self.base_time = base_time
+        self.start_idx = start_idx
+        self.end_idx = end_idx
+        return
+
+    def __len__(self):
+        return self.end_idx - self.start_idx
+
+    @property
+    def start_time(self):
+        return float(self.data['timestamp'][self.start_idx]) if len(self) > 0 else None
+
+    @property
+    def end_time(self):
+        return float(self.data['timestamp'][self.end_idx - 1]) if len(self) > 0 else None
+
+    @property
+    def duration(self):
+        return self.end_time - self.start_time if len(self) > 0 else 0.0
+
+    def column(self, field_name: str):
+        """
+        Gets a view of a single field across the records of the window.
+
+        :param field_name:
+        :return:
+        """
+        return self.data[field_name][self.start_idx:self.end_idx]
+
+    def __sums(self):
+        return self.prefix_sums[self.end_idx] - self.prefix_sums[self.start_idx]
+
+    def __has_nan(self, window_sums, field_idx: int):
+        return window_sums[SUM_N][field_idx] < len(self)
+
+    def count(self, field_name: str):
+        """
+        Number of valid (non-NaN) values of a field in the window.
+
+        :param field_name:
+        :return:
+        """
+        if len(self) == 0:
+            return 0
+        return int(self.__sums()[SUM_N][FIELD_INDEX[field_name]])
+
+    def mean(self, field_name: str):
+        """
+
+        :param field_name:
+        :return: mean of the valid values of the field, or None if there are none
+        """
+        if len(self) == 0:
+            return None
+        window_sums = self.__sums()
+        field_idx = FIELD_INDEX[field_name]
+        num_valid = window_sums[SUM_N][field_idx]
+        return float(window_sums[SUM_Y][field_idx] / num_valid) if num_valid > 0 else None
+
+    def min(self, field_name: str):
+        if self.count(field_name) == 0:
+            return None
+        return float(np.nanmin(self.column(field_name)))
+
+    def max(self, field_name: str):
+        if self.count(field_name) == 0:
+            return None
+        return float(np.nanmax(self.column(field_name)))
+
+    def slope(self, field_name: str):
+        """
+        Least-squares rate of change of a field over the window, in units per second, e.g. the battery drain
+        rate as `window.slope('bat')`.
+
+        :param field_name:
+        :return: the slope, or None if the window holds fewer than two valid values spread over time
+        """
+        if len(self) < 2:
+            return None
+        window_sums = self.__sums()
+        field_idx = FIELD_INDEX[field_name]
+        if self.__has_nan(window_sums, field_idx):
+            return self.__slope_nan(field_name)
+        num_records = len(self)
+        sum_t = window_sums[SUM_T]
+        sum_y = window_sums[SUM_Y][field_idx]
+        denominator = num_records * window_sums[SUM_TT] - sum_t * sum_t
+        if denominator <= 0:
+            return None
+        return float((num_records * window_sums[SUM_TY][field_idx] - sum_t * sum_y) / denominator)
+
+    def __slope_nan(self, field_name: str):
+        field_values = self.column(field_name).astype(np.float64)
+        valid_mask = ~np.isnan(field_values)
+        if np.count_nonzero(valid_mask) < 2:
+            return None
+        time_values = self.column('timestamp')[valid_mask] - self.base_time
+        field_values = field_values[valid_mask]
+        time_centered = time_values - time_values.mean()
+        denominator = np.dot(time_centered, time_centered)
+        if denominator <= 0:
+            return None
+        return float(np.dot(time_centered, field_values - field_values.mean()) / denominator)
+
+    def derivative(self, field_name: str):
+        """
+        Estimate of the rate of change of a field at the most recent record of the window, using finite
+        differences over the window (second order accurate in the interior, first order at the end).
+
+        :param field_name:
+        :return: the derivative in units per second, or None if the window holds fewer than two valid values
+        """
+        if len(self) < 2:
+            return None
+        time_values = self.column('timestamp')
+        field_values = self.column(field_name).astype(np.float64)
+        if self.count(field_name) < len(self):
+            valid_mask = ~np.isnan(field_values)
+            time_values = time_values[valid_mask]
+            field_values = field_values[valid_mask]
+        if len(time_values) < 2 or time_values[-1] <= time_values[0]:
+            return None
+        edge_order = 2 if len(time_values) > 2 else 1
+        return float(np.gradient(field_values, time_values, edge_order=edge_order)[-1])
+
+    def summary(self, field_list: list = None):
+        """
+
+        :param field_list: fields to summarize; every state field if None
+        :return: field -> dictionary of count, mean, min, max and slope
+        """
+        field_list = field_list if field_list is not None else STATE_FIELDS
+        summary = {
+            each_field: {
+                'count': self.count(each_field),
+                'mean': self.mean(each_field),
+                'min': self.min(each_field),
+                'max': self.max(each_field),
+                'slope': self.slope(each_field)
+            }
+            for each_field in field_list
+        }
+        return summary
+
+
+class TelemetryStore:
+    """
+    Growable columnar store of state records.
+
+    Records are held in a single structured array whose capacity doubles as it fills, so appends
+    are amortized O(1) and each field can be read as a contiguous NumPy column without a Python loop.
+
+    Alongside the records, running sums of the time, the values and their products are kept for every
+    record, so the mean and least-squares slope of a field over any window of records is the difference
+    of two rows (see TelemetryWindow).
+    """
+
+    def __init__(self, initial_capacity: int = 1024):
+        """
+
+        :param initial_capacity:
+        """
+        self.data = np.empty(max(initial_capacity, 1), dtype=STATE_DTYPE)
+        self.prefix_sums = np.zeros((len(self.data) + 1, NUM_SUMS), dtype=np.float64)
+        self.base_time = None
+        self.size = 0
+        self.store_lock = threading.Lock()
+        self.last_snapshot = None
+        return
+
+    def __len__(self):
+        return self.size
+
+    def append(self, record):
+        """
+
+        :param record: tuple of (timestamp, *STATE_FIELDS)
+        :return:
+        """
+        with self.store_lock:
+            if self.size == len(self.data):
+                grown_data = np.empty(len(self.data) * 2, dtype=STATE_DTYPE)
+                grown_data[:self.size] = self.data
+                self.data = grown_data
+                grown_sums = np.zeros((len(grown_data) + 1, NUM_SUMS), dtype=np.float64)
+                grown_sums[:self.size + 1] = self.prefix_sums[:self.size + 1]
+                self.prefix_sums = grown_sums
+            self.data[self.size] = record
+            self.__add_sums(self.data[self.size])
+            self.size += 1
+        return
+
+    def __add_sums(self, record):
+        """
+        Computes the running sums up to and including a record from the sums of the records before it.
+
+        :param record:
+        :return:
+        """
+        if self.base_time is None:
+            self.base_time = float(record['timestamp'])
+        relative_time = float(record['timestamp']) - self.base_time
+        field_values = np.array(record.item()[1:], dtype=np.float64)
+        valid_mask = ~np.isnan(field_values)
+        field_values[~valid_mask] = 0
+
+        record_sums = np.empty(NUM_SUMS, dtype=np.float64)
+        record_sums[SUM_T] = relative_time
+        record_sums[SUM_TT] = relative_time * relative_time
+        record_sums[SUM_Y] = field_values
+        record_sums[SUM_TY] = relative_time * field_values
+        record_sums[SUM_N] = valid_mask
+        np.add(self.prefix_sums[self.size], record_sums, out=self.prefix_sums[self.size + 1])
+        return
+
+    def last(self):
+        """
+        Gets the most recent record, or None if the store is empty. Fields are read by name, e.g.
+        `store.last()['bat']`.
+
+        :return:
+        """
+        with self.store_lock:
+            return self.data[self.size - 1] if self.size > 0 else None
+
+    def snapshot(self):
+        """
+        Gets a TelloState of the most recent record, or None if the store is empty.
+
+        A snapshot is only built for a record the first time it is asked for; every later call returns the
+        same snapshot until a newer record is appended.
+
+        :return:
+        """
+        with self.store_lock:
+            if self.size == 0:
+                return None
+            last_snapshot = self.last_snapshot
+            if last_snapshot is None or last_snapshot[0] != self.size:
+                last_snapshot = (self.size, TelloState(self.data[self.size - 1]))
+                self.last_snapshot = last_snapshot
+        return last_snapshot[1]
+
+    def window(self, seconds: float = None, count: int = None, end_time: float = None):
+        """
+        Gets the records received in the last `seconds`, or the last `count` records, up to `end_time`.
+
+        Records are appended in the order they were received, so the bounds of a time window are found
+        by binary search over the timestamps.
+
+        :param seconds: length of the window in seconds
+        :param count: number of records in the window; used if `seconds` is None
+        :param end_time: time the window ends at; the most recent record if None
+        :return: TelemetryWindow
+        """
+        with self.store_lock:
+            data = self.data
+            prefix_sums = self.prefix_sums
+            base_time = self.base_time
+            size = self.size
+        time_values = data['timestamp'][:size]
+        end_idx = size if end_time is None else int(np.searchsorted(time_values, end_time, side='right'))
+        if seconds is not None:
+            window_end = end_time if end_time is not None else (float(time_values[-1]) if size > 0 else 0)
+            start_idx = int(np.searchsorted(time_values[:end_idx], window_end - seconds, side='left'))
+        elif count is not None:
+            start_idx = max(end_idx - count, 0)
+        else:
+            start_idx = 0
+        return TelemetryWindow(data, prefix_sums, base_time, start_idx, end_idx)
+
+    def records(self):
+        """
+        Gets a view of all records stored so far.
+
+        :return:
+        """
+        with self.store_lock:
+            return self.data[:self.size]
+
+    def column(self, field_name: str):
+        """
+        Gets a view of a single field across all records stored so far.
+
+        :param field_name: 'timestamp' or one of STATE_FIELDS
+        :return:
+        """
+        return self.records()[field_name]
+
+    def to_dicts(self):
+        """
+
+        :return:
+        """
+        return [record_to_dict(each_record) for each_record in self.records()]
+
+
+class TelemetryGetters:
+    """
+    Read accessors of the drone telemetry, shared by every object that exposes the TelloDrone interface.
+
+    Subclasses provide `sdk_mode` and `get_snapshot()`, which returns a TelloState of the latest state
+    record. Every getter reads a single snapshot, so the values it returns all come from the same packet;
+    a caller that needs several values from the same packet should read them from one `get_snapshot()`.
+    """
+
+    def get_speed(self):
+        """
+        speed?
+
+        get current speed (cm/s)
+
+        x: 1-100
+
+        :return:
+        """
+        if not self.sdk_mode:
+            return None
+        last_state = self.get_snapshot()
+        if last_state is None:
+            return None
+
+        value = {
+            'vgx': last_state.vgx,
+            'vgy': last_state.vgy,
+            'vgz': last_state.vgz,
+            'total': last_state.speed
+        }
+        return value
+
+    def get_battery(self):
+        """
+        battery?
+
+        get current battery percentage
+
+        x: 0-100
+
+        :return:
+        """
+        if not self.sdk_mode:
+            return None
+        last_state = self.get_snapshot()
+        value = last_state.bat if last_state is not None else None
+        return value
+
+    def get_time(self):
+        """
+        time?
+
+        get current fly time (s)
+
+        time
+        :return:
+        """
+        if not self.sdk_mode:
+            return None
+        last_state = self.get_snapshot()
+        value = last_state.time if last_state is not None else None
+        return value
+
+    def get_height(self):
+        """
+
+        height?
+
+        get height (cm)
+
+        x: 0-3000
+
+        :return:
+        """
+        if not self.sdk_mode:
+            return None
+        last_state = self.get_snapshot()
+        value = last_state.h if last_state is not None else None
+        return value
+
+    def get_temp(self):
+        """
+        temp?
+
+        get temperature (C)
+
+        x: 0-90
+
+        :return:
+        """
+        if not self.sdk_mode:
+            return None
+        last_state = self.get_snapshot()
+        if last_state is None:
+            return None
+
+        value = {
+            'templ': last_state.templ,
+            'temph': last_state.temph,
+            'range': last_state.temp_range
+        }
+        return value
+
+    def get_attitude(self):
+        """
+        attitude?
+
+        get IMU attitude data
+
+        pitch roll yaw
+
+        :return:
+        """
+        if not self.sdk_mode:
+            return None
+        last_state = self.get_snapshot()
+        if last_state is None:
+            return None
+
+        value = {
+            'pitch': last_state.pitch,
+            'roll': last_state.roll,
+            'yaw': last_state.yaw
+        }
+        return value
+
+    def get_baro(self):
+        """
+        baro?
+
+        get barometer value (m)
+
+        x
+
+        :return:
+        """
+        if not self.sdk_mode:
+            return None
+        last_state = self.get_snapshot()
+        value = last_state.baro if last_state is not None else None
+        return value
+
+    def get_acceleration(self):
+        """
+        acceleration?
+
+        get IMU angular acceleration data (0.001g)
+
+        x y z
+
+        :return:
+        """
+        if not self.sdk_mode:
+            return None
+        last_state = self.get_snapshot()
+        if last_state is None:
+            return None
+
+        value = {
+            'agx': last_state.agx,
+            'agy': last_state.agy,
+            'agz': last_state.agz,
+            'total': last_state.acceleration
+        }
+        return value
+
+    def get_tof(self):
+        """
+        tof?
+
+        get distance value from point of takeoff (cm)
+
+        x: 30-1000
+
+        :return:
+        """
+        if not self.sdk_mode:
+            return None
+        last_state = self.get_snapshot()
+        value = last_state.tof if last_state is not None else None
+        return value
@@ -0,0 +1,338 @@
+"""
+@title
+@description
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+
+from auto_drone import DATA_DIR, version
+from auto_drone.drone.rc_scheduler import RcScheduler
+from auto_drone.drone.tello_drone import TelloDrone
+from auto_drone.drone.tello_simulator import TelloSimulator
+
+
+def current_rss():
+    """
+    Resident set size of the current process in bytes, or None if it cannot be read on this platform.
+
+    :return:
+    """
+    try:
+        with open('/proc/self/statm', 'r') as statm_file:
+            resident_pages = int(statm_file.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # reported in bytes on macOS and kilobytes elsewhere
+        return max_rss if sys.platform == 'darwin' else max_rss * 1024
+    except ImportError:
+        return None
+
+
+def benchmark_command_rtt(tello_drone: TelloDrone, num_commands: int):
+    """
+    Round-trip time of acknowledged commands, sent one at a time.
+
+    :param tello_drone:
+    :param num_commands:
+    :return:
+    """
+    rtt_list = []
+    num_timeouts = 0
+    for _ in range(num_commands):
+        send_info = tello_drone.control_command()
+        if send_info['rtt'] is None:
+            num_timeouts += 1
+        else:
+            rtt_list.append(send_info['rtt'])
+    rtt_array = np.array(rtt_list)
+    results = {
+        'num_commands': num_commands,
+        'num_timeouts': num_timeouts,
+        'rtt_mean': float(rtt_array.mean()) if len(rtt_array) > 0 else None,
+    }
+    for each_q in (50, 90, 95, 99, 100):
+        results[f'rtt_p{each_q}'] = float(np.percentile(rtt_array, each_q)) if len(rtt_array) > 0 else None
+    return results
+
+
+def benchmark_rc_rate(tello_drone: TelloDrone, simulator: TelloSimulator, rate_list: list, duration: float,
+                      tolerance: float = 0.95):
+    """
+    Streams rc commands at each of the given rates and counts how many reach the simulator.
+
+    A rate is sustained if the rate of rc commands received is at least `tolerance` of the target rate.
+    The rc stream of the drone itself keeps running during the benchmark and is subtracted out.
+
+    :param tello_drone:
+    :param simulator:
+    :param rate_list:
+    :param duration: seconds to stream at each rate
+    :param tolerance:
+    :return:
+    """
+    rate_results = []
+    max_sustained = 0
+    for each_rate in rate_list:
+        rc_scheduler = RcScheduler(tello_drone.command_transport, rate=each_rate)
+        received_before = simulator.num_rc
+        drone_sent_before = tello_drone.rc_scheduler.num_sent
+        rc_scheduler.start()
+        for update_idx in range(int(duration * each_rate * 2)):
+            rc_scheduler.update(update_idx % 10, 0, 0, 0)
+            time.sleep(1 / (each_rate * 2))
+        rc_scheduler.stop()
+        # allow the last packets to arrive
+        time.sleep(0.1)
+
+        drone_sent = tello_drone.rc_scheduler.num_sent - drone_sent_before
+        received = simulator.num_rc - received_before - drone_sent
+        scheduler_stats = rc_scheduler.get_stats()
+        received_rate = received / duration
+        sustained = received_rate >= tolerance * each_rate
+        if sustained:
+            max_sustained = max(max_sustained, each_rate)
+        rate_results.append({
+            'target_rate': each_rate,
+            'num_sent': scheduler_stats['num_sent'],
+            'num_received': received,
+            'received_rate': received_rate,
+            'num_missed': scheduler_stats['num_missed'],
+            'num_coalesced': scheduler_stats['num_coalesced'],
+            'jitter': scheduler_stats['jitter'],
+            'lateness_p99': scheduler_stats['lateness']['p99'],
+            'sustained': sustained
+        })
+    return {'rates': rate_results, 'max_sustained_rate': max_sustained}
+
+
+def benchmark_state_rate(tello_drone: TelloDrone, simulator: TelloSimulator, state_address: tuple,
+                         rate_list: list, duration: float):
+    """
+    Sends state packets to the drone state listener at each of the given rates and measures how many
+    are processed.
+
+    :param tello_drone:
+    :param simulator: used only to format state packets
+    :param state_address: address the drone state listener is bound to
+    :param rate_list:
+    :param duration: seconds to send at each rate
+    :return:
+    """
+    send_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    state_bytes = simulator.state_string().encode('utf-8')
+    rate_results = []
+    for each_rate in rate_list:
+        # the regular state stream keeps running and is subtracted out
+        processed_before = tello_drone.num_state_packets
+        simulator_before = simulator.num_states
+        period = 1 / each_rate
+        num_sent = 0
+        start_time = time.perf_counter()
+        next_send = start_time
+        while time.perf_counter() - start_time < duration:
+            sleep_time = next_send - time.perf_counter()
+            if sleep_time > 0:
+                time.sleep(sleep_time)
+            send_socket.sendto(state_bytes, state_address)
+            num_sent += 1
+            next_send += period
+        elapsed = time.perf_counter() - start_time
+        time.sleep(0.2)
+
+        simulator_sent = simulator.num_states - simulator_before
+        processed = tello_drone.num_state_packets - processed_before - simulator_sent
+        rate_results.append({
+            'target_rate': each_rate,
+            'num_sent': num_sent,
+            'send_rate': num_sent / elapsed,
+            'num_processed': processed,
+            'processed_rate': processed / elapsed,
+            'num_lost': max(num_sent - processed, 0)
+        })
+    send_socket.close()
+    state_stats = tello_drone.get_state_stats()
+    return {'rates': rate_results, 'backlog': state_stats['backlog'], 'jitter': state_stats['jitter']}
+
+
+def benchmark_video(tello_drone: TelloDrone, duration: float):
+    """
+    Decode and record throughput over the given duration.
+
+    :param tello_drone:
+    :param duration:
+    :return:
+    """
+    decode_before = tello_drone.decode_stats.num_processed
+    record_before = tello_drone.record_stats.num_processed
+    time.sleep(duration)
+    video_stats = tello_drone.get_video_stats()
+    relay_stats = tello_drone.video_relay.get_stats() if tello_drone.video_relay is not None else None
+    results = {
+        'decode_fps': (tello_drone.decode_stats.num_processed - decode_before) / duration,
+        'record_fps': (tello_drone.record_stats.num_processed - record_before) / duration,
+        'decode_latency_p95': video_stats['decode']['latency']['p95'],
+        'record_latency_p95': video_stats['record']['latency']['p95'],
+        'record_dropped': video_stats['record']['num_dropped'],
+        'relay_packet_rate': relay_stats['packet_rate'] if relay_stats is not None else None,
+    }
+    return results
+
+
+def benchmark_memory(tello_drone: TelloDrone, duration: float, sample_interval: float):
+    """
+    Samples Python heap usage and resident set size while the drone runs, and fits a line to estimate
+    the growth rate.
+
+    :param tello_drone:
+    :param duration:
+    :param sample_interval:
+    :return:
+    """
+    tracemalloc.start()
+    sample_list = []
+    start_time = time.perf_counter()
+    while time.perf_counter() - start_time < duration:
+        traced_current, traced_peak = tracemalloc.get_traced_memory()
+        sample_list.append({
+            'elapsed': time.perf_counter() - start_time,
+            'traced': traced_current,
+            'traced_peak': traced_peak,
+            'rss': current_rss(),
+            'num_states': len(tello_drone.telemetry)
+        })
+        time.sleep(sample_interval)
+    tracemalloc.stop()
+
+    elapsed_array = np.array([each_sample['elapsed'] for each_sample in sample_list])
+    results = {'samples': sample_list, 'traced_growth_rate': None, 'rss_growth_rate': None}
+    if len(sample_list) > 1:
+        traced_array = np.array([each_sample['traced'] for each_sample in sample_list], dtype=np.float64)
+        results['traced_growth_rate'] = float(np.polyfit(elapsed_array, traced_array, 1)[0])
+        if all(each_sample['rss'] is not None for each_sample in sample_list):
+            rss_array = np.array([each_sample['rss'] for each_sample in sample_list], dtype=np.float64)
+            results['rss_growth_rate'] = float(np.polyfit(elapsed_array, rss_array, 1)[0])
+    return results
+
+
+def run_benchmarks(main_args):
+    """
+    Runs every benchmark against a TelloSimulator on the loopback interface.
+
+    :param main_args:
+    :return:
+    """
+    host = '127.0.0.1'
+    command_port = main_args.get('command_port', 18889)
+    state_port = command_port + 1
+    video_port = command_port + 2
+    relay_port = command_port + 3
+    ###################################
+    simulator = TelloSimulator(
+        host=host, command_port=command_port, state_port=state_port, video_port=video_port,
+        video_fname=main_args.get('video', None)
+    )
+    simulator.start()
+    tello_drone = TelloDrone(
+        host=host, command_port=command_port, local_host=host, local_command_port=0,
+        state_port=state_port, video_port=video_port, video_relay_port=relay_port,
+        record_mode=main_args.get('record_mode', TelloDrone.RECORD_RAW)
+    )
+    if not tello_drone.connect():
+        raise RuntimeError(f'Could not connect to the simulator on {host}:{command_port}')
+    ###################################
+    results = {
+        'version': version,
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {key: value for key, value in main_args.items()},
+    }
+    results['command_rtt'] = benchmark_command_rtt(tello_drone, main_args.get('num_commands', 200))
+    results['rc_rate'] = benchmark_rc_rate(
+        tello_drone, simulator, main_args.get('rc_rates', [20, 50, 100, 200, 500, 1000]),
+        main_args.get('rate_duration', 2)
+    )
+    results['state_rate'] = benchmark_state_rate(
+        tello_drone, simulator, (host, state_port), main_args.get('state_rates', [10, 100, 1000, 5000]),
+        main_args.get('rate_duration', 2)
+    )
+    if main_args.get('video', None) is not None:
+        results['video'] = benchmark_video(tello_drone, main_args.get('video_duration', 10))
+    else:
+        results['video'] = None
+    results['memory'] = benchmark_memory(
+        tello_drone, main_args.get('memory_duration', 30), main_args.get('memory_interval', 1)
+    )
+    ###################################
+    cleanup_thread = threading.Thread(target=tello_drone.cleanup, daemon=True)
+    cleanup_thread.start()
+    cleanup_thread.join(timeout=10)
+    simulator.stop()
+    return results
+
+
+def main(main_args):
+    output_dir = main_args.get('output_dir', os.path.join(DATA_DIR, 'benchmarks'))
+    ###################################
+    results = run_benchmarks(main_args)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    time_str = datetime.fromtimestamp(results['timestamp']).strftime("%Y-%m-%d-%H-%M-%S")
+    output_fname = os.path.join(output_dir, f'benchmark_{version}_{time_str}.json')
+    with open(output_fname, 'w+') as save_file:
+        json.dump(fp=save_file, obj=results, indent=2)
+
+    print(f'Command RTT p50/p99:    {results["command_rtt"]["rtt_p50"]} / {results["command_rtt"]["rtt_p99"]}')
+    print(f'Max sustained rc rate:  {results["rc_rate"]["max_sustained_rate"]}')
+    for each_rate in results['state_rate']['rates']:
+        print(f'State rate {each_rate["target_rate"]}: processed {each_rate["processed_rate"]:0.1f}/s')
+    if results['video'] is not None:
+        print(f'Decode/record fps:      {results["video"]["decode_fps"]} / {results["video"]["record_fps"]}')
+    print(f'Heap growth rate:       {results["memory"]["traced_growth_rate"]} B/s')
+    print(f'RSS growth rate:        {results["memory"]["rss_growth_rate"]} B/s')
+    print(f'Results written to {output_fname}')
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the TelloDrone I/O paths against a local simulator.')
+    parser.add_argument('--command_port', type=int, default=18889,
+                        help='simulator command port; the next three ports are used for state, video and relay')
+    parser.add_argument('--video', type=str, default=None,
+                        help='H.264 elementary stream for the simulator to send; video is not benchmarked if None')
+    parser.add_argument('--record_mode', type=str, default=TelloDrone.RECORD_RAW,
+                        choices=[TelloDrone.RECORD_RAW, TelloDrone.RECORD_DECODED, TelloDrone.RECORD_NONE],
+                        help='recording mode of the drone')
+    parser.add_argument('--num_commands', type=int, default=200,
+                        help='commands sent to measure round-trip time')
+    parser.add_argument('--rc_rates', type=int, nargs='+', default=[20, 50, 100, 200, 500, 1000],
+                        help='rc rates to attempt, in commands per second')
+    parser.add_argument('--state_rates', type=int, nargs='+', default=[10, 100, 1000, 5000],
+                        help='state packet rates to attempt, in packets per second')
+    parser.add_argument('--rate_duration', type=float, default=2,
+                        help='seconds to run each rate for')
+    parser.add_argument('--video_duration', type=float, default=10,
+                        help='seconds to measure video throughput for')
+    parser.add_argument('--memory_duration', type=float, default=30,
+                        help='seconds to sample memory usage for')
+    parser.add_argument('--memory_interval', type=float, default=1,
+                        help='seconds between memory samples')
+    parser.add_argument('--output_dir', type=str, default=os.path.join(DATA_DIR, 'benchmarks'),
+                        help='directory the results are written to')
+
+    args = parser.parse_args()
+    main(vars(args))
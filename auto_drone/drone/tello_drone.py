@@ -3,18 +3,38 @@
 @description
 """
 import json
-import math
 import os
 import queue
+import select
 import socket
+import struct
+import sys
 import threading
 import time
+from collections import deque
 from datetime import datetime
 from enum import Enum
 
 import cv2
 
 from auto_drone import DATA_DIR
+from auto_drone.drone.command_transport import CommandTransport
+from auto_drone.drone.frame_alignment import FrameTimestampWriter, StateAligner, estimate_fps
+from auto_drone.drone.frame_buffer import FrameBuffer
+from auto_drone.drone.h264_relay import H264Relay
+from auto_drone.drone.rc_scheduler import RcScheduler
+from auto_drone.drone.telemetry import TelemetryGetters, TelemetryStore, parse_state, record_to_dict
+from auto_drone.drone.video_watchdog import VideoWatchdog
+from auto_drone.event_bus import EventBus, Severity
+from auto_drone.frame_bus import FrameBus
+from auto_drone.frame_views import FrameView, FrameViewStats
+from auto_drone.latency_trace import LatencyTracer
+from auto_drone.running_stats import RunningStats, StageStats
+from auto_drone.session_log import SessionWriter
+
+
+# not exposed by the socket module; the value is that of Linux, where the option is supported
+SO_TIMESTAMP = getattr(socket, 'SO_TIMESTAMP', 29 if sys.platform.startswith('linux') else None)
 
 
 class FlipDirection(Enum):
@@ -27,31 +47,67 @@ class FlipDirection(Enum):
     BACK = 'b'
 
 
-class TelloDrone:
-    # todo more clearly define the function of NETWORK_SCAN_DELAY and SEND_DELAY
+class TelloDrone(TelemetryGetters):
+    # todo more clearly define the function of NETWORK_SCAN_DELAY
     # Network constants
     BASE_SSID = 'TELLO-'
     NETWORK_SCAN_DELAY = 0.5
 
+    # session log constants
+    EVENT_LOG_DEPTH = 1000
+    # only one in this many state events is logged; every state is still written to the states log
+    STATE_EVENT_SAMPLE = 10
+    MESSAGE_HISTORY_DEPTH = 1000
+
     # Send/receive commands socket
     CLIENT_HOST = '192.168.10.1'
     CLIENT_PORT = 8889
+    # fixed delay between consecutive commands, the baseline adaptive pacing is measured against
     SEND_DELAY = 0.1
+    RESPONSE_TIMEOUT = 4
+    # per the SDK, rc commands are not acknowledged by the drone
+    RC_EXPECTS_RESPONSE = False
+    RC_RATE = 20
 
     # receive constants
     BUFFER_SIZE = 1024
+    # room for the ancillary data carrying the kernel receive timestamp of a packet
+    TIMESTAMP_BUFFER_SIZE = socket.CMSG_SPACE(struct.calcsize('ll')) if hasattr(socket, 'CMSG_SPACE') else 0
     ANY_HOST = '0.0.0.0'
 
     # state stream constants
     STATE_PORT = 8890
-    STATE_DELAY = 0.1
+    STATE_TIMEOUT = 0.5
     NUM_BASELINE_VALS = 10
 
     # video stream constants
-    VIDEO_UDP_URL = f'udp://0.0.0.0:11111'
+    VIDEO_PORT = 11111
+    LOOPBACK_HOST = '127.0.0.1'
+    VIDEO_RELAY_PORT = 11112
     FRAME_DELAY = 1
-
-    def __init__(self):
+    # seconds the decoder waits for the stream to open, and for each frame, before giving up
+    VIDEO_OPEN_TIMEOUT = 5
+    VIDEO_READ_TIMEOUT = 1
+    # two seconds of video at 30 fps, about 124 MB of 960x720 BGR frames
+    FRAME_BUFFER_DEPTH = 60
+    RECORD_FPS = 30
+    # frames used to estimate the frame rate of the decoded recording before it is opened
+    RECORD_FPS_FRAMES = 30
+    RECORD_QUEUE_SIZE = 64
+    RECORD_TIMEOUT = 0.5
+    # when the record queue is full, either discard the oldest queued frame or the frame being queued
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+    # record the raw H.264 stream as received, re-encode decoded frames to MJPG, or record nothing
+    RECORD_RAW = 'raw'
+    RECORD_DECODED = 'decoded'
+    RECORD_NONE = 'none'
+
+    def __init__(self, frame_buffer_depth: int = FRAME_BUFFER_DEPTH, rc_rate: float = RC_RATE,
+                 record_drop_policy: str = DROP_OLDEST, record_mode: str = RECORD_RAW,
+                 host: str = CLIENT_HOST, command_port: int = CLIENT_PORT, local_host: str = ANY_HOST,
+                 local_command_port: int = CLIENT_PORT, state_port: int = STATE_PORT, video_port: int = VIDEO_PORT,
+                 video_relay_port: int = VIDEO_RELAY_PORT, output_list: list = None):
         """
         The Tello SDK connects to the aircraft through a Wi-Fi UDP port, allowing users to control the
         drone with text commands
@@ -87,6 +143,43 @@ class TelloDrone:
                 Returns 'error' or an informational result code if the command failed
             Read
                 Returns the current value of the sub-parameter
+
+        Decoded video frames are held in a fixed-capacity ring buffer of `frame_buffer_depth` frames. At
+        960x720 BGR, each frame is roughly 2 MB, so the default depth retains about 2 seconds of video. If
+        the frame dimensions change mid-session, the buffer is reallocated and the frames it held dropped.
+
+        rc setpoints are not sent as they are set, but streamed to the drone at a fixed `rc_rate` by an
+        RcScheduler once SDK mode is enabled. The stream also keeps the drone from auto-landing.
+
+        Video is handled by two pipeline stages on separate threads: the decode stage reads frames from
+        the stream into the frame buffer, and the record stage encodes them to disk. The stages are
+        connected by a bounded queue, so a slow encoder drops frames from the recording according to
+        `record_drop_policy` rather than stalling decoding.
+
+        In the default RECORD_RAW mode, the stream is not re-encoded at all: an H264Relay writes the packets
+        to disk as they are received, along with a packet index, and forwards them to a loopback port
+        that the decode stage reads from. The capture can be converted afterwards using
+        auto_drone.drone.h264_relay. RECORD_DECODED re-encodes the decoded frames to an MJPG video.
+        In both modes, the receive time of every frame of the recording is written to a frame timestamp
+        sidecar, which auto_drone.drone.frame_alignment uses to align frames with states. For a raw
+        capture, the relay writes an entry for every access unit it records, as it is received, so the
+        sidecar matches the capture even where frames were lost to the decoder.
+
+        :param frame_buffer_depth: number of decoded frames retained before the oldest is overwritten
+        :param rc_rate: rc commands sent per second
+        :param record_drop_policy: DROP_OLDEST or DROP_NEWEST
+        :param record_mode: RECORD_RAW, RECORD_DECODED or RECORD_NONE
+        :param host: address of the drone, or of a simulator standing in for it
+        :param command_port: port the drone receives commands on
+        :param local_host: local interface the command, state and video sockets are bound to
+        :param local_command_port: local port commands are sent from and replies received on; 0 for any free port
+        :param state_port: local port the drone sends the state stream to
+        :param video_port: local port the drone sends the video stream to
+        :param video_relay_port: loopback port the raw video relay forwards the stream to for decoding
+        :param output_list: objects with an add_frame method that receive each decoded frame, as a FrameView
+            shared by all of them, along with the id of the latency trace started for the frame. Frames are
+            also published on the FRAMES topic of `frame_bus`, and state snapshots on its TELEMETRY topic,
+            where each subscriber chooses how it is delivered to when it falls behind, short of blocking
         """
         current_time = time.time()
         date_time = datetime.fromtimestamp(time.time())
@@ -95,38 +188,61 @@ class TelloDrone:
         # identification information
         self.name = 'Tello'
         self.id = f'{self.name}_{time_str}_{int(current_time)}'
-        self.event_log = []
+        self.event_bus = EventBus(depth=self.EVENT_LOG_DEPTH)
+        self.event_bus.set_sampling('state', self.STATE_EVENT_SAMPLE)
         self.save_directory = os.path.join(DATA_DIR, 'tello', f'{self.id}')
         if not os.path.isdir(self.save_directory):
             os.makedirs(self.save_directory)
 
         # To send comments
-        self.tello_address = (self.CLIENT_HOST, self.CLIENT_PORT)
+        self.tello_address = (host, command_port)
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.client_socket.bind((self.ANY_HOST, self.CLIENT_PORT))
+        self.client_socket.bind((local_host, local_command_port))
 
         # receive state messages
         self.state_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.state_socket.bind((self.ANY_HOST, self.STATE_PORT))
+        self.state_socket.bind((local_host, state_port))
+        self.state_kernel_timestamps = self.__enable_kernel_timestamps(self.state_socket)
 
         # send and receive message logging
-        self.send_queue = queue.Queue()
-        self.send_history = []
-        self.receive_history = []
-        self.outstanding_receive_count = 0
+        self.command_transport = CommandTransport(self.client_socket, self.tello_address, self.BUFFER_SIZE)
+        self.send_history = deque(maxlen=self.MESSAGE_HISTORY_DEPTH)
+        self.num_messages = 0
         self.message_lock = threading.Lock()
+        self.latency_tracer = LatencyTracer()
+        self.rc_scheduler = RcScheduler(
+            self.command_transport, rate=rc_rate, expect_response=self.RC_EXPECTS_RESPONSE,
+            latency_tracer=self.latency_tracer
+        )
 
         # state information
-        self.state_history = []
-        self.state_lock = threading.Lock()
+        self.telemetry = TelemetryStore()
+        self.num_state_packets = 0
+        self.num_state_errors = 0
+        self.state_interval_stats = RunningStats()
+        self.state_backlog_stats = RunningStats()
 
         # video stream
-        self.frame_history = []
+        self.frame_buffer = FrameBuffer(capacity=frame_buffer_depth)
+        self.output_list = output_list if output_list is not None else []
+        # published from the decode and state threads, which must never wait on a subscriber
+        self.frame_bus = FrameBus(nonblocking_topics=(FrameBus.FRAMES, FrameBus.TELEMETRY))
+        self.frame_view_stats = FrameViewStats()
         self.video_lock = threading.Lock()
         self.video_start_time = -1
         self.video_end_time = -1
         self.video_capture = None
         self.video_writer = None
+        if record_drop_policy not in (self.DROP_OLDEST, self.DROP_NEWEST):
+            raise ValueError(f'Unknown record drop policy: {record_drop_policy}')
+        self.record_drop_policy = record_drop_policy
+        if record_mode not in (self.RECORD_RAW, self.RECORD_DECODED, self.RECORD_NONE):
+            raise ValueError(f'Unknown record mode: {record_mode}')
+        self.record_mode = record_mode
+        self.record_queue = queue.Queue(maxsize=self.RECORD_QUEUE_SIZE)
+        self.decode_stats = StageStats('decode')
+        self.record_stats = StageStats('record')
+        self.video_watchdog = VideoWatchdog(event_bus=self.event_bus)
 
         # drone status
         self.sdk_mode = False
@@ -134,15 +250,44 @@ class TelloDrone:
 
         # save file names
         self.video_fname = os.path.join(self.save_directory, f'{self.id}.avi')
-        self.state_history_fname = os.path.join(self.save_directory, f'states_{self.id}.json')
-        self.message_history_fname = os.path.join(self.save_directory, f'messages_{self.id}.json')
+        self.raw_video_fname = os.path.join(self.save_directory, f'{self.id}.h264')
+        self.raw_index_fname = os.path.join(self.save_directory, f'{self.id}.idx')
+        self.frame_times_fname = os.path.join(self.save_directory, f'frames_{self.id}.ts')
+        self.frame_timestamp_writer = FrameTimestampWriter(self.frame_times_fname)
+        self.record_fps = None
+
+        # raw video stream relay
+        self.video_relay = None
+        self.video_url = f'udp://{local_host}:{video_port}'
+        if self.record_mode == self.RECORD_RAW:
+            self.video_relay = H264Relay(
+                listen_address=(local_host, video_port),
+                forward_address=(self.LOOPBACK_HOST, video_relay_port),
+                capture_fname=self.raw_video_fname, index_fname=self.raw_index_fname,
+                keyframe_callback=self.video_watchdog.keyframe_received,
+                frame_timestamp_writer=self.frame_timestamp_writer
+            )
+            self.video_url = f'udp://{self.LOOPBACK_HOST}:{video_relay_port}'
+        self.state_history_fname = os.path.join(self.save_directory, f'states_{self.id}.jsonl')
+        self.message_history_fname = os.path.join(self.save_directory, f'messages_{self.id}.jsonl')
         self.metadata_fname = os.path.join(self.save_directory, f'metadata_{self.id}.json')
-        self.event_log_fname = os.path.join(self.save_directory, f'event_log_{self.id}.json')
+        self.event_log_fname = os.path.join(self.save_directory, f'event_log_{self.id}.jsonl')
+
+        # session logs are streamed to disk as they are recorded
+        self.session_writer = SessionWriter({
+            'events': self.event_log_fname,
+            'messages': self.message_history_fname,
+            'states': self.state_history_fname
+        })
+        self.session_writer.start()
+        self.event_bus.add_sink(self.session_writer, 'events')
+        self.event_bus.start()
 
         # thread info
         self.__thread_dict = {
             'video': {'thread': threading.Thread(target=self.__listen_video, args=(), daemon=True), 'running': False},
-            'state': {'thread': threading.Thread(target=self.__listen_state, args=(), daemon=True), 'running': False}
+            'state': {'thread': threading.Thread(target=self.__listen_state, args=(), daemon=True), 'running': False},
+            'record': {'thread': threading.Thread(target=self.__record_video, args=(), daemon=True), 'running': False}
         }
         return
 
@@ -151,23 +296,23 @@ class TelloDrone:
 
         :return:
         """
-        self.event_log.append({'timestamp': time.time(), 'type': 'status',
-                               'value': f'Attempting initialization of SDK mode...'})
+        self.event_bus.info('status', f'Attempting initialization of SDK mode...')
         response_str = 'error'
+        if self.command_transport.receive_thread is None:
+            self.command_transport.start()
         try:
             response = self.control_command()
             response_str = response['response']
             if response_str == 'ok':
                 self.sdk_mode = True
-                self.event_log.append(
-                    {'timestamp': time.time(), 'type': 'status', 'value': f'SDK mode enabled...'}
-                )
+                self.event_bus.info('status', f'SDK mode enabled...')
                 # ensure the drone video stream is in a known state
                 self.control_streamoff()
                 while not self.control_streamon():
-                    self.event_log.append({'timestamp': time.time(), 'type': 'status',
-                                           'value': f'Could not open turn on drone video stream'})
+                    self.event_bus.warning('status', f'Could not open turn on drone video stream')
                 self.__start_threads()
+                if self.rc_scheduler.schedule_thread is None:
+                    self.rc_scheduler.start()
         except UnicodeDecodeError:
             pass
         return response_str == 'ok'
@@ -178,182 +323,457 @@ class TelloDrone:
         :return:
         """
         self.control_streamoff()
+        self.rc_scheduler.stop()
         for thread_name, thread_entry in self.__thread_dict.items():
             thread_entry['running'] = False
             each_thread = thread_entry['thread']
             if each_thread.ident:
                 each_thread.join()
+        if self.video_relay is not None:
+            self.video_relay.stop()
+        self.frame_timestamp_writer.close()
+        self.command_transport.stop()
 
+        frame_stats = self.frame_buffer.get_stats()
         delta_video_time = max(self.video_end_time - self.video_start_time, 1)
         meta_data = {
             'id': self.id,
-            'num_messages': len(self.send_history),
-            'num_states': len(self.state_history),
-            'num_frames': len(self.frame_history),
+            'num_messages': self.num_messages,
+            'command_stats': self.command_transport.get_stats(),
+            'rc_stats': self.rc_scheduler.get_stats(),
+            'state_stats': self.get_state_stats(),
+            'video_stats': self.get_video_stats(),
+            'record_mode': self.record_mode,
+            'relay_stats': self.video_relay.get_stats() if self.video_relay is not None else None,
+            'num_states': len(self.telemetry),
+            'num_frames': frame_stats['num_frames'],
+            'num_frames_overwritten': frame_stats['num_overwritten'],
+            'num_frame_buffer_reallocations': frame_stats['num_reallocations'],
+            'frame_buffer_depth': frame_stats['capacity'],
             'video_start_time': self.video_start_time,
-            'video_end_time': self.video_start_time,
-            'video_fps': len(self.frame_history) / delta_video_time
+            'video_end_time': self.video_end_time,
+            'video_fps': frame_stats['num_frames'] / delta_video_time,
+            'record_fps': self.record_fps,
+            'frame_times_fname': self.frame_times_fname if self.frame_timestamp_writer.num_frames > 0 else None,
+            'num_frame_times': self.frame_timestamp_writer.num_frames
         }
+        self.event_bus.stop()
+        self.session_writer.stop()
+        meta_data['event_stats'] = self.event_bus.get_stats()
+        meta_data['latency_stats'] = self.latency_tracer.get_stats()
+        meta_data['bus_stats'] = self.frame_bus.get_stats()
+        meta_data['session_log_stats'] = self.session_writer.get_stats()
         with open(self.metadata_fname, 'w+') as save_file:
             json.dump(fp=save_file, obj=meta_data, indent=2)
-
-        with open(self.event_log_fname, 'w+') as save_file:
-            json.dump(fp=save_file, obj=self.event_log, indent=2)
-
-        with self.message_lock:
-            with open(self.message_history_fname, 'w+') as save_file:
-                json.dump(fp=save_file, obj=self.send_history, indent=2)
-
-        with self.state_lock:
-            with open(self.state_history_fname, 'w+') as save_file:
-                json.dump(fp=save_file, obj=self.state_history, indent=2)
         return
 
     def __start_threads(self):
+        if self.video_relay is not None:
+            self.video_relay.start()
         for thread_name, thread_entry in self.__thread_dict.items():
             each_thread = thread_entry['thread']
             each_thread.start()
         return
 
-    def __send_command(self, command: str, wait_response: bool, receive_timeout: float = 4):
+    def __send_command(self, command: str, wait_response: bool, expect_response: bool = True,
+                       receive_timeout: float = RESPONSE_TIMEOUT):
         """
+        Sends a command through the command transport.
+
+        Commands are correlated with their replies by the transport, so a command that is not waited on
+        never delays, or is delayed by, the commands sent after it.
 
         :param command:
-        :param wait_response:
+        :param wait_response: block until the reply is received or the command times out
+        :param expect_response: whether the drone replies to this command
         :param receive_timeout:
-        :return:
+        :return: the send info of the command if waiting for the response, else a future resolving to it
         """
-        enc_command = command.encode(encoding='utf-8')
-        initial_time = time.time()
-        self.event_log.append(
-            {'timestamp': initial_time, 'type': 'send', 'value': f'Sending message: {command}'}
-        )
-        self.client_socket.sendto(enc_command, self.tello_address)
-
-        response_time = None
-        response_message = None
+        self.event_bus.debug('send', f'Sending message: {command}')
+        future = self.command_transport.send(command, expect_response=expect_response, timeout=receive_timeout)
+        future.add_done_callback(self.__log_response)
         if wait_response:
-            while self.outstanding_receive_count > 0:
-                # todo  back-correlate messages that didn't receive a response
-                #       assume packets are not received out of order
-                _ = self.__receive_response(receive_timeout)
-                self.outstanding_receive_count -= 1
-            response_info = self.__receive_response(receive_timeout)
-            response_message = response_info['response']
-            response_time = response_info['receive_time']
-        else:
-            self.outstanding_receive_count += 1
-        send_info = {
-            'timestamp': initial_time, 'command': command, 'response_time': response_time, 'response': response_message
-        }
+            return future.result()
+        return future
+
+    def __log_response(self, future):
+        send_info = future.result()
+        if send_info['response'] is not None:
+            self.event_bus.debug('receive', f'{send_info["response"]}', timestamp=send_info['response_time'])
         with self.message_lock:
             self.send_history.append(send_info)
-        return send_info
+            self.num_messages += 1
+        self.session_writer.write('messages', send_info)
+        return
+
+    @staticmethod
+    def __enable_kernel_timestamps(receive_socket: socket.socket):
+        """
+        Asks the kernel to stamp each datagram received on a socket with its arrival time, where the
+        platform supports it.
 
-    def __receive_response(self, receive_timeout: float):
-        initial_time = time.time()
-        response_str = None
-        receive_time = None
+        :param receive_socket:
+        :return: whether datagrams will be stamped
+        """
+        if SO_TIMESTAMP is None or not hasattr(receive_socket, 'recvmsg'):
+            return False
         try:
-            self.client_socket.settimeout(receive_timeout)
-            response = self.client_socket.recvfrom(self.BUFFER_SIZE)
-            receive_time = time.time()
-            if isinstance(response, Exception):
-                response_str = str(response)
-            else:
-                (response_bytes, _) = response
-                response_str = response_bytes.decode('utf-8')
-                self.event_log.append({'timestamp': time.time(), 'type': 'receive', 'value': f'{response_str}'})
-        except UnicodeDecodeError:
-            pass
-        except socket.timeout:
-            pass
+            receive_socket.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMP, 1)
+        except OSError:
+            return False
+        return True
 
-        receive_message = {'timestamp': initial_time, 'response': response_str, 'receive_time': receive_time}
-        with self.message_lock:
-            self.receive_history.append(receive_message)
-        return receive_message
+    def __receive_state(self):
+        """
+        Reads a state packet along with the time it arrived: the kernel timestamp if the state socket has
+        them, else the time it was read.
+
+        :return: (packet, receive time, whether the receive time is the kernel timestamp)
+        """
+        if not self.state_kernel_timestamps:
+            state_bytes, _ = self.state_socket.recvfrom(self.BUFFER_SIZE)
+            return state_bytes, time.time(), False
+        state_bytes, ancillary_list, _, _ = self.state_socket.recvmsg(self.BUFFER_SIZE, self.TIMESTAMP_BUFFER_SIZE)
+        for each_level, each_type, each_data in ancillary_list:
+            if each_level == socket.SOL_SOCKET and each_type == SO_TIMESTAMP:
+                seconds, microseconds = struct.unpack('ll', each_data[:struct.calcsize('ll')])
+                return state_bytes, seconds + microseconds * 1e-6, True
+        return state_bytes, time.time(), False
 
     def __listen_state(self):
         """
+        Drains the state socket as fast as packets arrive.
+
+        The listener blocks on the socket rather than sleeping between packets, so it is never the
+        cause of packets queueing in the kernel buffer. After each blocking read, any packets already
+        queued behind it are read without blocking; the number of such packets is recorded as the
+        socket backlog. A backlog that stays at zero shows that no state is waiting to be read.
+
+        Packets are stamped with the time the kernel received them where the platform supports it, so
+        packets drained from the backlog keep their true inter-arrival times. Otherwise they are stamped
+        when read, and those drained from the backlog are left out of the interval statistics, as the
+        time between reading them says nothing of when they arrived.
 
         :return:
         """
         state_thread = self.__thread_dict['state']
         state_thread['running'] = True
+        self.state_socket.settimeout(self.STATE_TIMEOUT)
+        last_receive_time = None
         while state_thread['running']:
             try:
-                state_bytes, _ = self.state_socket.recvfrom(self.BUFFER_SIZE)
-                initial_time = time.time()
-                state_str = state_bytes.decode('utf-8').strip()
-                state_val_list = state_str.split(';')
-                state_dict = {
-                    state_entry.split(':')[0]: state_entry.split(':')[1]
-                    for state_entry in state_val_list
-                    if len(state_entry) > 0
-                }
-                state_dict['timestamp'] = initial_time
-                with self.state_lock:
-                    self.state_history.append(state_dict)
-                self.event_log.append({'timestamp': time.time(), 'type': 'state', 'value': state_dict})
-            except Exception as e:
-                self.event_log.append({'timestamp': time.time(), 'type': 'status', 'value': f'{str(e)}'})
-            time.sleep(self.STATE_DELAY)
+                state_bytes, receive_time, kernel_stamped = self.__receive_state()
+            except socket.timeout:
+                continue
+            except OSError as e:
+                self.num_state_errors += 1
+                self.event_bus.error('status', f'{str(e)}')
+                continue
+
+            backlog = 0
+            while True:
+                self.num_state_packets += 1
+                if last_receive_time is not None and (kernel_stamped or backlog == 0):
+                    self.state_interval_stats.add(receive_time - last_receive_time)
+                last_receive_time = receive_time
+                self.__handle_state(state_bytes, receive_time)
+
+                readable, _, _ = select.select([self.state_socket], [], [], 0)
+                if not readable:
+                    break
+                try:
+                    state_bytes, receive_time, kernel_stamped = self.__receive_state()
+                except OSError:
+                    break
+                backlog += 1
+            self.state_backlog_stats.add(backlog)
         return
 
-    def __listen_video(self):
+    def __handle_state(self, state_bytes: bytes, receive_time: float):
         """
-        always on
+        Parses a state packet once into a typed record stamped with the time it was received.
 
+        :param state_bytes:
+        :param receive_time:
         :return:
         """
-        self.video_capture = cv2.VideoCapture(self.VIDEO_UDP_URL, cv2.CAP_FFMPEG)
+        try:
+            state_record = parse_state(state_bytes, receive_time)
+            self.telemetry.append(state_record)
+            state_dict = record_to_dict(self.telemetry.last())
+            self.session_writer.write('states', state_dict)
+            self.event_bus.debug('state', state_dict, timestamp=receive_time)
+            if self.frame_bus.has_subscribers(FrameBus.TELEMETRY):
+                self.frame_bus.publish(FrameBus.TELEMETRY, state_dict, timestamp=receive_time)
+        except Exception as e:
+            self.num_state_errors += 1
+            self.event_bus.error('status', f'{str(e)}')
+        return
+
+    def __open_video_capture(self):
+        """
+        Opens, or reopens, the capture the decode stage reads from. Reads time out after
+        VIDEO_READ_TIMEOUT, so a stalled stream never blocks the decode stage indefinitely.
+
+        :return: whether the capture was opened
+        """
+        if self.video_capture is not None:
+            self.video_capture.release()
+        timeout_params = [
+            cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, int(self.VIDEO_OPEN_TIMEOUT * 1000),
+            cv2.CAP_PROP_READ_TIMEOUT_MSEC, int(self.VIDEO_READ_TIMEOUT * 1000)
+        ]
+        self.video_capture = cv2.VideoCapture(self.video_url, cv2.CAP_FFMPEG, timeout_params)
         if not self.video_capture.isOpened():
-            self.event_log.append({'timestamp': time.time(), 'type': 'status',
-                                   'value': f'Could not open video stream'})
-            return
-
-        self.event_log.append({'timestamp': time.time(), 'type': 'status',
-                               'value': f'Opened video stream: {self.VIDEO_UDP_URL}'})
-
-        # discard first read and make sure all is reading correctly
-        read_success, video_frame = self.video_capture.read()
-        if not read_success:
-            self.event_log.append({'timestamp': time.time(), 'type': 'status',
-                                   'value': f'Error reading from video stream'})
-            return
-        # save capture width and height for later when saving the video
-        fps = 30
-        frame_width = int(self.video_capture.get(3))
-        frame_height = int(self.video_capture.get(4))
-        self.event_log.append({'timestamp': time.time(), 'type': 'status',
-                               'value': f'Read frame from video stream\n'
-                                        f'FPS: {fps}\n'
-                                        f'Width: {frame_width}\n'
-                                        f'Height: {frame_height}'})
+            self.event_bus.error('status', f'Could not open video stream')
+            return False
+        self.event_bus.info('status', f'Opened video stream: {self.video_url}')
+        return True
 
-        codec_str = 'MJPG'
-        self.video_writer = cv2.VideoWriter(
-            self.video_fname, cv2.VideoWriter_fourcc(*codec_str),
-            fps, (frame_width, frame_height)
-        )
+    def __restart_video_stream(self):
+        """
+        Asks the drone to restart the video stream, which makes it resend the parameter sets and a
+        keyframe, and reopens the capture.
 
+        :return: whether the capture was opened
+        """
+        self.event_bus.warning('status', f'Restarting video stream')
+        self.control_streamoff()
+        self.control_streamon()
+        return self.__open_video_capture()
+
+    def __listen_video(self):
+        """
+        Decode stage of the video pipeline: reads frames from the stream into the frame buffer and
+        hands them to the record stage.
+
+        Decoding is watched by a VideoWatchdog. Frames it finds corrupt are not passed on, and when it
+        detects a stall or a burst of errors, the capture is reopened or the stream restarted, as it
+        decides, without stopping the stage.
+
+        :return:
+        """
         video_thread = self.__thread_dict['video']
         video_thread['running'] = True
-        self.video_start_time = time.time()
-        while self.video_capture.isOpened() and video_thread['running']:
-            read_success, video_frame = self.video_capture.read()
+        self.video_watchdog.start(time.time())
+        capture_open = self.__open_video_capture()
+        frame_size = None
+        while video_thread['running']:
+            read_success = False
+            video_frame = None
+            read_start = time.time()
+            if capture_open:
+                read_success, video_frame = self.video_capture.read()
+            else:
+                time.sleep(self.VIDEO_READ_TIMEOUT)
+            read_end = time.time()
             if read_success:
-                self.frame_history.append(video_frame)
-                self.video_writer.write(video_frame.astype('uint8'))
-            cv2.waitKey(self.FRAME_DELAY)
+                if self.video_watchdog.frame_decoded(video_frame, read_end):
+                    if frame_size != video_frame.shape[:2]:
+                        frame_size = video_frame.shape[:2]
+                        self.event_bus.info('status', f'Read frame from video stream\n'
+                                                      f'Width: {frame_size[1]}\n'
+                                                      f'Height: {frame_size[0]}')
+                    if self.video_start_time < 0:
+                        self.video_start_time = read_end
+                    try:
+                        frame_seq = self.frame_buffer.append(video_frame, read_end)
+                    except ValueError:
+                        self.event_bus.warning('status', f'Video frame size changed to {video_frame.shape}, '
+                                                         f'reallocating frame buffer')
+                        self.frame_buffer.reallocate(video_frame.shape, video_frame.dtype)
+                        frame_seq = self.frame_buffer.append(video_frame, read_end)
+                    self.decode_stats.add(read_end - read_start, read_end)
+                    if self.record_mode == self.RECORD_DECODED:
+                        self.__queue_record_frame(video_frame, read_end)
+                    frame_view = FrameView(video_frame, read_end, frame_seq, self.frame_view_stats)
+                    for each_output in self.output_list:
+                        each_output.add_frame(frame_view, trace_id=self.latency_tracer.start(LatencyTracer.DECODED))
+                    self.frame_bus.publish(FrameBus.FRAMES, frame_view, timestamp=read_end)
+            elif capture_open:
+                self.video_watchdog.read_failed(read_end)
+
+            recovery_action = self.video_watchdog.check(time.time())
+            if not video_thread['running']:
+                break
+            if recovery_action == VideoWatchdog.REOPEN:
+                capture_open = self.__open_video_capture()
+            elif recovery_action == VideoWatchdog.RESTART_STREAM:
+                capture_open = self.__restart_video_stream()
         self.video_end_time = time.time()
-
+        self.video_watchdog.close(self.video_end_time)
         self.video_capture.release()
-        self.video_writer.release()
-        cv2.destroyAllWindows()
         return
 
+    def __queue_record_frame(self, video_frame, frame_time: float):
+        """
+        Hands a decoded frame to the record stage without blocking, applying the record drop policy
+        if the record stage has fallen behind.
+
+        :param video_frame:
+        :param frame_time:
+        :return:
+        """
+        try:
+            self.record_queue.put_nowait((video_frame, frame_time))
+        except queue.Full:
+            if self.record_drop_policy == self.DROP_NEWEST:
+                self.record_stats.drop()
+                return
+            try:
+                self.record_queue.get_nowait()
+                self.record_stats.drop()
+            except queue.Empty:
+                pass
+            try:
+                self.record_queue.put_nowait((video_frame, frame_time))
+            except queue.Full:
+                self.record_stats.drop()
+        return
+
+    def __record_video(self):
+        """
+        Record stage of the video pipeline: encodes decoded frames to the session video file.
+
+        The frame rate of the video is estimated from the receive times of the first RECORD_FPS_FRAMES
+        frames, which are held back until the video is opened. The receive time of every frame written is
+        recorded in the frame timestamp sidecar, so the exact time of each frame is known regardless of
+        the frame rate of the file.
+
+        After the stage is stopped, the frames still queued are written before the file is closed.
+
+        :return:
+        """
+        record_thread = self.__thread_dict['record']
+        record_thread['running'] = True
+        pending_frames = []
+        while record_thread['running'] or not self.record_queue.empty():
+            try:
+                video_frame, frame_time = self.record_queue.get(timeout=self.RECORD_TIMEOUT)
+            except queue.Empty:
+                continue
+
+            if self.video_writer is None:
+                pending_frames.append((video_frame, frame_time))
+                if len(pending_frames) < self.RECORD_FPS_FRAMES:
+                    continue
+                self.__open_video_writer(pending_frames)
+                for each_frame, each_time in pending_frames:
+                    self.__write_record_frame(each_frame, each_time)
+                pending_frames = []
+                continue
+            self.__write_record_frame(video_frame, frame_time)
+
+        if self.video_writer is None and len(pending_frames) > 0:
+            self.__open_video_writer(pending_frames)
+        for each_frame, each_time in pending_frames:
+            self.__write_record_frame(each_frame, each_time)
+        if self.video_writer is not None:
+            self.video_writer.release()
+        return
+
+    def __open_video_writer(self, pending_frames: list):
+        frame_height, frame_width = pending_frames[0][0].shape[:2]
+        self.record_fps = estimate_fps([each_time for _, each_time in pending_frames], default=self.RECORD_FPS)
+        codec_str = 'MJPG'
+        self.video_writer = cv2.VideoWriter(
+            self.video_fname, cv2.VideoWriter_fourcc(*codec_str),
+            self.record_fps, (frame_width, frame_height)
+        )
+        return
+
+    def __write_record_frame(self, video_frame, frame_time: float):
+        self.video_writer.write(video_frame)
+        self.frame_timestamp_writer.write(frame_time)
+        write_end = time.time()
+        self.record_stats.add(write_end - frame_time, write_end)
+        return
+
+    def get_video_stats(self):
+        """
+        Throughput and latency of each stage of the video pipeline.
+
+        Decode latency is the time spent waiting on and decoding each frame. Record latency is the time
+        from a frame being decoded to it being written to disk, including time spent in the record queue.
+
+        :return:
+        """
+        stats = {
+            'decode': self.decode_stats.summary(),
+            'record': self.record_stats.summary(),
+            'record_queue_depth': self.record_queue.qsize(),
+            'record_drop_policy': self.record_drop_policy,
+            'frame_buffer': self.frame_buffer.get_stats(),
+            'watchdog': self.video_watchdog.get_stats(),
+            'frame_views': self.frame_view_stats.get_stats()
+        }
+        return stats
+
+    def get_events(self, count: int = None, event_type: str = None, min_severity: Severity = Severity.DEBUG):
+        """
+        Gets the most recent events retained by the event bus, oldest first.
+
+        :param count:
+        :param event_type:
+        :param min_severity:
+        :return:
+        """
+        return self.event_bus.recent(count=count, event_type=event_type, min_severity=min_severity)
+
+    def get_latency_stats(self):
+        """
+        Latency of frames through the control pipeline, from being decoded to the rc command computed from
+        them being sent. See LatencyTracer.
+
+        :return:
+        """
+        return self.latency_tracer.get_stats()
+
+    def get_bus_stats(self):
+        """
+        Messages published on the frame bus, and the delivery policy, lag and drops of each subscriber.
+
+        :return:
+        """
+        return self.frame_bus.get_stats()
+
+    def get_command_stats(self):
+        """
+        Counters and round-trip latency statistics of the commands sent to the drone.
+
+        :return:
+        """
+        return self.command_transport.get_stats()
+
+    def get_rc_stats(self):
+        """
+        Send rate, jitter and coalescing counters of the rc stream.
+
+        :return:
+        """
+        return self.rc_scheduler.get_stats()
+
+    def get_state_stats(self):
+        """
+        Ingestion statistics of the state stream.
+
+        packet_rate is the mean number of packets received per second, jitter is the standard deviation of
+        the inter-arrival time, and backlog is the number of packets found already queued in the socket
+        each time the listener woke up.
+
+        :return:
+        """
+        interval_mean = self.state_interval_stats.mean if self.state_interval_stats.count > 0 else 0
+        stats = {
+            'num_packets': self.num_state_packets,
+            'num_errors': self.num_state_errors,
+            'packet_rate': 1 / interval_mean if interval_mean > 0 else 0,
+            'interval': self.state_interval_stats.summary(),
+            'jitter': self.state_interval_stats.std,
+            'backlog': self.state_backlog_stats.summary()
+        }
+        return stats
+
     def get_last_state(self):
         """
         Gets the latest state information from the stream to port 8890.
@@ -375,19 +795,84 @@ class TelloDrone:
         agy:    %0.2f:  acceleration y
         agz:    %0.2f:  acceleration z
 
+        The state is a record of the telemetry store, with fields read by name, e.g. `state['bat']`.
+        Values are parsed once on receipt; fields missing from the packet are NaN.
+
         :return:
         """
-        last_state = self.state_history[-1] if len(self.state_history) > 0 else None
-        return last_state
+        return self.telemetry.last()
+
+    def get_snapshot(self):
+        """
+        Gets an immutable TelloState of the latest state, with every field read from the same packet.
+
+        Fields are read as attributes, e.g. `snapshot.bat`, and derived values such as `snapshot.speed`
+        are computed once per packet, however many times they are read.
+
+        :return:
+        """
+        return self.telemetry.snapshot()
+
+    def get_telemetry_column(self, field_name: str):
+        """
+        Gets every value received so far of a single state field as a NumPy array.
+
+        :param field_name: 'timestamp' or one of the fields listed in get_last_state
+        :return:
+        """
+        return self.telemetry.column(field_name)
+
+    def get_frame_state(self, seq: int = None, interpolate: bool = False, max_gap: float = None):
+        """
+        Gets the state received closest in time to a frame of the frame buffer.
+
+        :param seq: sequence number of the frame; the latest frame if None
+        :param interpolate: interpolate between the states received either side of the frame
+        :param max_gap: seconds; no state is returned if the nearest one is further than this from the frame
+        :return: field name -> value, or None if the frame is no longer buffered or there is no state
+        """
+        seq = self.frame_buffer.newest_seq if seq is None else seq
+        frame_time = self.frame_buffer.get_timestamp(seq)
+        if frame_time is None:
+            return None
+        state_aligner = StateAligner.from_store(self.telemetry)
+        if interpolate:
+            return state_aligner.interpolate(frame_time)
+        return state_aligner.nearest(frame_time, max_gap=max_gap)
+
+    def get_window(self, seconds: float = None, count: int = None):
+        """
+        Gets aggregates over the states received in the last `seconds`, or the last `count` states, e.g.
+        `get_window(seconds=5).mean('h')` or `get_window(seconds=30).slope('bat')` for the battery
+        drain rate in percent per second.
+
+        :param seconds:
+        :param count:
+        :return: TelemetryWindow
+        """
+        return self.telemetry.window(seconds=seconds, count=count)
 
     def get_last_frame(self):
         """
         Gets the latest video frame from the stream to port 11111.
 
+        The frame is a view into the frame buffer and is overwritten once `frame_buffer_depth` newer
+        frames have been decoded.
+
+        :return:
+        """
+        return self.frame_buffer.get_last_frame()
+
+    def get_frames(self, since: int = 0):
+        """
+        Gets views of the buffered video frames with a sequence number of at least `since`.
+
+        See FrameBuffer.get_frames.
+
+        :param since:
         :return:
         """
-        last_frame = self.frame_history[-1] if len(self.frame_history) > 0 else None
-        return last_frame
+        return self.frame_buffer.get_frames(since=since)
 
     def control_command(self):
         """
@@ -517,7 +1002,7 @@ class TelloDrone:
             self.__send_command(command_str, wait_response=False)
         return
 
-    def set_rc(self, left_right, forward_back, up_down, yaw):
+    def set_rc(self, left_right, forward_back, up_down, yaw, trace_id: int = None):
         """
         Send RC control via four channels.
 
@@ -529,200 +1014,15 @@ class TelloDrone:
         ok
         error
 
+        The setpoint is sent on the next tick of the rc scheduler. Setpoints set faster than the scheduler
+        rate are coalesced, and only the latest is sent.
+
+        :param trace_id: latency trace of the frame the setpoint was computed from, if any
         :return:
         """
-        command_str = f'rc {left_right} {forward_back} {up_down} {yaw}'
         if self.sdk_mode:
-            self.__send_command(command_str, wait_response=False)
+            self.latency_tracer.mark(trace_id, LatencyTracer.RC_QUEUED)
+            self.rc_scheduler.update(left_right, forward_back, up_down, yaw, trace_id=trace_id)
+        else:
+            self.latency_tracer.drop(trace_id)
         return
-
-    def get_speed(self):
-        """
-        speed?
-
-        get current speed (cm/s)
-
-        x: 1-100
-
-        :return:
-        """
-        if not self.sdk_mode:
-            return None
-        last_state = self.get_last_state()
-        if not last_state:
-            return None
-
-        vgx = float(last_state['vgx'])
-        vgy = float(last_state['vgy'])
-        vgz = float(last_state['vgz'])
-
-        radicand = (vgx ** 2) + (vgy ** 2) + (vgz ** 2)
-        total = math.sqrt(radicand)
-        value = {
-            'vgx': vgx,
-            'vgy': vgy,
-            'vgz': vgz,
-            'total': total
-        }
-        return value
-
-    def get_battery(self):
-        """
-        battery?
-
-        get current battery percentage
-
-        x: 0-100
-
-        :return:
-        """
-        if not self.sdk_mode:
-            return None
-        last_state = self.get_last_state()
-        value = float(last_state['bat']) if last_state else None
-        return value
-
-    def get_time(self):
-        """
-        time?
-
-        get current fly time (s)
-
-        time
-        :return:
-        """
-        if not self.sdk_mode:
-            return None
-        last_state = self.get_last_state()
-        value = float(last_state['time']) if last_state else None
-        return value
-
-    def get_height(self):
-        """
-
-        height?
-
-        get height (cm)
-
-        x: 0-3000
-
-        :return:
-        """
-        if not self.sdk_mode:
-            return None
-        last_state = self.get_last_state()
-        value = float(last_state['h']) if last_state else None
-        return value
-
-    def get_temp(self):
-        """
-        temp?
-
-        get temperature (C)
-
-        x: 0-90
-
-        :return:
-        """
-        if not self.sdk_mode:
-            return None
-        last_state = self.get_last_state()
-        if not last_state:
-            return None
-
-        temp_low = float(last_state['templ'])
-        temp_high = float(last_state['temph'])
-        value = {
-            'templ': temp_low,
-            'temph': temp_high,
-            'range': temp_high - temp_low
-        }
-        return value
-
-    def get_attitude(self):
-        """
-        attitude?
-
-        get IMU attitude data
-
-        pitch roll yaw
-
-        :return:
-        """
-        if not self.sdk_mode:
-            return None
-        last_state = self.get_last_state()
-        if not last_state:
-            return None
-
-        pitch = float(last_state['pitch'])
-        roll = float(last_state['roll'])
-        yaw = float(last_state['yaw'])
-        value = {
-            'pitch': pitch,
-            'roll': roll,
-            'yaw': yaw
-        }
-        return value
-
-    def get_baro(self):
-        """
-        baro?
-
-        get barometer value (m)
-
-        x
-
-        :return:
-        """
-        if not self.sdk_mode:
-            return None
-        last_state = self.get_last_state()
-        value = float(last_state['baro']) if last_state else None
-        return value
-
-    def get_acceleration(self):
-        """
-        acceleration?
-
-        get IMU angular acceleration data (0.001g)
-
-        x y z
-
-        :return:
-        """
-        if not self.sdk_mode:
-            return None
-        last_state = self.get_last_state()
-        if not last_state:
-            return None
-
-        agx = float(last_state['agx'])
-        agy = float(last_state['agy'])
-        agz = float(last_state['agz'])
-
-        radicand = (agx ** 2) + (agy ** 2) + (agz ** 2)
-        total = math.sqrt(radicand)
-        value = {
-            'agx': agx,
-            'agy': agy,
-            'agz': agz,
-            'total': total
-        }
-        return value
-
-    def get_tof(self):
-        """
-        tof?
-
-        get distance value from point of takeoff (cm)
-
-        x: 30-1000
-
-        :return:
-        """
-        if not self.sdk_mode:
-            return None
-        last_state = self.get_last_state()
-        value = float(last_state['tof']) if last_state else None
-        return value
@@ -0,0 +1,528 @@
+"""
+@title
+@description
+"""
+import argparse
+import heapq
+import os
+import random
+import shutil
+import socket
+import subprocess
+import threading
+import time
+
+from auto_drone import DATA_DIR
+from auto_drone.drone.telemetry import STATE_FIELDS
+
+
+class NetworkImpairment:
+    """
+    Sends datagrams through a simulated lossy link.
+
+    Each datagram is dropped with probability `loss`, delayed by `delay` plus a uniformly distributed
+    jitter of up to `jitter` seconds, and, with probability `reorder`, held back so that it is sent after
+    the datagram that follows it. Delayed datagrams are sent from a background thread.
+
+    Datagrams are held back per socket and destination, so the state, video and reply streams are only
+    ever reordered within themselves. A held datagram that is not followed within `HOLD_TIMEOUT` seconds
+    is released by the background thread, and any still held are sent when the link is stopped.
+    """
+
+    HOLD_TIMEOUT = 0.1
+
+    def __init__(self, loss: float = 0.0, reorder: float = 0.0, delay: float = 0.0, jitter: float = 0.0,
+                 seed: int = None):
+        """
+
+        :param loss: probability of dropping a datagram
+        :param reorder: probability of swapping a datagram with the next one
+        :param delay: seconds added to every datagram
+        :param jitter: maximum random seconds added on top of the delay
+        :param seed:
+        """
+        self.loss = loss
+        self.reorder = reorder
+        self.delay = delay
+        self.jitter = jitter
+        self.random = random.Random(seed)
+
+        self.held_packets = {}
+        self.hold_lock = threading.Lock()
+        self.delay_heap = []
+        self.delay_count = 0
+        self.delay_condition = threading.Condition()
+        self.delay_thread = None
+        self.running = False
+
+        self.num_sent = 0
+        self.num_dropped = 0
+        self.num_reordered = 0
+        return
+
+    @property
+    def is_active(self):
+        return self.loss > 0 or self.reorder > 0 or self.delay > 0 or self.jitter > 0
+
+    def start(self):
+        """
+
+        :return:
+        """
+        self.running = True
+        self.delay_thread = threading.Thread(target=self.__send_delayed, daemon=True)
+        self.delay_thread.start()
+        return
+
+    def stop(self):
+        """
+
+        :return:
+        """
+        self.running = False
+        with self.delay_condition:
+            self.delay_condition.notify_all()
+        if self.delay_thread is not None and self.delay_thread.ident:
+            self.delay_thread.join()
+        self.__release_held(release_all=True)
+        return
+
+    def send(self, send_socket: socket.socket, packet: bytes, address: tuple):
+        """
+
+        :param send_socket:
+        :param packet:
+        :param address:
+        :return:
+        """
+        if not self.is_active:
+            self.__send_now(send_socket, packet, address)
+            return
+        if self.random.random() < self.loss:
+            self.num_dropped += 1
+            return
+
+        packet_list = [(send_socket, packet, address)]
+        hold_key = (id(send_socket), address)
+        with self.hold_lock:
+            held_packet = self.held_packets.pop(hold_key, None)
+            if held_packet is None and self.random.random() < self.reorder:
+                self.held_packets[hold_key] = (send_socket, packet, address, time.perf_counter() + self.HOLD_TIMEOUT)
+                self.num_reordered += 1
+                return
+        if held_packet is not None:
+            packet_list.append(held_packet[:3])
+
+        for each_socket, each_packet, each_address in packet_list:
+            packet_delay = self.delay + self.random.uniform(0, self.jitter)
+            if packet_delay <= 0:
+                self.__send_now(each_socket, each_packet, each_address)
+                continue
+            with self.delay_condition:
+                heapq.heappush(
+                    self.delay_heap,
+                    (time.perf_counter() + packet_delay, self.delay_count, each_socket, each_packet, each_address)
+                )
+                self.delay_count += 1
+                self.delay_condition.notify()
+        return
+
+    def __send_now(self, send_socket: socket.socket, packet: bytes, address: tuple):
+        try:
+            send_socket.sendto(packet, address)
+            self.num_sent += 1
+        except OSError:
+            self.num_dropped += 1
+        return
+
+    def __release_held(self, release_all: bool = False):
+        release_time = time.perf_counter()
+        with self.hold_lock:
+            release_keys = [
+                each_key for each_key, each_held in self.held_packets.items()
+                if release_all or each_held[3] <= release_time
+            ]
+            release_list = [self.held_packets.pop(each_key) for each_key in release_keys]
+        for each_socket, each_packet, each_address, _ in release_list:
+            self.__send_now(each_socket, each_packet, each_address)
+        return
+
+    def __send_delayed(self):
+        while self.running:
+            self.__release_held()
+            with self.delay_condition:
+                if len(self.delay_heap) == 0:
+                    self.delay_condition.wait(timeout=self.HOLD_TIMEOUT)
+                    continue
+                send_time = self.delay_heap[0][0]
+                wait_time = send_time - time.perf_counter()
+                if wait_time > 0:
+                    self.delay_condition.wait(timeout=min(wait_time, self.HOLD_TIMEOUT))
+                    continue
+                _, _, send_socket, packet, address = heapq.heappop(self.delay_heap)
+            self.__send_now(send_socket, packet, address)
+        return
+
+
+def split_h264_frames(stream_bytes: bytes):
+    """
+    Splits an H.264 Annex B elementary stream into chunks that each end with a coded picture, so the
+    chunks can be sent one per frame period.
+
+    :param stream_bytes:
+    :return: list of byte strings
+    """
+    start_code = b'\x00\x00\x00\x01'
+    nal_starts = []
+    search_idx = stream_bytes.find(start_code)
+    while search_idx != -1:
+        nal_starts.append(search_idx)
+        search_idx = stream_bytes.find(start_code, search_idx + len(start_code))
+    nal_starts.append(len(stream_bytes))
+
+    frame_list = []
+    frame_start = nal_starts[0] if len(nal_starts) > 1 else 0
+    for nal_start, nal_end in zip(nal_starts[:-1], nal_starts[1:]):
+        nal_type = stream_bytes[nal_start + len(start_code)] & 0x1F if nal_start + len(start_code) < nal_end else 0
+        # coded slices of a non-IDR (1) or IDR (5) picture end a frame
+        if nal_type in (1, 5):
+            frame_list.append(stream_bytes[frame_start:nal_end])
+            frame_start = nal_end
+    if frame_start < len(stream_bytes):
+        frame_list.append(stream_bytes[frame_start:])
+    return frame_list
+
+
+def generate_synthetic_stream(stream_fname: str, duration: float = 10, fps: int = 30, width: int = 960,
+                              height: int = 720):
+    """
+    Generates a synthetic H.264 elementary stream of a test pattern. Requires ffmpeg with libx264.
+
+    :param stream_fname:
+    :param duration:
+    :param fps:
+    :param width:
+    :param height:
+    :return:
+    """
+    ffmpeg_path = shutil.which('ffmpeg')
+    if ffmpeg_path is None:
+        raise RuntimeError(f'Could not find ffmpeg on the path')
+    command_list = [
+        ffmpeg_path, '-y', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', f'testsrc2=size={width}x{height}:rate={fps}',
+        '-t', f'{duration}', '-c:v', 'libx264', '-preset', 'ultrafast', '-tune', 'zerolatency',
+        '-g', f'{fps}', '-bsf:v', 'h264_mp4toannexb', '-f', 'h264', stream_fname
+    ]
+    subprocess.run(command_list, check=True)
+    return
+
+
+class TelloSimulator:
+    """
+    Stands in for a Tello on the local host, speaking the SDK over UDP.
+
+    Commands received on the command port are answered with `ok`, or `error` for unknown commands;
+    rc commands are not answered, as on the drone. Once a client has entered SDK mode, the state
+    string is streamed to the client's state port at `state_rate` Hz, and after `streamon` the H.264
+    stream read from `video_fname` is streamed to the client's video port, one frame every frame
+    period, split into packets of at most PACKET_SIZE bytes as the drone does. The video is looped.
+
+    The simulated drone follows the rc setpoint with a first-order response, and every outgoing datagram
+    is passed through a NetworkImpairment.
+    """
+
+    PACKET_SIZE = 1460
+    BUFFER_SIZE = 1024
+    RECEIVE_TIMEOUT = 0.2
+    RC_RESPONSE = 0.3
+
+    KNOWN_COMMANDS = {
+        'command', 'takeoff', 'land', 'streamon', 'streamoff', 'emergency', 'flip', 'speed', 'rc'
+    }
+
+    def __init__(self, host: str = '127.0.0.1', command_port: int = 18889, state_port: int = 8890,
+                 video_port: int = 11111, state_rate: float = 10, video_fname: str = None, video_fps: float = 30,
+                 impairment: NetworkImpairment = None):
+        """
+
+        :param host: interface the simulator receives commands on
+        :param command_port: port the simulator receives commands on
+        :param state_port: client port the state stream is sent to
+        :param video_port: client port the video stream is sent to
+        :param state_rate: state packets sent per second
+        :param video_fname: H.264 elementary stream to send; no video is sent if None
+        :param video_fps:
+        :param impairment: link impairment applied to replies, states and video
+        """
+        self.host = host
+        self.command_port = command_port
+        self.state_port = state_port
+        self.video_port = video_port
+        self.state_rate = state_rate
+        self.video_fps = video_fps
+        self.impairment = impairment if impairment is not None else NetworkImpairment()
+
+        self.video_frames = []
+        if video_fname is not None:
+            with open(video_fname, 'rb') as video_file:
+                self.video_frames = split_h264_frames(video_file.read())
+
+        self.command_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.command_socket.bind((host, command_port))
+        self.stream_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        self.client_host = None
+        self.sdk_mode = False
+        self.stream_on = False
+        self.is_flying = False
+
+        # simulated drone state
+        self.state_lock = threading.Lock()
+        self.rc_setpoint = (0, 0, 0, 0)
+        self.state = {each_field: 0.0 for each_field in STATE_FIELDS}
+        self.state.update({'templ': 60.0, 'temph': 62.0, 'bat': 100.0, 'agz': -1000.0})
+
+        self.thread_list = []
+        self.running = False
+
+        self.num_commands = 0
+        self.num_rc = 0
+        self.num_states = 0
+        self.num_video_packets = 0
+        return
+
+    def start(self):
+        """
+
+        :return:
+        """
+        self.running = True
+        self.impairment.start()
+        self.command_socket.settimeout(self.RECEIVE_TIMEOUT)
+        self.thread_list = [
+            threading.Thread(target=self.__serve_commands, daemon=True),
+            threading.Thread(target=self.__stream_state, daemon=True),
+            threading.Thread(target=self.__stream_video, daemon=True),
+        ]
+        for each_thread in self.thread_list:
+            each_thread.start()
+        return
+
+    def stop(self):
+        """
+
+        :return:
+        """
+        self.running = False
+        for each_thread in self.thread_list:
+            each_thread.join()
+        self.impairment.stop()
+        self.command_socket.close()
+        self.stream_socket.close()
+        return
+
+    def get_stats(self):
+        """
+
+        :return:
+        """
+        stats = {
+            'num_commands': self.num_commands,
+            'num_rc': self.num_rc,
+            'num_states': self.num_states,
+            'num_video_packets': self.num_video_packets,
+            'num_sent': self.impairment.num_sent,
+            'num_dropped': self.impairment.num_dropped,
+            'num_reordered': self.impairment.num_reordered
+        }
+        return stats
+
+    def handle_command(self, command: str):
+        """
+        Applies a command to the simulated drone.
+
+        :param command:
+        :return: the reply to send, or None if the command is not answered
+        """
+        command_parts = command.strip().split()
+        if len(command_parts) == 0 or command_parts[0] not in self.KNOWN_COMMANDS:
+            return 'error'
+        command_name = command_parts[0]
+        if command_name == 'command':
+            self.sdk_mode = True
+            return 'ok'
+        if not self.sdk_mode:
+            return None if command_name == 'rc' else 'error'
+
+        if command_name == 'rc':
+            self.num_rc += 1
+            try:
+                rc_values = tuple(int(float(each_val)) for each_val in command_parts[1:5])
+            except ValueError:
+                return None
+            if len(rc_values) == 4:
+                with self.state_lock:
+                    self.rc_setpoint = rc_values
+            return None
+        if command_name == 'streamon':
+            self.stream_on = True
+        elif command_name == 'streamoff':
+            self.stream_on = False
+        elif command_name == 'takeoff':
+            with self.state_lock:
+                self.is_flying = True
+                self.state['h'] = 80.0
+                self.state['tof'] = 80.0
+        elif command_name in ('land', 'emergency'):
+            with self.state_lock:
+                self.is_flying = False
+                self.rc_setpoint = (0, 0, 0, 0)
+                self.state.update({'h': 0.0, 'tof': 0.0, 'vgx': 0.0, 'vgy': 0.0, 'vgz': 0.0})
+        return 'ok'
+
+    def state_string(self):
+        """
+        Formats the simulated state as sent by the drone.
+
+        :return:
+        """
+        with self.state_lock:
+            field_list = []
+            for each_field in STATE_FIELDS:
+                each_value = self.state[each_field]
+                if each_field in ('baro', 'agx', 'agy', 'agz'):
+                    field_list.append(f'{each_field}:{each_value:0.2f}')
+                else:
+                    field_list.append(f'{each_field}:{int(round(each_value))}')
+        return ';'.join(field_list) + ';\r\n'
+
+    def __step_state(self, time_step: float):
+        with self.state_lock:
+            left_right, forward_back, up_down, yaw = self.rc_setpoint if self.is_flying else (0, 0, 0, 0)
+            response = min(time_step / self.RC_RESPONSE, 1)
+            self.state['vgx'] += (forward_back - self.state['vgx']) * response
+            self.state['vgy'] += (left_right - self.state['vgy']) * response
+            self.state['vgz'] += (up_down - self.state['vgz']) * response
+            self.state['pitch'] = -0.2 * self.state['vgx']
+            self.state['roll'] = 0.2 * self.state['vgy']
+            self.state['agx'] = (forward_back - self.state['vgx']) * 10
+            self.state['agy'] = (left_right - self.state['vgy']) * 10
+            self.state['yaw'] = (self.state['yaw'] + yaw * time_step + 180) % 360 - 180
+            if self.is_flying:
+                self.state['h'] = max(self.state['h'] + self.state['vgz'] * time_step, 10)
+                self.state['tof'] = self.state['h']
+                self.state['time'] += time_step
+                self.state['bat'] = max(self.state['bat'] - time_step / 6, 0)
+            self.state['baro'] = self.state['h'] / 100 + 100
+            self.state['agz'] = -1000.0 + self.state['vgz']
+        return
+
+    def __serve_commands(self):
+        while self.running:
+            try:
+                command_bytes, client_address = self.command_socket.recvfrom(self.BUFFER_SIZE)
+            except socket.timeout:
+                continue
+            except OSError:
+                continue
+            self.num_commands += 1
+            self.client_host = client_address[0]
+            try:
+                reply = self.handle_command(command_bytes.decode('utf-8'))
+            except UnicodeDecodeError:
+                reply = 'error'
+            if reply is not None:
+                self.impairment.send(self.command_socket, reply.encode('utf-8'), client_address)
+        return
+
+    def __stream_state(self):
+        period = 1 / self.state_rate
+        next_send = time.perf_counter()
+        while self.running:
+            sleep_time = next_send - time.perf_counter()
+            if sleep_time > 0:
+                time.sleep(sleep_time)
+            next_send += period
+            self.__step_state(period)
+            if self.sdk_mode and self.client_host is not None:
+                state_bytes = self.state_string().encode('utf-8')
+                self.impairment.send(self.stream_socket, state_bytes, (self.client_host, self.state_port))
+                self.num_states += 1
+        return
+
+    def __stream_video(self):
+        period = 1 / self.video_fps
+        next_send = time.perf_counter()
+        frame_idx = 0
+        while self.running:
+            sleep_time = next_send - time.perf_counter()
+            if sleep_time > 0:
+                time.sleep(sleep_time)
+            next_send += period
+            if not self.stream_on or self.client_host is None or len(self.video_frames) == 0:
+                continue
+
+            frame_bytes = self.video_frames[frame_idx % len(self.video_frames)]
+            frame_idx += 1
+            video_address = (self.client_host, self.video_port)
+            for packet_start in range(0, len(frame_bytes), self.PACKET_SIZE):
+                packet = frame_bytes[packet_start:packet_start + self.PACKET_SIZE]
+                self.impairment.send(self.stream_socket, packet, video_address)
+                self.num_video_packets += 1
+        return
+
+
+def main(main_args):
+    host = main_args.get('host', '127.0.0.1')
+    command_port = main_args.get('command_port', 18889)
+    state_rate = main_args.get('state_rate', 10)
+    video_fname = main_args.get('video', None)
+    run_length = main_args.get('run_length', 60)
+    impairment = NetworkImpairment(
+        loss=main_args.get('loss', 0), reorder=main_args.get('reorder', 0),
+        delay=main_args.get('delay', 0), jitter=main_args.get('jitter', 0)
+    )
+    ###################################
+    if video_fname is None and shutil.which('ffmpeg') is not None:
+        video_dir = os.path.join(DATA_DIR, 'tello_simulator')
+        os.makedirs(video_dir, exist_ok=True)
+        video_fname = os.path.join(video_dir, 'synthetic_tello.h264')
+        generate_synthetic_stream(video_fname)
+    simulator = TelloSimulator(
+        host=host, command_port=command_port, state_rate=state_rate, video_fname=video_fname,
+        impairment=impairment
+    )
+    simulator.start()
+    print(f'Simulating Tello on {host}:{command_port}')
+    end_time = time.time() + run_length
+    while time.time() < end_time:
+        time.sleep(min(5, max(end_time - time.time(), 0)))
+        print(simulator.get_stats())
+    simulator.stop()
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate a Tello drone on the local host.')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='interface to receive commands on')
+    parser.add_argument('--command_port', type=int, default=18889,
+                        help='port to receive commands on')
+    parser.add_argument('--state_rate', type=float, default=10,
+                        help='state packets sent per second')
+    parser.add_argument('--video', type=str, default=None,
+                        help='H.264 elementary stream to send, e.g. a raw capture recorded by TelloDrone')
+    parser.add_argument('--loss', type=float, default=0,
+                        help='probability of dropping each datagram')
+    parser.add_argument('--reorder', type=float, default=0,
+                        help='probability of reordering each datagram')
+    parser.add_argument('--delay', type=float, default=0,
+                        help='seconds of delay added to each datagram')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='maximum random seconds of delay added to each datagram')
+    parser.add_argument('--run_length', type=float, default=60,
+                        help='seconds to run the simulator for')
+
+    args = parser.parse_args()
+    main(vars(args))
@@ -0,0 +1,532 @@
+"""
+@title
+@description
+"""
+import argparse
+import json
+import os
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from auto_drone import DATA_DIR
+from auto_drone.drone.command_transport import CommandTransport
+from auto_drone.drone.h264_relay import H264Relay
+from auto_drone.drone.rc_scheduler import RcScheduler
+from auto_drone.drone.telemetry import TelemetryGetters, TelemetryStore, parse_state
+from auto_drone.running_stats import RunningStats
+
+
+def bind_to_interface(bound_socket: socket.socket, interface: str):
+    """
+    Restricts a socket to a single network interface (e.g. 'wlan1'), so that drones reachable at the same
+    address through different Wi-Fi adapters can be told apart. Only supported on Linux, and usually
+    requires elevated privileges.
+
+    :param bound_socket:
+    :param interface:
+    :return:
+    """
+    if not hasattr(socket, 'SO_BINDTODEVICE'):
+        raise OSError(f'Binding to an interface is not supported on this platform: {interface}')
+    bound_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, interface.encode('utf-8'))
+    return
+
+
+class SwarmMember(TelemetryGetters):
+    """
+    Connection to a single drone of a TelloSwarm.
+
+    A member owns the command, state and, optionally, video sockets of its drone, but no threads: all
+    of its sockets are serviced by the event loop of the swarm it belongs to. Each member must be given
+    a distinct combination of local interface and ports, so the sockets of different drones never
+    collide. Drones that all use the default 192.168.10.1 address must be reached through separate
+    adapters, named by `interface`; Tello EDUs in station mode can instead share one adapter.
+    """
+
+    BUFFER_SIZE = 1024
+
+    def __init__(self, name: str, host: str, command_port: int = 8889, local_host: str = '',
+                 local_command_port: int = 0, state_port: int = 8890, video_port: int = None,
+                 interface: str = None, capture_fname: str = None):
+        """
+
+        :param name: unique name of the drone within the swarm
+        :param host: address of the drone, or of a simulator standing in for it
+        :param command_port: port the drone receives commands on
+        :param local_host: local interface the sockets of this drone are bound to
+        :param local_command_port: local port commands are sent from and replies received on; 0 for any free port
+        :param state_port: local port the drone sends the state stream to
+        :param video_port: local port the drone sends the video stream to; video is not received if None
+        :param interface: network interface the sockets are restricted to, if any
+        :param capture_fname: file the raw video stream is written to; not recorded if None
+        """
+        self.name = name
+        self.address = (host, command_port)
+        self.sdk_mode = False
+        self.is_flying = False
+
+        self.command_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.command_socket.bind((local_host, local_command_port))
+        self.state_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.state_socket.bind((local_host, state_port))
+        self.video_relay = None
+        if video_port is not None:
+            index_fname = f'{os.path.splitext(capture_fname)[0]}.idx' if capture_fname is not None else None
+            self.video_relay = H264Relay(
+                (local_host, video_port), None, capture_fname=capture_fname, index_fname=index_fname
+            )
+        if interface is not None:
+            for each_socket in self.sockets():
+                bind_to_interface(each_socket, interface)
+        for each_socket in self.sockets():
+            each_socket.setblocking(False)
+
+        self.transport = CommandTransport(self.command_socket, self.address, self.BUFFER_SIZE)
+        self.telemetry = TelemetryStore()
+        self.num_state_packets = 0
+        self.num_state_errors = 0
+
+        self.rc_lock = threading.Lock()
+        self.rc_setpoint = None
+        self.rc_setpoint_time = time.perf_counter()
+        return
+
+    def sockets(self):
+        """
+
+        :return: every socket owned by this member
+        """
+        socket_list = [self.command_socket, self.state_socket]
+        if self.video_relay is not None:
+            socket_list.append(self.video_relay.video_socket)
+        return socket_list
+
+    def close(self):
+        """
+        Completes the commands still in flight and closes the sockets and capture of this member.
+
+        :return:
+        """
+        self.transport.expire(now=float('inf'))
+        self.command_socket.close()
+        self.state_socket.close()
+        if self.video_relay is not None:
+            self.video_relay.stop()
+        return
+
+    def handle_state(self, state_bytes: bytes, receive_time: float):
+        """
+
+        :param state_bytes:
+        :param receive_time:
+        :return:
+        """
+        try:
+            self.telemetry.append(parse_state(state_bytes, receive_time))
+            self.num_state_packets += 1
+        except (UnicodeDecodeError, ValueError):
+            self.num_state_errors += 1
+        return
+
+    def get_last_state(self):
+        return self.telemetry.last()
+
+    def get_snapshot(self):
+        return self.telemetry.snapshot()
+
+    def get_telemetry_column(self, field_name: str):
+        return self.telemetry.column(field_name)
+
+    def get_window(self, seconds: float = None, count: int = None):
+        return self.telemetry.window(seconds=seconds, count=count)
+
+    def set_rc(self, left_right, forward_back, up_down, yaw):
+        """
+        Sets the rc setpoint streamed to this drone by the swarm, until `clear_rc` is called. The setpoint
+        must be refreshed before it expires, after `max_setpoint_age` seconds, or the swarm zeroes it.
+
+        :param left_right:
+        :param forward_back:
+        :param up_down:
+        :param yaw:
+        :return:
+        """
+        with self.rc_lock:
+            self.rc_setpoint = (int(left_right), int(forward_back), int(up_down), int(yaw))
+            self.rc_setpoint_time = time.perf_counter()
+        return
+
+    def clear_rc(self):
+        with self.rc_lock:
+            self.rc_setpoint = None
+        return
+
+    def get_stats(self):
+        """
+
+        :return:
+        """
+        stats = {
+            'name': self.name,
+            'address': self.address,
+            'commands': self.transport.get_stats(),
+            'num_state_packets': self.num_state_packets,
+            'num_state_errors': self.num_state_errors,
+            'video': self.video_relay.get_stats() if self.video_relay is not None else None
+        }
+        return stats
+
+
+class TelloSwarm:
+    """
+    Controls several drones from a single thread.
+
+    The command, state and video sockets of every member are registered with one selector, and a single
+    event loop thread reads whatever is ready, matches replies through each member's CommandTransport,
+    parses states into each member's TelemetryStore, records video through each member's H264Relay and
+    streams the rc setpoints of all members at `rc_rate`. Adding a drone adds sockets, not threads.
+
+    As with the RcScheduler of a single drone, a setpoint that has not been refreshed for
+    `max_setpoint_age` seconds is replaced with a zero setpoint, so a member whose controller has
+    stopped updating it hovers instead of flying on.
+
+    A broadcast sends the same command to every member back to back from the calling thread, then waits
+    for all of the replies. The spread between the first and last send (send skew) and between the
+    first and last reply (reply skew) is measured for every broadcast.
+    """
+
+    RC_RATE = 20
+    SELECT_TIMEOUT = 0.05
+    BROADCAST_HISTORY_DEPTH = 1000
+    COMMAND_TIMEOUT = 4
+    TAKEOFF_TIMEOUT = 20
+
+    COMMAND = 'command'
+    STATE = 'state'
+    VIDEO = 'video'
+
+    def __init__(self, member_list: list, rc_rate: float = RC_RATE,
+                 max_setpoint_age: float = RcScheduler.MAX_SETPOINT_AGE):
+        """
+
+        :param member_list: SwarmMembers with distinct names
+        :param rc_rate: rc commands sent per second to each member with an rc setpoint
+        :param max_setpoint_age: seconds a setpoint is streamed without being refreshed before it is zeroed
+        """
+        self.members = {}
+        for each_member in member_list:
+            if each_member.name in self.members:
+                raise ValueError(f'Duplicate swarm member name: {each_member.name}')
+            self.members[each_member.name] = each_member
+        self.rc_period = 1 / rc_rate
+        self.max_setpoint_age = max_setpoint_age
+
+        self.selector = selectors.DefaultSelector()
+        for each_member in self.members.values():
+            self.selector.register(each_member.command_socket, selectors.EVENT_READ, (each_member, self.COMMAND))
+            self.selector.register(each_member.state_socket, selectors.EVENT_READ, (each_member, self.STATE))
+            if each_member.video_relay is not None:
+                self.selector.register(
+                    each_member.video_relay.video_socket, selectors.EVENT_READ, (each_member, self.VIDEO)
+                )
+
+        self.loop_thread = None
+        self.running = False
+
+        self.broadcast_history = deque(maxlen=self.BROADCAST_HISTORY_DEPTH)
+        self.send_skew_stats = RunningStats()
+        self.reply_skew_stats = RunningStats()
+        self.num_loops = 0
+        self.num_datagrams = 0
+        self.num_receive_errors = 0
+        self.num_rc_sent = 0
+        self.num_rc_missed = 0
+        self.num_rc_expired = 0
+        return
+
+    def start(self):
+        """
+        Starts the event loop.
+
+        :return:
+        """
+        for each_member in self.members.values():
+            if each_member.video_relay is not None:
+                each_member.video_relay.open_capture()
+        self.running = True
+        self.loop_thread = threading.Thread(target=self.__event_loop, daemon=True)
+        self.loop_thread.start()
+        return
+
+    def connect(self):
+        """
+        Starts the event loop and puts every member into SDK mode.
+
+        :return: True if every member acknowledged the command
+        """
+        if self.loop_thread is None:
+            self.start()
+        broadcast_info = self.broadcast('command')
+        for each_name, each_result in broadcast_info['results'].items():
+            self.members[each_name].sdk_mode = each_result['response'] == 'ok'
+        return broadcast_info['num_ok'] == len(self.members)
+
+    def cleanup(self):
+        """
+
+        :return:
+        """
+        for each_member in self.members.values():
+            each_member.clear_rc()
+        self.running = False
+        if self.loop_thread is not None and self.loop_thread.ident:
+            self.loop_thread.join()
+        self.selector.close()
+        for each_member in self.members.values():
+            each_member.close()
+        return
+
+    def broadcast(self, command: str, expect_response: bool = True, timeout: float = COMMAND_TIMEOUT,
+                  member_names: list = None):
+        """
+        Sends a command to every member as close together as possible and waits for the replies.
+
+        :param command:
+        :param expect_response:
+        :param timeout: seconds to wait for each reply
+        :param member_names: members to send to; all members if None
+        :return: dictionary with the send info of each member, keyed by name, and the measured skews
+        """
+        member_list = [self.members[each_name] for each_name in member_names] \
+            if member_names is not None else list(self.members.values())
+        future_dict = {}
+        for each_member in member_list:
+            future_dict[each_member.name] = each_member.transport.send(
+                command, expect_response=expect_response, timeout=timeout
+            )
+        result_dict = {each_name: each_future.result() for each_name, each_future in future_dict.items()}
+
+        send_time_list = [each_result['timestamp'] for each_result in result_dict.values()]
+        reply_time_list = [
+            each_result['response_time'] for each_result in result_dict.values()
+            if each_result['response_time'] is not None
+        ]
+        send_skew = max(send_time_list) - min(send_time_list) if len(send_time_list) > 0 else None
+        reply_skew = max(reply_time_list) - min(reply_time_list) if len(reply_time_list) > 1 else None
+        if send_skew is not None:
+            self.send_skew_stats.add(send_skew)
+        if reply_skew is not None:
+            self.reply_skew_stats.add(reply_skew)
+
+        broadcast_info = {
+            'timestamp': min(send_time_list) if len(send_time_list) > 0 else time.time(),
+            'command': command,
+            'results': result_dict,
+            'num_ok': sum(1 for each_result in result_dict.values() if each_result['response'] == 'ok'),
+            'send_skew': send_skew,
+            'reply_skew': reply_skew
+        }
+        self.broadcast_history.append({
+            each_key: each_value for each_key, each_value in broadcast_info.items() if each_key != 'results'
+        })
+        return broadcast_info
+
+    def control_takeoff(self):
+        broadcast_info = self.broadcast('takeoff', timeout=self.TAKEOFF_TIMEOUT)
+        for each_name, each_result in broadcast_info['results'].items():
+            if each_result['response'] == 'ok':
+                self.members[each_name].is_flying = True
+        return broadcast_info
+
+    def control_land(self):
+        for each_member in self.members.values():
+            each_member.clear_rc()
+        broadcast_info = self.broadcast('land', timeout=self.TAKEOFF_TIMEOUT)
+        for each_name, each_result in broadcast_info['results'].items():
+            if each_result['response'] == 'ok':
+                self.members[each_name].is_flying = False
+        return broadcast_info
+
+    def control_emergency(self):
+        for each_member in self.members.values():
+            each_member.clear_rc()
+        return self.broadcast('emergency')
+
+    def control_streamon(self):
+        return self.broadcast('streamon')
+
+    def control_streamoff(self):
+        return self.broadcast('streamoff')
+
+    def set_rc(self, left_right, forward_back, up_down, yaw, member_names: list = None):
+        """
+        Sets the rc setpoint of the named members, or of every member if None.
+
+        :param left_right:
+        :param forward_back:
+        :param up_down:
+        :param yaw:
+        :param member_names:
+        :return:
+        """
+        name_list = member_names if member_names is not None else list(self.members.keys())
+        for each_name in name_list:
+            self.members[each_name].set_rc(left_right, forward_back, up_down, yaw)
+        return
+
+    def get_stats(self):
+        """
+        Event loop counters, broadcast skew statistics and the stats of every member.
+
+        :return:
+        """
+        stats = {
+            'num_members': len(self.members),
+            'num_loops': self.num_loops,
+            'num_datagrams': self.num_datagrams,
+            'num_receive_errors': self.num_receive_errors,
+            'num_rc_sent': self.num_rc_sent,
+            'num_rc_missed': self.num_rc_missed,
+            'num_rc_expired': self.num_rc_expired,
+            'num_broadcasts': len(self.broadcast_history),
+            'send_skew': self.send_skew_stats.summary(),
+            'reply_skew': self.reply_skew_stats.summary(),
+            'members': {each_name: each_member.get_stats() for each_name, each_member in self.members.items()}
+        }
+        return stats
+
+    def __send_rc(self):
+        for each_member in self.members.values():
+            with each_member.rc_lock:
+                setpoint_expired = (
+                    each_member.rc_setpoint is not None
+                    and each_member.rc_setpoint != RcScheduler.ZERO_SETPOINT
+                    and time.perf_counter() - each_member.rc_setpoint_time > self.max_setpoint_age
+                )
+                if setpoint_expired:
+                    each_member.rc_setpoint = RcScheduler.ZERO_SETPOINT
+                    self.num_rc_expired += 1
+                rc_setpoint = each_member.rc_setpoint
+            if rc_setpoint is None or not each_member.sdk_mode:
+                continue
+            left_right, forward_back, up_down, yaw = rc_setpoint
+            each_member.transport.send(f'rc {left_right} {forward_back} {up_down} {yaw}', expect_response=False)
+            self.num_rc_sent += 1
+        return
+
+    def __receive(self, member: SwarmMember, socket_type: str, ready_socket: socket.socket):
+        """
+        Reads every datagram queued on a ready socket.
+
+        :param member:
+        :param socket_type:
+        :param ready_socket:
+        :return:
+        """
+        while True:
+            try:
+                packet, _ = ready_socket.recvfrom(H264Relay.BUFFER_SIZE)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                self.num_receive_errors += 1
+                break
+            receive_time = time.time()
+            self.num_datagrams += 1
+            if socket_type == self.COMMAND:
+                member.transport.handle_datagram(packet, receive_time)
+            elif socket_type == self.STATE:
+                member.handle_state(packet, receive_time)
+            else:
+                member.video_relay.handle_packet(packet, receive_time)
+        return
+
+    def __event_loop(self):
+        next_rc = time.perf_counter()
+        while self.running:
+            select_timeout = min(self.SELECT_TIMEOUT, max(next_rc - time.perf_counter(), 0))
+            for each_key, _ in self.selector.select(timeout=select_timeout):
+                member, socket_type = each_key.data
+                self.__receive(member, socket_type, each_key.fileobj)
+
+            now = time.time()
+            for each_member in self.members.values():
+                each_member.transport.expire(now=now)
+
+            if time.perf_counter() >= next_rc:
+                self.__send_rc()
+                next_rc += self.rc_period
+                behind = time.perf_counter() - next_rc
+                if behind > self.rc_period:
+                    num_skipped = int(behind // self.rc_period)
+                    self.num_rc_missed += num_skipped
+                    next_rc += num_skipped * self.rc_period
+            self.num_loops += 1
+        return
+
+
+def main(main_args):
+    from auto_drone.drone.tello_simulator import TelloSimulator
+    ###################################
+    num_drones = main_args.get('num_drones', 3)
+    num_broadcasts = main_args.get('num_broadcasts', 50)
+    base_port = main_args.get('base_port', 19000)
+    run_length = main_args.get('run_length', 5)
+    ###################################
+    simulator_list = []
+    member_list = []
+    for drone_idx in range(num_drones):
+        command_port = base_port + 10 * drone_idx
+        simulator = TelloSimulator(
+            host='127.0.0.1', command_port=command_port, state_port=command_port + 1, video_port=command_port + 2
+        )
+        simulator.start()
+        simulator_list.append(simulator)
+        member_list.append(SwarmMember(
+            name=f'tello_{drone_idx}', host='127.0.0.1', command_port=command_port, local_host='127.0.0.1',
+            state_port=command_port + 1, video_port=command_port + 2
+        ))
+    tello_swarm = TelloSwarm(member_list)
+    if not tello_swarm.connect():
+        print('Not every drone entered SDK mode')
+    ###################################
+    tello_swarm.control_takeoff()
+    for _ in range(num_broadcasts):
+        tello_swarm.set_rc(0, 20, 0, 0)
+        tello_swarm.broadcast('command')
+        time.sleep(run_length / num_broadcasts)
+    tello_swarm.control_land()
+    swarm_stats = tello_swarm.get_stats()
+    tello_swarm.cleanup()
+    for each_simulator in simulator_list:
+        each_simulator.stop()
+    ###################################
+    time_str = datetime.fromtimestamp(time.time()).strftime("%Y-%m-%d-%H-%M-%S")
+    save_directory = os.path.join(DATA_DIR, 'swarm')
+    if not os.path.isdir(save_directory):
+        os.makedirs(save_directory)
+    stats_fname = os.path.join(save_directory, f'swarm_{time_str}.json')
+    with open(stats_fname, 'w+') as stats_file:
+        json.dump(swarm_stats, stats_file, indent=2)
+    print(json.dumps({each_key: swarm_stats[each_key] for each_key in ('send_skew', 'reply_skew')}, indent=2))
+    print(f'Saved swarm stats: {stats_fname}')
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fly a swarm of simulated drones and measure broadcast skew.')
+    parser.add_argument('--num_drones', type=int, default=3,
+                        help='number of simulated drones')
+    parser.add_argument('--num_broadcasts', type=int, default=50,
+                        help='number of broadcast commands to measure skew over')
+    parser.add_argument('--base_port', type=int, default=19000,
+                        help='command port of the first simulator; each drone uses a block of ten ports')
+    parser.add_argument('--run_length', type=float, default=5,
+                        help='seconds to fly the swarm for')
+
+    args = parser.parse_args()
+    main(vars(args))
@@ -0,0 +1,334 @@
+"""
+@title
+@description
+"""
+import threading
+from collections import deque
+
+import cv2
+import numpy as np
+
+from auto_drone.event_bus import Severity
+from auto_drone.running_stats import RunningStats
+
+GREY_LEVEL = 128
+GREY_TOLERANCE = 3
+GREY_FRACTION = 0.25
+GREY_STRIDE = 8
+
+
+def is_grey_frame(video_frame, grey_fraction: float = GREY_FRACTION, stride: int = GREY_STRIDE):
+    """
+    Checks whether a decoded frame is largely the flat mid-grey the decoder fills in for macroblocks it
+    could not decode, e.g. when slices reference a picture or parameter set that was lost.
+
+    Only every `stride`th pixel in each direction is inspected.
+
+    :param video_frame: BGR or grayscale frame
+    :param grey_fraction: fraction of the inspected pixels that must be grey
+    :param stride:
+    :return:
+    """
+    sample = np.ascontiguousarray(video_frame[::stride, ::stride])
+    num_channels = sample.shape[2] if sample.ndim == 3 else 1
+    lower_bound = np.full(num_channels, GREY_LEVEL - GREY_TOLERANCE, dtype=sample.dtype)
+    upper_bound = np.full(num_channels, GREY_LEVEL + GREY_TOLERANCE, dtype=sample.dtype)
+    num_grey = cv2.countNonZero(cv2.inRange(sample, lower_bound, upper_bound))
+    return num_grey >= grey_fraction * sample.shape[0] * sample.shape[1]
+
+
+class VideoWatchdog:
+    """
+    Watches the decode stage of a video stream for stalls and corruption, and decides how to recover.
+
+    The watchdog is driven by the decode loop: it is told of every frame decoded and every failed read,
+    and is asked after each which recovery action to take. Three kinds of incident are detected:
+        stall:          no frame has been decoded for `stall_timeout` seconds
+        error_burst:    at least `error_burst` failed reads or grey frames within `error_window` seconds
+        grey_frames:    `grey_burst` consecutive frames that are largely grey
+
+    Recovery escalates for as long as an incident is open. Corruption is first waited out until the
+    next keyframe, as every frame decoded before it may reference the lost data; frames decoded in the
+    meantime are withheld from the rest of the pipeline. If no clean keyframe follows within
+    `keyframe_timeout`, or the stream stalled, the capture is reopened, and if that does not recover the
+    stream within `reopen_timeout`, the drone is asked to restart the stream, which also makes it send
+    fresh parameter sets and a keyframe. The session itself is never torn down.
+
+    An incident is recovered at the first clean frame after it, or after the first keyframe received
+    since the last corruption when keyframes are reported by the relay. Each incident records the actions
+    taken, the recovery time and the frames lost, estimated from the frame rate before the incident.
+    """
+
+    NONE = 'none'
+    WAIT_KEYFRAME = 'wait_keyframe'
+    REOPEN = 'reopen'
+    RESTART_STREAM = 'restart_stream'
+
+    STALL = 'stall'
+    ERROR_BURST = 'error_burst'
+    GREY_FRAMES = 'grey_frames'
+
+    STALL_TIMEOUT = 1.0
+    ERROR_WINDOW = 1.0
+    ERROR_BURST_SIZE = 5
+    GREY_BURST = 3
+    KEYFRAME_TIMEOUT = 2.0
+    REOPEN_TIMEOUT = 3.0
+    EXPECTED_FPS = 30
+    INCIDENT_DEPTH = 100
+
+    def __init__(self, stall_timeout: float = STALL_TIMEOUT, error_window: float = ERROR_WINDOW,
+                 error_burst: int = ERROR_BURST_SIZE, grey_burst: int = GREY_BURST,
+                 keyframe_timeout: float = KEYFRAME_TIMEOUT, reopen_timeout: float = REOPEN_TIMEOUT,
+                 expected_fps: float = EXPECTED_FPS, event_bus=None):
+        """
+
+        :param stall_timeout: seconds without a decoded frame before the stream is considered stalled
+        :param error_window: seconds over which errors are counted towards a burst
+        :param error_burst: errors within `error_window` that make a burst
+        :param grey_burst: consecutive grey frames that make an incident
+        :param keyframe_timeout: seconds to wait for a clean keyframe before reopening the capture
+        :param reopen_timeout: seconds to wait after reopening the capture before restarting the stream
+        :param expected_fps: frame rate assumed until it has been measured
+        :param event_bus: EventBus incidents are published to, if given
+        """
+        self.stall_timeout = stall_timeout
+        self.error_window = error_window
+        self.error_burst = error_burst
+        self.grey_burst = grey_burst
+        self.keyframe_timeout = keyframe_timeout
+        self.reopen_timeout = reopen_timeout
+        self.event_bus = event_bus
+
+        self.watchdog_lock = threading.Lock()
+        self.error_times = deque(maxlen=error_burst)
+        self.frame_interval = 1 / expected_fps
+        self.last_frame_time = None
+        self.last_keyframe_time = None
+        self.last_error_time = None
+        self.num_consecutive_grey = 0
+        self.grey_start_time = None
+
+        self.incident = None
+        self.incidents = deque(maxlen=self.INCIDENT_DEPTH)
+        self.recovery_stats = RunningStats()
+        self.type_counts = {}
+        self.num_frames = 0
+        self.num_grey_frames = 0
+        self.num_read_errors = 0
+        self.num_withheld = 0
+        self.num_keyframes = 0
+        self.num_reopens = 0
+        self.num_stream_restarts = 0
+        self.num_recovered = 0
+        self.total_frames_lost = 0
+        return
+
+    def start(self, start_time: float):
+        """
+        Starts watching, counting a stall from `start_time` if no frame is decoded.
+
+        :param start_time:
+        :return:
+        """
+        with self.watchdog_lock:
+            self.last_frame_time = start_time
+        return
+
+    def keyframe_received(self, receive_time: float):
+        """
+        Reports that a keyframe has been received, ahead of it being decoded.
+
+        :param receive_time:
+        :return:
+        """
+        with self.watchdog_lock:
+            self.last_keyframe_time = receive_time
+            self.num_keyframes += 1
+        return
+
+    def frame_decoded(self, video_frame, frame_time: float):
+        """
+        Reports a decoded frame.
+
+        :param video_frame:
+        :param frame_time:
+        :return: True if the frame is clean and should be passed on, False if it should be withheld
+        """
+        grey_frame = is_grey_frame(video_frame)
+        with self.watchdog_lock:
+            if self.num_frames > 0 and self.incident is None:
+                # exponential average of the frame interval while the stream is healthy
+                self.frame_interval += 0.05 * (frame_time - self.last_frame_time - self.frame_interval)
+            self.num_frames += 1
+            self.last_frame_time = frame_time
+
+            if grey_frame:
+                self.num_grey_frames += 1
+                self.num_consecutive_grey += 1
+                if self.num_consecutive_grey == 1:
+                    self.grey_start_time = frame_time
+                self.__add_error(frame_time)
+                if self.incident is None and self.num_consecutive_grey >= self.grey_burst:
+                    self.__open_incident(self.GREY_FRAMES, self.grey_start_time, self.WAIT_KEYFRAME)
+                    # the grey frames before the burst was recognized were withheld as well
+                    self.incident['frames_withheld'] = self.num_consecutive_grey - 1
+                self.__withhold()
+                return False
+            self.num_consecutive_grey = 0
+
+            if self.incident is None:
+                return True
+            awaiting_keyframe = (
+                self.incident['type'] != self.STALL and self.last_keyframe_time is not None
+                and self.last_keyframe_time < self.last_error_time
+            )
+            if awaiting_keyframe:
+                self.__withhold()
+                return False
+            self.__close_incident(frame_time, recovered=True)
+        return True
+
+    def read_failed(self, fail_time: float):
+        """
+        Reports a read of the capture that returned no frame.
+
+        :param fail_time:
+        :return:
+        """
+        with self.watchdog_lock:
+            self.num_read_errors += 1
+            self.__add_error(fail_time)
+        return
+
+    def check(self, now: float):
+        """
+        Decides the recovery action to take at `now`, opening an incident if the stream has stalled.
+
+        :param now:
+        :return: NONE, REOPEN or RESTART_STREAM
+        """
+        with self.watchdog_lock:
+            incident = self.incident
+            if incident is None:
+                if self.last_frame_time is not None and now - self.last_frame_time > self.stall_timeout:
+                    self.__open_incident(self.STALL, now, self.REOPEN)
+                    self.num_reopens += 1
+                    return self.REOPEN
+                return self.NONE
+
+            last_action, action_time = incident['actions'][-1]
+            if last_action == self.WAIT_KEYFRAME and now - action_time > self.keyframe_timeout:
+                incident['actions'].append((self.REOPEN, now))
+                self.num_reopens += 1
+                return self.REOPEN
+            if last_action in (self.REOPEN, self.RESTART_STREAM) and now - action_time > self.reopen_timeout:
+                incident['actions'].append((self.RESTART_STREAM, now))
+                self.num_stream_restarts += 1
+                return self.RESTART_STREAM
+        return self.NONE
+
+    def close(self, end_time: float):
+        """
+        Closes any open incident as unrecovered, e.g. when the session ends.
+
+        :param end_time:
+        :return:
+        """
+        with self.watchdog_lock:
+            if self.incident is not None:
+                self.__close_incident(end_time, recovered=False)
+        return
+
+    def __add_error(self, error_time: float):
+        self.error_times.append(error_time)
+        self.last_error_time = error_time
+        burst = len(self.error_times) == self.error_burst and error_time - self.error_times[0] <= self.error_window
+        if burst and self.incident is None:
+            self.__open_incident(self.ERROR_BURST, self.error_times[0], self.WAIT_KEYFRAME)
+        return
+
+    def __withhold(self):
+        self.num_withheld += 1
+        if self.incident is not None:
+            self.incident['frames_withheld'] += 1
+        return
+
+    def __open_incident(self, incident_type: str, start_time: float, first_action: str):
+        self.incident = {
+            'type': incident_type,
+            'start_time': start_time,
+            'end_time': None,
+            'recovery_time': None,
+            'frames_withheld': 0,
+            'frames_lost': 0,
+            'actions': [(first_action, start_time)],
+            'recovered': False
+        }
+        self.type_counts[incident_type] = self.type_counts.get(incident_type, 0) + 1
+        if self.event_bus is not None:
+            self.event_bus.publish('video_incident', {'type': incident_type, 'action': first_action},
+                                   severity=Severity.WARNING, timestamp=start_time)
+        return
+
+    def __close_incident(self, end_time: float, recovered: bool):
+        incident = self.incident
+        recovery_time = end_time - incident['start_time']
+        frames_expected = int(round(recovery_time / self.frame_interval)) if self.frame_interval > 0 else 0
+        incident.update({
+            'end_time': end_time,
+            'recovery_time': recovery_time,
+            'frames_lost': max(frames_expected, incident['frames_withheld']),
+            'actions': [each_action for each_action, _ in incident['actions']],
+            'recovered': recovered
+        })
+        self.incidents.append(incident)
+        self.incident = None
+        self.error_times.clear()
+        self.total_frames_lost += incident['frames_lost']
+        if recovered:
+            self.num_recovered += 1
+            self.recovery_stats.add(recovery_time)
+        if self.event_bus is not None:
+            self.event_bus.publish('video_recovery', dict(incident),
+                                   severity=Severity.INFO if recovered else Severity.ERROR, timestamp=end_time)
+        return
+
+    def get_counters(self):
+        """
+        Incident counters, without the incident history and recovery percentiles of `get_stats`.
+
+        :return:
+        """
+        with self.watchdog_lock:
+            counters = {
+                'num_incidents': sum(self.type_counts.values()),
+                'num_stream_restarts': self.num_stream_restarts,
+                'total_frames_lost': self.total_frames_lost
+            }
+        return counters
+
+    def get_stats(self):
+        """
+
+        :return:
+        """
+        with self.watchdog_lock:
+            stats = {
+                'num_frames': self.num_frames,
+                'num_grey_frames': self.num_grey_frames,
+                'num_read_errors': self.num_read_errors,
+                'num_withheld': self.num_withheld,
+                'num_keyframes': self.num_keyframes,
+                'num_incidents': sum(self.type_counts.values()),
+                'num_recovered': self.num_recovered,
+                'num_reopens': self.num_reopens,
+                'num_stream_restarts': self.num_stream_restarts,
+                'total_frames_lost': self.total_frames_lost,
+                'incident_counts': dict(self.type_counts),
+                'recovery_time': self.recovery_stats.summary(),
+                'fps': 1 / self.frame_interval if self.frame_interval > 0 else 0,
+                'open_incident': self.incident['type'] if self.incident is not None else None,
+                'incidents': list(self.incidents)
+            }
+        return stats
@@ -0,0 +1,281 @@
+"""
+@title
+@description
+"""
+import queue
+import threading
+import time
+from collections import deque
+from enum import IntEnum
+
+
+class Severity(IntEnum):
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+
+
+class EventBus:
+    """
+    Thread-safe, bounded bus of structured events.
+
+    Publishing an event is O(1) and never blocks: the event is filtered by severity, thinned by the
+    sampling and rate limit of its type, appended to a ring of the most recent `depth` events and queued
+    for dispatch. Subscriber callbacks, such as the sink writing events to disk, run on a dispatch thread
+    of their own, so a slow subscriber never holds up the thread that published the event. When the
+    dispatch queue is full, events are still retained in the ring but are not dispatched, and are counted
+    as dropped.
+
+    Events are dictionaries with the keys timestamp, type, severity (the name of a Severity) and value.
+    """
+
+    DEPTH = 1000
+    QUEUE_SIZE = 10000
+    DISPATCH_TIMEOUT = 0.25
+
+    def __init__(self, depth: int = DEPTH, queue_size: int = QUEUE_SIZE, min_severity: Severity = Severity.DEBUG):
+        """
+
+        :param depth: number of recent events retained in memory
+        :param queue_size: maximum number of events waiting to be dispatched to subscribers
+        :param min_severity: events below this severity are discarded when published
+        """
+        self.min_severity = min_severity
+        self.events = deque(maxlen=depth)
+        self.bus_lock = threading.Lock()
+
+        # per event type: publish every nth event, or at most max_rate events per second
+        self.sample_every = {}
+        self.sample_counts = {}
+        self.rate_limits = {}
+        self.rate_buckets = {}
+
+        self.subscribers = {}
+        self.next_token = 0
+        self.dispatch_queue = queue.Queue(maxsize=queue_size)
+        self.dispatch_thread = None
+        self.running = False
+
+        self.num_published = 0
+        self.num_accepted = 0
+        self.num_filtered = 0
+        self.num_sampled_out = 0
+        self.num_rate_limited = 0
+        self.num_dropped = 0
+        self.num_dispatched = 0
+        self.num_callback_errors = 0
+        self.type_counts = {}
+        return
+
+    def start(self):
+        """
+        Starts the dispatch thread.
+
+        :return:
+        """
+        self.running = True
+        self.dispatch_thread = threading.Thread(target=self.__dispatch_events, daemon=True)
+        self.dispatch_thread.start()
+        return
+
+    def stop(self):
+        """
+        Dispatches every event still queued, then stops the dispatch thread.
+
+        :return:
+        """
+        self.running = False
+        if self.dispatch_thread is not None and self.dispatch_thread.ident:
+            self.dispatch_thread.join()
+        return
+
+    def set_sampling(self, event_type: str, every_n: int):
+        """
+        Keeps only one in every `every_n` events of a type. 1 keeps every event.
+
+        :param event_type:
+        :param every_n:
+        :return:
+        """
+        if every_n < 1:
+            raise ValueError(f'Sampling interval must be at least 1: {every_n}')
+        with self.bus_lock:
+            self.sample_every[event_type] = every_n
+            self.sample_counts[event_type] = 0
+        return
+
+    def set_rate_limit(self, event_type: str, max_rate: float, burst: int = 1):
+        """
+        Keeps at most `max_rate` events of a type per second, allowing short bursts of up to `burst` events.
+
+        :param event_type:
+        :param max_rate: events per second; None removes the limit
+        :param burst:
+        :return:
+        """
+        with self.bus_lock:
+            if max_rate is None:
+                self.rate_limits.pop(event_type, None)
+                self.rate_buckets.pop(event_type, None)
+            else:
+                self.rate_limits[event_type] = (max_rate, max(burst, 1))
+                self.rate_buckets[event_type] = (float(max(burst, 1)), time.perf_counter())
+        return
+
+    def subscribe(self, callback, event_types: list = None, min_severity: Severity = Severity.DEBUG):
+        """
+        Registers a callback that is called, on the dispatch thread, with every matching event.
+
+        :param callback: function taking the event dictionary
+        :param event_types: types of event to receive; all types if None
+        :param min_severity:
+        :return: token used to unsubscribe
+        """
+        type_set = set(event_types) if event_types is not None else None
+        with self.bus_lock:
+            token = self.next_token
+            self.next_token += 1
+            self.subscribers[token] = (callback, type_set, min_severity)
+        return token
+
+    def unsubscribe(self, token: int):
+        with self.bus_lock:
+            self.subscribers.pop(token, None)
+        return
+
+    def add_sink(self, session_writer, stream_name: str = 'events', min_severity: Severity = Severity.DEBUG):
+        """
+        Streams every event to a stream of a SessionWriter.
+
+        :param session_writer:
+        :param stream_name:
+        :param min_severity:
+        :return: token used to unsubscribe
+        """
+        return self.subscribe(
+            lambda event: session_writer.write(stream_name, event), min_severity=min_severity
+        )
+
+    def publish(self, event_type: str, value, severity: Severity = Severity.INFO, timestamp: float = None):
+        """
+        Publishes an event without blocking.
+
+        :param event_type:
+        :param value: JSON-serializable value of the event
+        :param severity:
+        :param timestamp: time of the event; the current time if None
+        :return: True if the event was accepted, False if it was filtered, sampled out or rate limited
+        """
+        with self.bus_lock:
+            self.num_published += 1
+            if severity < self.min_severity:
+                self.num_filtered += 1
+                return False
+
+            every_n = self.sample_every.get(event_type, 1)
+            if every_n > 1:
+                sample_count = self.sample_counts[event_type]
+                self.sample_counts[event_type] = sample_count + 1
+                if sample_count % every_n != 0:
+                    self.num_sampled_out += 1
+                    return False
+
+            if event_type in self.rate_limits:
+                max_rate, burst = self.rate_limits[event_type]
+                tokens, last_time = self.rate_buckets[event_type]
+                now = time.perf_counter()
+                tokens = min(burst, tokens + (now - last_time) * max_rate)
+                if tokens < 1:
+                    self.rate_buckets[event_type] = (tokens, now)
+                    self.num_rate_limited += 1
+                    return False
+                self.rate_buckets[event_type] = (tokens - 1, now)
+
+            event = {
+                'timestamp': timestamp if timestamp is not None else time.time(),
+                'type': event_type,
+                'severity': Severity(severity).name,
+                'value': value
+            }
+            self.events.append(event)
+            self.num_accepted += 1
+            self.type_counts[event_type] = self.type_counts.get(event_type, 0) + 1
+            has_subscribers = len(self.subscribers) > 0
+
+        if has_subscribers:
+            try:
+                self.dispatch_queue.put_nowait((event, severity))
+            except queue.Full:
+                self.num_dropped += 1
+        return True
+
+    def debug(self, event_type: str, value, timestamp: float = None):
+        return self.publish(event_type, value, severity=Severity.DEBUG, timestamp=timestamp)
+
+    def info(self, event_type: str, value, timestamp: float = None):
+        return self.publish(event_type, value, severity=Severity.INFO, timestamp=timestamp)
+
+    def warning(self, event_type: str, value, timestamp: float = None):
+        return self.publish(event_type, value, severity=Severity.WARNING, timestamp=timestamp)
+
+    def error(self, event_type: str, value, timestamp: float = None):
+        return self.publish(event_type, value, severity=Severity.ERROR, timestamp=timestamp)
+
+    def recent(self, count: int = None, event_type: str = None, min_severity: Severity = Severity.DEBUG):
+        """
+        Gets the most recent retained events, oldest first.
+
+        :param count: maximum number of events returned; all retained events if None
+        :param event_type: only return events of this type, if given
+        :param min_severity:
+        :return:
+        """
+        with self.bus_lock:
+            event_list = list(self.events)
+        event_list = [
+            each_event for each_event in event_list
+            if (event_type is None or each_event['type'] == event_type)
+            and Severity[each_event['severity']] >= min_severity
+        ]
+        if count is not None:
+            event_list = event_list[-count:] if count > 0 else []
+        return event_list
+
+    def get_stats(self):
+        """
+
+        :return:
+        """
+        stats = {
+            'num_published': self.num_published,
+            'num_accepted': self.num_accepted,
+            'num_filtered': self.num_filtered,
+            'num_sampled_out': self.num_sampled_out,
+            'num_rate_limited': self.num_rate_limited,
+            'num_dropped': self.num_dropped,
+            'num_dispatched': self.num_dispatched,
+            'num_callback_errors': self.num_callback_errors,
+            'num_retained': len(self.events),
+            'queue_depth': self.dispatch_queue.qsize(),
+            'type_counts': dict(self.type_counts)
+        }
+        return stats
+
+    def __dispatch_events(self):
+        while self.running or not self.dispatch_queue.empty():
+            try:
+                event, severity = self.dispatch_queue.get(timeout=self.DISPATCH_TIMEOUT)
+            except queue.Empty:
+                continue
+            with self.bus_lock:
+                subscriber_list = list(self.subscribers.values())
+            for callback, type_set, min_severity in subscriber_list:
+                if severity < min_severity or (type_set is not None and event['type'] not in type_set):
+                    continue
+                try:
+                    callback(event)
+                except Exception:
+                    self.num_callback_errors += 1
+            self.num_dispatched += 1
+        return
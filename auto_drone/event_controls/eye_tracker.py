@@ -11,6 +11,7 @@ import dlib
 import numpy as np
 
 from auto_drone import DATA_DIR
+from auto_drone.frame_views import FrameView, FrameViewStats
 
 
 def shape_to_np(shape, dtype='int'):
@@ -37,6 +38,7 @@ class EyeTracker:
             os.path.join(DATA_DIR, 'eye_tracking', 'shape_predictor_68_face_landmarks.dat')
         )
         self.video_writer = None
+        self.frame_view_stats = FrameViewStats()
         self.video_start_time = None
         self.video_end_time = None
         start_time = time.time()
@@ -96,8 +98,15 @@ class EyeTracker:
         while self.listening:
             ret, img = self.video_capture.read()
             if ret:
-                gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+                read_time = time.time()
+                # callbacks share the views of the frame, such as the grayscale frame used for detection
+                frame_view = FrameView(img, read_time, len(self.history), self.frame_view_stats)
+                gray = frame_view.gray()
                 rects = self.detector(gray, 1)
+                # the wrapped frame is read-only and shared through the view, so landmarks are drawn on a
+                # copy, made only when there are landmarks to draw
+                if len(rects) > 0:
+                    img = img.copy()
 
                 for (i, rect) in enumerate(rects):
                     shape = self.predictor(gray, rect)
@@ -111,10 +120,9 @@ class EyeTracker:
 
                 self.history.append(img)
                 # # todo save to video
-                read_time = time.time()
                 for each_callback in self.callback_list:
                     if callable(each_callback):
-                        each_callback({'timestamp': read_time, 'data': img})
+                        each_callback({'timestamp': read_time, 'data': img, 'view': frame_view})
         self.video_end_time = time.time()
         cv2.destroyAllWindows()
         self.video_capture.release()
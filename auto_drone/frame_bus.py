@@ -0,0 +1,351 @@
+"""
+@title
+@description
+"""
+import itertools
+import threading
+import time
+from collections import deque
+
+from auto_drone.latency_trace import LatencyTracer
+from auto_drone.running_stats import RunningStats
+
+
+class Subscription:
+    """
+    Delivery queue of a single subscriber to a topic of a FrameBus.
+
+    The policy of the subscription decides what happens when messages are published faster than the
+    subscriber takes them:
+        LATEST:         only the newest message is held; an untaken message is replaced, and dropped
+        DROP_OLDEST:    up to `maxsize` messages are held; the oldest is dropped to make room
+        BLOCK:          up to `maxsize` messages are held; the publisher waits for room, for at most
+                        `block_timeout` seconds, after which the message is dropped
+
+    A `maxsize` of None holds every message, so nothing is ever dropped or blocked on.
+
+    Lag is the number of messages published on the topic since the message the subscriber last took, and
+    age is the time from a message being published to it being taken.
+
+    If the subscription has a latency tracer, a trace is followed for each message it is given: the trace
+    published with the message if there is one, else a trace started when the message is published. The
+    trace is marked as queued, and dropped if the message is.
+    """
+
+    LATEST = 'latest'
+    DROP_OLDEST = 'drop_oldest'
+    BLOCK = 'block'
+    POLICIES = (LATEST, DROP_OLDEST, BLOCK)
+
+    BLOCK_TIMEOUT = 1.0
+
+    def __init__(self, bus, topic: str, name: str, policy: str = DROP_OLDEST, maxsize: int = None,
+                 block_timeout: float = BLOCK_TIMEOUT, latency_tracer: LatencyTracer = None):
+        """
+
+        :param bus: FrameBus the subscription belongs to
+        :param topic:
+        :param name: name the subscriber is reported under
+        :param policy: LATEST, DROP_OLDEST or BLOCK
+        :param maxsize: maximum number of messages held; unbounded if None
+        :param block_timeout: seconds a publisher waits for room under the BLOCK policy
+        :param latency_tracer:
+        """
+        if policy not in self.POLICIES:
+            raise ValueError(f'Unknown subscription policy: {policy}')
+        if maxsize is not None and maxsize < 1:
+            raise ValueError(f'Subscription size must be at least 1: {maxsize}')
+        self.bus = bus
+        self.topic = topic
+        self.name = name
+        self.policy = policy
+        self.maxsize = 1 if policy == self.LATEST else maxsize
+        self.block_timeout = block_timeout
+        self.latency_tracer = latency_tracer
+
+        self.messages = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+
+        self.last_taken_seq = None
+        self.num_delivered = 0
+        self.num_taken = 0
+        self.num_dropped = 0
+        self.num_blocked = 0
+        self.block_time = 0.0
+        self.max_depth = 0
+        self.age_stats = RunningStats()
+        return
+
+    def __len__(self):
+        return len(self.messages)
+
+    def put(self, message: dict, trace_id: int = None):
+        """
+        Delivers a message to the subscription, applying its policy. Called by the bus.
+
+        :param message:
+        :param trace_id: trace published with the message, if any
+        :return: whether the message was queued
+        """
+        if self.latency_tracer is not None:
+            if trace_id is None:
+                trace_id = self.latency_tracer.start(LatencyTracer.DECODED)
+            self.latency_tracer.mark(trace_id, LatencyTracer.QUEUED)
+        with self.condition:
+            if self.closed:
+                self.__drop(trace_id)
+                return False
+            self.num_delivered += 1
+            if self.maxsize is not None and len(self.messages) >= self.maxsize:
+                if self.policy == self.BLOCK:
+                    self.num_blocked += 1
+                    block_start = time.perf_counter()
+                    has_room = self.condition.wait_for(
+                        lambda: self.closed or len(self.messages) < self.maxsize, timeout=self.block_timeout
+                    )
+                    self.block_time += time.perf_counter() - block_start
+                    if not has_room or self.closed:
+                        self.__drop(trace_id)
+                        return False
+                else:
+                    _, dropped_trace = self.messages.popleft()
+                    self.__drop(dropped_trace)
+            self.messages.append((message, trace_id))
+            self.max_depth = max(self.max_depth, len(self.messages))
+            self.condition.notify_all()
+        return True
+
+    def __drop(self, trace_id):
+        self.num_dropped += 1
+        if self.latency_tracer is not None:
+            self.latency_tracer.drop(trace_id)
+        return
+
+    def get(self, timeout: float = None):
+        """
+        Takes the oldest message held, waiting for one to be published if need be.
+
+        :param timeout: seconds to wait; waits indefinitely if None
+        :return: (message, trace id), or (None, None) if the wait timed out or the subscription was closed
+        """
+        with self.condition:
+            has_message = self.condition.wait_for(lambda: self.closed or len(self.messages) > 0, timeout=timeout)
+            if not has_message or len(self.messages) == 0:
+                return None, None
+            message, trace_id = self.messages.popleft()
+            self.condition.notify_all()
+        self.num_taken += 1
+        self.last_taken_seq = message['seq']
+        self.age_stats.add(time.time() - message['timestamp'])
+        if self.latency_tracer is not None:
+            self.latency_tracer.mark(trace_id, LatencyTracer.DEQUEUED)
+        return message, trace_id
+
+    def close(self):
+        """
+        Stops delivery to the subscription and wakes any subscriber or publisher waiting on it. Messages
+        still held can be taken.
+
+        :return:
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.bus.unsubscribe(self)
+        return
+
+    @property
+    def lag(self):
+        last_seq = self.bus.last_seq(self.topic)
+        if last_seq is None:
+            return 0
+        return last_seq - self.last_taken_seq if self.last_taken_seq is not None else last_seq + 1
+
+    def get_counters(self):
+        """
+        Delivery counters and lag of the subscription, without the age percentiles of `get_stats`.
+
+        :return:
+        """
+        counters = {
+            'topic': self.topic,
+            'lag': self.lag,
+            'num_delivered': self.num_delivered,
+            'num_taken': self.num_taken,
+            'num_dropped': self.num_dropped
+        }
+        return counters
+
+    def get_stats(self):
+        """
+
+        :return:
+        """
+        stats = {
+            'topic': self.topic,
+            'policy': self.policy,
+            'maxsize': self.maxsize,
+            'depth': len(self.messages),
+            'max_depth': self.max_depth,
+            'lag': self.lag,
+            'num_delivered': self.num_delivered,
+            'num_taken': self.num_taken,
+            'num_dropped': self.num_dropped,
+            'num_blocked': self.num_blocked,
+            'block_time': self.block_time,
+            'age': self.age_stats.summary()
+        }
+        return stats
+
+
+class FrameBus:
+    """
+    In-process publish/subscribe bus for frames and telemetry.
+
+    Each topic is published by a single source, such as the decode stage of TelloDrone for frames, and
+    read by any number of subscribers, each through a Subscription with a delivery policy of its own.
+    Messages are delivered to the subscribers of a topic in turn, on the thread of the publisher. A slow
+    LATEST or DROP_OLDEST subscriber only ever loses its own messages, but a BLOCK subscriber that falls
+    behind holds up the publisher, and every subscriber after it, for up to its block timeout on every
+    message. Topics published from a stage that must never wait, such as the decode stage, are given as
+    `nonblocking_topics`, on which BLOCK subscriptions are refused. The subscribers of a topic are held
+    in a tuple that is replaced when they change, so publishing never takes the bus lock.
+
+    Messages are dictionaries with the keys topic, seq (the number of the message within its topic),
+    timestamp and value.
+    """
+
+    FRAMES = 'frames'
+    TELEMETRY = 'telemetry'
+
+    def __init__(self, nonblocking_topics: tuple = ()):
+        """
+
+        :param nonblocking_topics: topics whose publisher must not be blocked by a subscriber
+        """
+        self.nonblocking_topics = tuple(nonblocking_topics)
+        self.bus_lock = threading.Lock()
+        self.subscriptions = {}
+        self.seq_counters = {}
+        self.last_seqs = {}
+        self.num_published = {}
+        return
+
+    def subscribe(self, topic: str, name: str, policy: str = Subscription.DROP_OLDEST, maxsize: int = None,
+                  block_timeout: float = Subscription.BLOCK_TIMEOUT, latency_tracer: LatencyTracer = None):
+        """
+        Subscribes to a topic. See Subscription for the policies.
+
+        :param topic:
+        :param name:
+        :param policy:
+        :param maxsize:
+        :param block_timeout:
+        :param latency_tracer:
+        :return: Subscription
+        """
+        if policy == Subscription.BLOCK and topic in self.nonblocking_topics:
+            raise ValueError(f'Subscriptions to {topic} must not block its publisher: use LATEST or DROP_OLDEST')
+        subscription = Subscription(
+            self, topic, name, policy=policy, maxsize=maxsize, block_timeout=block_timeout,
+            latency_tracer=latency_tracer
+        )
+        with self.bus_lock:
+            self.subscriptions[topic] = self.subscriptions.get(topic, ()) + (subscription,)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.bus_lock:
+            topic_subscriptions = self.subscriptions.get(subscription.topic, ())
+            self.subscriptions[subscription.topic] = tuple(
+                each_subscription for each_subscription in topic_subscriptions if each_subscription is not subscription
+            )
+        return
+
+    def has_subscribers(self, topic: str):
+        return len(self.subscriptions.get(topic, ())) > 0
+
+    def last_seq(self, topic: str):
+        """
+        Sequence number of the last message published on a topic, or None if none has been.
+
+        :param topic:
+        :return:
+        """
+        return self.last_seqs.get(topic, None)
+
+    def publish(self, topic: str, value, timestamp: float = None, trace_id: int = None):
+        """
+        Publishes a message to every subscriber of a topic.
+
+        :param topic:
+        :param value:
+        :param timestamp: time of the message; the current time if None
+        :param trace_id: latency trace of the message, for a topic with a single traced subscriber
+        :return: sequence number of the message
+        """
+        seq_counter = self.seq_counters.get(topic, None)
+        if seq_counter is None:
+            with self.bus_lock:
+                seq_counter = self.seq_counters.setdefault(topic, itertools.count())
+        seq = next(seq_counter)
+        message = {
+            'topic': topic,
+            'seq': seq,
+            'timestamp': timestamp if timestamp is not None else time.time(),
+            'value': value
+        }
+        self.last_seqs[topic] = seq
+        self.num_published[topic] = seq + 1
+        for each_subscription in self.subscriptions.get(topic, ()):
+            each_subscription.put(message, trace_id)
+        return seq
+
+    def add_frame(self, new_frame, trace_id: int = None):
+        """
+        Publishes a frame, so the bus can be given to any frame source as an output.
+
+        :param new_frame:
+        :param trace_id:
+        :return:
+        """
+        frame_timestamp = getattr(new_frame, 'timestamp', None)
+        self.publish(self.FRAMES, new_frame, timestamp=frame_timestamp, trace_id=trace_id)
+        return
+
+    def get_counters(self):
+        """
+        Messages published on each topic, and the delivery counters of every subscriber by name.
+
+        :return:
+        """
+        with self.bus_lock:
+            subscription_items = list(self.subscriptions.items())
+        counters = {
+            'num_published': dict(self.num_published),
+            'subscribers': {
+                each_subscription.name: each_subscription.get_counters()
+                for _, topic_subscriptions in subscription_items
+                for each_subscription in topic_subscriptions
+            }
+        }
+        return counters
+
+    def get_stats(self):
+        """
+        Messages published on each topic, and the statistics of every subscriber by name.
+
+        :return:
+        """
+        with self.bus_lock:
+            subscription_items = list(self.subscriptions.items())
+        stats = {
+            'num_published': dict(self.num_published),
+            'subscribers': {
+                each_subscription.name: each_subscription.get_stats()
+                for _, topic_subscriptions in subscription_items
+                for each_subscription in topic_subscriptions
+            }
+        }
+        return stats
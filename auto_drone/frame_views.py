@@ -0,0 +1,166 @@
+"""
+@title
+@description
+"""
+import threading
+import time
+
+import cv2
+import numpy as np
+
+
+class FrameViewStats:
+    """
+    Counts, for each kind of derived view, how often it was asked for and already cached (a hit) or had
+    to be computed (a miss), and the time spent computing it. Shared by every FrameView of a frame source.
+    """
+
+    def __init__(self):
+        self.stats_lock = threading.Lock()
+        self.view_counts = {}
+        self.num_frames = 0
+        return
+
+    def add_frame(self):
+        with self.stats_lock:
+            self.num_frames += 1
+        return
+
+    def add(self, view_name: str, hit: bool, compute_time: float = 0.0):
+        """
+
+        :param view_name:
+        :param hit: the view was already cached
+        :param compute_time: seconds spent computing the view on a miss
+        :return:
+        """
+        with self.stats_lock:
+            view_entry = self.view_counts.get(view_name, None)
+            if view_entry is None:
+                view_entry = {'hits': 0, 'misses': 0, 'compute_time': 0.0}
+                self.view_counts[view_name] = view_entry
+            if hit:
+                view_entry['hits'] += 1
+            else:
+                view_entry['misses'] += 1
+                view_entry['compute_time'] += compute_time
+        return
+
+    def get_stats(self):
+        """
+        Hits, misses and hit ratio of each view. Each view is computed at most once per frame, so a view
+        with as many misses as there are frames and many more hits is being shared.
+
+        :return:
+        """
+        with self.stats_lock:
+            stats = {
+                'num_frames': self.num_frames,
+                'views': {
+                    each_name: {
+                        **each_entry,
+                        'hit_ratio': each_entry['hits'] / (each_entry['hits'] + each_entry['misses'])
+                    }
+                    for each_name, each_entry in self.view_counts.items()
+                }
+            }
+        return stats
+
+
+class FrameView:
+    """
+    A decoded frame along with views derived from it, computed on demand and cached with the frame, so
+    consumers sharing the frame share the work of deriving them.
+
+    The views are the levels of an image pyramid, where level n is the frame downscaled by 2^n in each
+    dimension, and the grayscale version of each level. A view is computed the first time any consumer
+    asks for it, from the finest view already cached that it can be derived from, and every later request
+    returns the same array. The frame and its views are marked read-only, as they are shared: a consumer
+    that draws on a view must copy it first.
+    """
+
+    __slots__ = ('frame', 'timestamp', 'seq', 'views', 'view_lock', 'stats')
+
+    def __init__(self, frame: np.ndarray, timestamp: float = None, seq: int = None, stats: FrameViewStats = None):
+        """
+
+        :param frame: BGR frame
+        :param timestamp: receive time of the frame
+        :param seq: sequence number of the frame within its source
+        :param stats: hit and miss counters shared by the frames of a source
+        """
+        frame.flags.writeable = False
+        self.frame = frame
+        self.timestamp = timestamp
+        self.seq = seq
+        self.views = {}
+        # reentrant, as a view may be derived from another view computed on demand
+        self.view_lock = threading.RLock()
+        self.stats = stats if stats is not None else FrameViewStats()
+        self.stats.add_frame()
+        return
+
+    @property
+    def shape(self):
+        return self.frame.shape
+
+    def __get_view(self, view_key: tuple, compute_func):
+        with self.view_lock:
+            view = self.views.get(view_key, None)
+            if view is not None:
+                self.stats.add(f'{view_key[0]}@{view_key[1]}', hit=True)
+                return view
+            compute_start = time.perf_counter()
+            view = compute_func()
+            view.flags.writeable = False
+            self.views[view_key] = view
+            compute_time = time.perf_counter() - compute_start
+        self.stats.add(f'{view_key[0]}@{view_key[1]}', hit=False, compute_time=compute_time)
+        return view
+
+    def scaled(self, level: int = 0):
+        """
+        The frame downscaled by 2^level in each dimension.
+
+        :param level:
+        :return:
+        """
+        if level == 0:
+            return self.frame
+        return self.__get_view(('bgr', level), lambda: self.__downscale(level))
+
+    def __downscale(self, level: int):
+        source_level = 0
+        source_frame = self.frame
+        for finer_level in range(level - 1, 0, -1):
+            finer_frame = self.views.get(('bgr', finer_level), None)
+            if finer_frame is not None:
+                source_level = finer_level
+                source_frame = finer_frame
+                break
+        scale = 0.5 ** (level - source_level)
+        scaled_dims = (int(source_frame.shape[1] * scale), int(source_frame.shape[0] * scale))
+        return cv2.resize(source_frame, scaled_dims, interpolation=cv2.INTER_AREA)
+
+    def gray(self, level: int = 0):
+        """
+        Grayscale version of pyramid level `level`.
+
+        :param level:
+        :return:
+        """
+        return self.__get_view(('gray', level), lambda: cv2.cvtColor(self.scaled(level), cv2.COLOR_BGR2GRAY))
+
+
+def as_frame_view(frame, stats: FrameViewStats = None):
+    """
+    Wraps a plain frame in a FrameView, for consumers that accept frames from sources that do not produce
+    FrameViews. A FrameView is returned as it is.
+
+    :param frame:
+    :param stats:
+    :return:
+    """
+    if frame is None or isinstance(frame, FrameView):
+        return frame
+    return FrameView(frame, stats=stats)
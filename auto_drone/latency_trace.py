@@ -0,0 +1,151 @@
+"""
+@title
+@description
+"""
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+from auto_drone.running_stats import RunningStats
+
+
+class LatencyTracer:
+    """
+    Follows individual frames through the control pipeline and measures the time spent between stages.
+
+    A trace is started when a frame is decoded and is identified by an integer trace id, which is passed
+    along with the frame to each later stage. Each stage marks the trace with a high-resolution
+    timestamp. For every pair of consecutive stages a trace passes through, and for the time from the
+    start of the trace to each stage, the latency is added to a RunningStats, which keeps the
+    percentiles of a rolling window of the most recent traces.
+
+    A trace ends when it is finished, at the last stage it reaches, or dropped, e.g. when its rc command
+    is replaced by a newer one before being sent. At most `max_in_flight` traces are followed at once;
+    beyond that the oldest are evicted, so traces that are never ended cannot grow the tracer.
+    """
+
+    DECODED = 'decoded'
+    QUEUED = 'queued'
+    DEQUEUED = 'dequeued'
+    PROCESSED = 'processed'
+    RC_QUEUED = 'rc_queued'
+    RC_SENT = 'rc_sent'
+    STAGES = (DECODED, QUEUED, DEQUEUED, PROCESSED, RC_QUEUED, RC_SENT)
+
+    WINDOW_SIZE = 1000
+    MAX_IN_FLIGHT = 1000
+
+    def __init__(self, window_size: int = WINDOW_SIZE, max_in_flight: int = MAX_IN_FLIGHT):
+        """
+
+        :param window_size: number of recent latencies the percentiles are computed over
+        :param max_in_flight: maximum number of traces followed at once
+        """
+        self.window_size = window_size
+        self.max_in_flight = max_in_flight
+        self.traces = OrderedDict()
+        self.trace_lock = threading.Lock()
+        self.trace_ids = itertools.count()
+
+        self.stage_stats = {}
+        self.total_stats = {}
+        self.num_started = 0
+        self.num_finished = 0
+        self.num_dropped = 0
+        self.num_evicted = 0
+        return
+
+    def start(self, stage: str = DECODED):
+        """
+        Starts a new trace at its first stage.
+
+        :param stage:
+        :return: trace id
+        """
+        stage_time = time.perf_counter()
+        with self.trace_lock:
+            trace_id = next(self.trace_ids)
+            self.traces[trace_id] = [(stage, stage_time)]
+            self.num_started += 1
+            while len(self.traces) > self.max_in_flight:
+                self.traces.popitem(last=False)
+                self.num_evicted += 1
+        return trace_id
+
+    def mark(self, trace_id, stage: str):
+        """
+        Records that a trace reached a stage. Unknown or ended traces, and a trace id of None, are ignored.
+
+        :param trace_id:
+        :param stage:
+        :return:
+        """
+        if trace_id is None:
+            return
+        stage_time = time.perf_counter()
+        with self.trace_lock:
+            stage_list = self.traces.get(trace_id, None)
+            if stage_list is None:
+                return
+            first_stage, first_time = stage_list[0]
+            last_stage, last_time = stage_list[-1]
+            stage_list.append((stage, stage_time))
+            self.__add_latency(self.stage_stats, f'{last_stage}->{stage}', stage_time - last_time)
+            self.__add_latency(self.total_stats, f'{first_stage}->{stage}', stage_time - first_time)
+        return
+
+    def finish(self, trace_id, stage: str = None):
+        """
+        Ends a trace, after marking it with a final stage if one is given.
+
+        :param trace_id:
+        :param stage:
+        :return:
+        """
+        if trace_id is None:
+            return
+        if stage is not None:
+            self.mark(trace_id, stage)
+        with self.trace_lock:
+            if self.traces.pop(trace_id, None) is not None:
+                self.num_finished += 1
+        return
+
+    def drop(self, trace_id):
+        """
+        Ends a trace that will not reach any further stage.
+
+        :param trace_id:
+        :return:
+        """
+        if trace_id is None:
+            return
+        with self.trace_lock:
+            if self.traces.pop(trace_id, None) is not None:
+                self.num_dropped += 1
+        return
+
+    def __add_latency(self, stats_dict: dict, key: str, latency: float):
+        if key not in stats_dict:
+            stats_dict[key] = RunningStats(window_size=self.window_size)
+        stats_dict[key].add(latency)
+        return
+
+    def get_stats(self):
+        """
+        Latency between consecutive stages and from the start of the trace to each stage, in seconds.
+
+        :return:
+        """
+        with self.trace_lock:
+            stats = {
+                'num_started': self.num_started,
+                'num_finished': self.num_finished,
+                'num_dropped': self.num_dropped,
+                'num_evicted': self.num_evicted,
+                'num_in_flight': len(self.traces),
+                'stages': {each_key: each_stats.summary() for each_key, each_stats in self.stage_stats.items()},
+                'total': {each_key: each_stats.summary() for each_key, each_stats in self.total_stats.items()}
+            }
+        return stats
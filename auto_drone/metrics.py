@@ -0,0 +1,307 @@
+"""
+@title
+@description
+"""
+import math
+import threading
+import time
+
+from auto_drone.running_stats import Histogram
+
+
+class MetricsText:
+    """
+    Builds a page of metrics in the Prometheus text exposition format.
+    """
+
+    COUNTER = 'counter'
+    GAUGE = 'gauge'
+    HISTOGRAM = 'histogram'
+
+    def __init__(self, prefix: str):
+        """
+
+        :param prefix: prepended to the name of every metric
+        """
+        self.prefix = prefix
+        self.line_list = []
+        self.described = set()
+        return
+
+    def __describe(self, name: str, metric_type: str, help_str: str):
+        if name not in self.described:
+            self.line_list.append(f'# HELP {name} {help_str}')
+            self.line_list.append(f'# TYPE {name} {metric_type}')
+            self.described.add(name)
+        return
+
+    @staticmethod
+    def __format_sample(name: str, value, labels: dict = None):
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            value_str = 'NaN'
+        elif isinstance(value, float) and math.isinf(value):
+            value_str = '+Inf' if value > 0 else '-Inf'
+        else:
+            value_str = f'{value}'
+        if labels:
+            label_str = ','.join(f'{each_key}="{each_value}"' for each_key, each_value in labels.items())
+            return f'{name}{{{label_str}}} {value_str}'
+        return f'{name} {value_str}'
+
+    def add(self, name: str, metric_type: str, help_str: str, value, labels: dict = None):
+        """
+
+        :param name: name of the metric, without the prefix
+        :param metric_type: COUNTER or GAUGE
+        :param help_str:
+        :param value:
+        :param labels:
+        :return:
+        """
+        full_name = f'{self.prefix}_{name}'
+        self.__describe(full_name, metric_type, help_str)
+        self.line_list.append(self.__format_sample(full_name, value, labels))
+        return
+
+    def add_histogram(self, name: str, help_str: str, histogram: Histogram):
+        """
+
+        :param name: name of the metric, without the prefix
+        :param help_str:
+        :param histogram:
+        :return:
+        """
+        full_name = f'{self.prefix}_{name}'
+        self.__describe(full_name, self.HISTOGRAM, help_str)
+        cumulative_list = histogram.cumulative_counts()
+        for each_bound, each_count in zip(histogram.bounds, cumulative_list):
+            self.line_list.append(self.__format_sample(f'{full_name}_bucket', each_count, {'le': f'{each_bound}'}))
+        self.line_list.append(self.__format_sample(f'{full_name}_bucket', cumulative_list[-1], {'le': '+Inf'}))
+        self.line_list.append(self.__format_sample(f'{full_name}_sum', histogram.total))
+        self.line_list.append(self.__format_sample(f'{full_name}_count', histogram.count))
+        return
+
+    def render(self):
+        return '\n'.join(self.line_list) + '\n'
+
+
+class MetricsCollector:
+    """
+    Periodically collects operational counters and gauges from a drone and a GestureControl and renders
+    them as a Prometheus text page.
+
+    Collection runs on its own thread every `interval` seconds and reads only counters and attributes
+    that the drone and controller already maintain, through counter accessors where there are any, so no
+    percentile windows are sorted. Counters that are updated together under a lock, such as those of the
+    video watchdog and the frame view stats, are read under that lock, which is held only for the copy,
+    once per collection. The rendered page is swapped in as a single string, so serving it to a scraper
+    is a reference read, however often it is scraped.
+
+    An error raised while collecting is counted and the previous page kept, so a collection that fails,
+    e.g. on a drone that is shutting down, does not stop later ones.
+    """
+
+    INTERVAL = 1.0
+    PREFIX = 'auto_drone'
+
+    def __init__(self, drone=None, gesture_control=None, interval: float = INTERVAL):
+        """
+
+        :param drone: TelloDrone, or any object exposing the same interface
+        :param gesture_control:
+        :param interval: seconds between collections
+        """
+        self.drone = drone
+        self.gesture_control = gesture_control
+        self.interval = interval
+
+        self.metrics_text = None
+        self.collect_thread = None
+        self.running = False
+        self.num_collections = 0
+        self.num_errors = 0
+        self.last_error = None
+        self.collect_time = 0.0
+        return
+
+    def start(self):
+        """
+
+        :return:
+        """
+        self.running = True
+        self.collect_thread = threading.Thread(target=self.__collect_loop, daemon=True)
+        self.collect_thread.start()
+        return
+
+    def stop(self):
+        """
+
+        :return:
+        """
+        self.running = False
+        if self.collect_thread is not None and self.collect_thread.ident:
+            self.collect_thread.join()
+        return
+
+    def render(self):
+        """
+        Gets the most recently collected page of metrics, collecting one first if none has been.
+
+        :return:
+        """
+        metrics_text = self.metrics_text
+        if metrics_text is None:
+            metrics_text = self.collect()
+        return metrics_text
+
+    def collect(self):
+        """
+        Collects every metric and swaps in the rendered page.
+
+        :return: the rendered page
+        """
+        collect_start = time.perf_counter()
+        metrics_builder = MetricsText(self.PREFIX)
+        if self.drone is not None:
+            self.__collect_drone(metrics_builder)
+        if self.gesture_control is not None:
+            self.__collect_gesture(metrics_builder)
+        metrics_builder.add('metrics_collections_total', MetricsText.COUNTER,
+                            'Number of times the metrics were collected', self.num_collections + 1)
+        metrics_builder.add('metrics_collect_seconds', MetricsText.GAUGE,
+                            'Time taken by the previous collection', self.collect_time)
+        metrics_builder.add('metrics_collect_errors_total', MetricsText.COUNTER,
+                            'Collections that failed with an error', self.num_errors)
+        metrics_text = metrics_builder.render()
+
+        self.metrics_text = metrics_text
+        self.num_collections += 1
+        self.collect_time = time.perf_counter() - collect_start
+        return metrics_text
+
+    def __collect_loop(self):
+        next_collect = time.perf_counter()
+        while self.running:
+            try:
+                self.collect()
+            except Exception as e:
+                self.num_errors += 1
+                self.last_error = f'{str(e)}'
+            next_collect += self.interval
+            sleep_time = next_collect - time.perf_counter()
+            if sleep_time > 0:
+                time.sleep(sleep_time)
+            else:
+                next_collect = time.perf_counter()
+        return
+
+    def __collect_drone(self, metrics_builder: MetricsText):
+        drone = self.drone
+        if hasattr(drone, 'decode_stats'):
+            metrics_builder.add('frames_decoded_total', MetricsText.COUNTER,
+                                'Frames decoded from the video stream', drone.decode_stats.num_processed)
+            metrics_builder.add('frames_decode_rate', MetricsText.GAUGE,
+                                'Frames decoded per second', drone.decode_stats.throughput)
+        if hasattr(drone, 'record_stats'):
+            metrics_builder.add('frames_recorded_total', MetricsText.COUNTER,
+                                'Frames written to the decoded recording', drone.record_stats.num_processed)
+            metrics_builder.add('frames_dropped_total', MetricsText.COUNTER,
+                                'Frames dropped by the record stage', drone.record_stats.num_dropped)
+            metrics_builder.add('record_queue_depth', MetricsText.GAUGE,
+                                'Frames waiting in the record queue', drone.record_queue.qsize())
+        if hasattr(drone, 'video_watchdog'):
+            watchdog_counters = drone.video_watchdog.get_counters()
+            metrics_builder.add('video_incidents_total', MetricsText.COUNTER,
+                                'Stalls and bursts of corruption detected in the video stream',
+                                watchdog_counters['num_incidents'])
+            metrics_builder.add('video_frames_lost_total', MetricsText.COUNTER,
+                                'Frames lost to closed video incidents', watchdog_counters['total_frames_lost'])
+            metrics_builder.add('video_stream_restarts_total', MetricsText.COUNTER,
+                                'Times the drone was asked to restart the video stream',
+                                watchdog_counters['num_stream_restarts'])
+        if hasattr(drone, 'frame_view_stats'):
+            view_stats = drone.frame_view_stats.get_stats()
+            for each_view, each_counts in view_stats['views'].items():
+                metrics_builder.add('frame_view_hits_total', MetricsText.COUNTER,
+                                    'Requests for a derived frame view served from the cache',
+                                    each_counts['hits'], {'view': each_view})
+                metrics_builder.add('frame_view_misses_total', MetricsText.COUNTER,
+                                    'Requests for a derived frame view that computed it',
+                                    each_counts['misses'], {'view': each_view})
+        if hasattr(drone, 'frame_bus'):
+            bus_counters = drone.frame_bus.get_counters()
+            for each_name, each_stats in bus_counters['subscribers'].items():
+                subscriber_labels = {'subscriber': each_name, 'topic': each_stats['topic']}
+                metrics_builder.add('bus_delivered_total', MetricsText.COUNTER,
+                                    'Messages delivered to a frame bus subscriber',
+                                    each_stats['num_delivered'], subscriber_labels)
+                metrics_builder.add('bus_dropped_total', MetricsText.COUNTER,
+                                    'Messages dropped by the delivery policy of a frame bus subscriber',
+                                    each_stats['num_dropped'], subscriber_labels)
+                metrics_builder.add('bus_lag_messages', MetricsText.GAUGE,
+                                    'Messages published since the last one taken by a frame bus subscriber',
+                                    each_stats['lag'], subscriber_labels)
+        if hasattr(drone, 'frame_buffer'):
+            metrics_builder.add('frame_buffer_overwritten_total', MetricsText.COUNTER,
+                                'Frames overwritten in the frame buffer', drone.frame_buffer.num_overwritten)
+
+        if hasattr(drone, 'num_state_packets'):
+            interval_mean = drone.state_interval_stats.mean if drone.state_interval_stats.count > 0 else 0
+            metrics_builder.add('state_packets_total', MetricsText.COUNTER,
+                                'State packets received', drone.num_state_packets)
+            metrics_builder.add('state_errors_total', MetricsText.COUNTER,
+                                'State packets that could not be received or parsed', drone.num_state_errors)
+            metrics_builder.add('state_packet_rate', MetricsText.GAUGE,
+                                'State packets received per second', 1 / interval_mean if interval_mean > 0 else 0)
+
+        if hasattr(drone, 'command_transport'):
+            transport = drone.command_transport
+            metrics_builder.add('commands_sent_total', MetricsText.COUNTER,
+                                'Commands sent to the drone', transport.num_sent)
+            metrics_builder.add('command_timeouts_total', MetricsText.COUNTER,
+                                'Commands not answered before their deadline', transport.num_timeouts)
+            metrics_builder.add('commands_in_flight', MetricsText.GAUGE,
+                                'Commands awaiting a reply', transport.num_in_flight())
+            metrics_builder.add_histogram('command_rtt_seconds', 'Round-trip time of acknowledged commands',
+                                          transport.rtt_histogram)
+        if hasattr(drone, 'rc_scheduler'):
+            metrics_builder.add('rc_sent_total', MetricsText.COUNTER,
+                                'rc commands sent', drone.rc_scheduler.num_sent)
+            metrics_builder.add('rc_missed_total', MetricsText.COUNTER,
+                                'rc sends skipped by a late scheduler', drone.rc_scheduler.num_missed)
+        if hasattr(drone, 'event_bus'):
+            metrics_builder.add('events_dropped_total', MetricsText.COUNTER,
+                                'Events not dispatched because the dispatch queue was full',
+                                drone.event_bus.num_dropped)
+
+        last_state = drone.get_snapshot()
+        if last_state is not None:
+            metrics_builder.add('battery_percent', MetricsText.GAUGE, 'Battery level', last_state.bat)
+            metrics_builder.add('temperature_celsius', MetricsText.GAUGE, 'Temperature of the drone',
+                                last_state.templ, {'bound': 'low'})
+            metrics_builder.add('temperature_celsius', MetricsText.GAUGE, 'Temperature of the drone',
+                                last_state.temph, {'bound': 'high'})
+            metrics_builder.add('height_cm', MetricsText.GAUGE, 'Height from the ground', last_state.h)
+            metrics_builder.add('state_age_seconds', MetricsText.GAUGE, 'Time since the latest state was received',
+                                time.time() - last_state.timestamp)
+        return
+
+    def __collect_gesture(self, metrics_builder: MetricsText):
+        gesture_control = self.gesture_control
+        metrics_builder.add('gesture_queue_depth', MetricsText.GAUGE,
+                            'Frames waiting to be processed by gesture control', gesture_control.queue_depth())
+        metrics_builder.add('gesture_frames_processed_total', MetricsText.COUNTER,
+                            'Frames processed by gesture control', len(gesture_control.history))
+        if hasattr(gesture_control, 'process_stats'):
+            metrics_builder.add('gesture_process_rate', MetricsText.GAUGE,
+                                'Frames processed per second by gesture control',
+                                gesture_control.process_stats.throughput)
+            metrics_builder.add('gesture_frames_skipped_total', MetricsText.COUNTER,
+                                'Frames received but not processed by gesture control',
+                                gesture_control.process_stats.num_dropped)
+            if gesture_control.last_frame_age is not None:
+                metrics_builder.add('gesture_frame_age_seconds', MetricsText.GAUGE,
+                                    'Age of the last frame processed by gesture control when it was processed',
+                                    gesture_control.last_frame_age)
+        return
@@ -0,0 +1,182 @@
+"""
+@title
+@description
+"""
+import bisect
+import math
+from collections import deque
+
+import numpy as np
+
+
+class RunningStats:
+    """
+    Incrementally maintained summary statistics of a stream of samples.
+
+    Count, mean, variance, min and max are tracked over the whole stream using Welford's algorithm.
+    Percentiles are computed on demand from a bounded window of the most recent samples.
+    """
+
+    def __init__(self, window_size: int = 1000):
+        """
+
+        :param window_size: number of recent samples retained for percentile estimates
+        """
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.last = None
+        self.recent = deque(maxlen=window_size)
+        return
+
+    def add(self, value: float):
+        """
+
+        :param value:
+        :return:
+        """
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.last = value
+        self.recent.append(value)
+        return
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+    def percentiles(self, q_list=(50, 95, 99)):
+        """
+        Percentiles of the recent sample window.
+
+        :param q_list:
+        :return:
+        """
+        if len(self.recent) == 0:
+            return {f'p{each_q}': None for each_q in q_list}
+        values = np.percentile(np.fromiter(self.recent, dtype=np.float64), q_list)
+        return {f'p{each_q}': float(each_val) for each_q, each_val in zip(q_list, values)}
+
+    def summary(self):
+        """
+
+        :return:
+        """
+        summary = {
+            'count': self.count,
+            'mean': self.mean if self.count > 0 else None,
+            'std': self.std,
+            'min': self.min if self.count > 0 else None,
+            'max': self.max if self.count > 0 else None,
+        }
+        summary.update(self.percentiles())
+        return summary
+
+
+class StageStats:
+    """
+    Throughput and latency counters of a single stage of a processing pipeline.
+    """
+
+    def __init__(self, name: str):
+        """
+
+        :param name:
+        """
+        self.name = name
+        self.num_processed = 0
+        self.num_dropped = 0
+        self.latency_stats = RunningStats()
+        self.first_time = None
+        self.last_time = None
+        return
+
+    def add(self, latency: float, timestamp: float):
+        """
+        Records an item completing the stage.
+
+        :param latency: seconds the item spent in the stage
+        :param timestamp: time the item completed the stage
+        :return:
+        """
+        self.num_processed += 1
+        self.latency_stats.add(latency)
+        if self.first_time is None:
+            self.first_time = timestamp
+        self.last_time = timestamp
+        return
+
+    def drop(self, count: int = 1):
+        self.num_dropped += count
+        return
+
+    @property
+    def throughput(self):
+        if self.num_processed < 2 or self.last_time <= self.first_time:
+            return 0
+        return (self.num_processed - 1) / (self.last_time - self.first_time)
+
+    def summary(self):
+        """
+
+        :return:
+        """
+        summary = {
+            'name': self.name,
+            'num_processed': self.num_processed,
+            'num_dropped': self.num_dropped,
+            'throughput': self.throughput,
+            'latency': self.latency_stats.summary()
+        }
+        return summary
+
+
+class Histogram:
+    """
+    Counts of samples falling into fixed buckets, kept over the whole stream.
+
+    Bucket `i` counts the samples no greater than `bounds[i]` and greater than `bounds[i - 1]`; a final
+    bucket counts the samples greater than every bound. Adding a sample is a binary search and an
+    increment, and the histogram never grows, so it can be updated on every sample of a hot path.
+    """
+
+    def __init__(self, bounds):
+        """
+
+        :param bounds: upper bounds of the buckets, in increasing order
+        """
+        self.bounds = tuple(sorted(bounds))
+        self.bucket_counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        return
+
+    def add(self, value: float):
+        """
+
+        :param value:
+        :return:
+        """
+        self.bucket_counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        return
+
+    def cumulative_counts(self):
+        """
+        Number of samples no greater than each bound, followed by the total number of samples.
+
+        :return:
+        """
+        cumulative_list = []
+        running_count = 0
+        for each_count in self.bucket_counts:
+            running_count += each_count
+            cumulative_list.append(running_count)
+        return cumulative_list
@@ -0,0 +1,177 @@
+"""
+@title
+@description
+"""
+import json
+import os
+import queue
+import threading
+import time
+
+
+class SessionWriter:
+    """
+    Streams session records to append-only JSON Lines files from a background thread.
+
+    Each named stream is written to its own file, one JSON object per line. Records are handed to
+    the writer through a bounded queue, so the memory held in the process is bounded and producers
+    never block: when the queue is full the record is dropped and counted. Files are flushed and
+    fsynced in batches, every `flush_count` records or `flush_interval` seconds, whichever comes first,
+    so a crash loses at most the last batch.
+    """
+
+    QUEUE_SIZE = 10000
+    FLUSH_COUNT = 500
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, stream_fnames: dict, queue_size: int = QUEUE_SIZE, flush_count: int = FLUSH_COUNT,
+                 flush_interval: float = FLUSH_INTERVAL):
+        """
+
+        :param stream_fnames: stream name -> file the stream is appended to
+        :param queue_size: maximum number of records waiting to be written
+        :param flush_count:
+        :param flush_interval:
+        """
+        self.stream_fnames = dict(stream_fnames)
+        self.flush_count = flush_count
+        self.flush_interval = flush_interval
+
+        self.record_queue = queue.Queue(maxsize=queue_size)
+        self.stream_files = {}
+        self.write_thread = None
+        self.running = False
+
+        self.num_written = {stream_name: 0 for stream_name in self.stream_fnames}
+        self.num_dropped = 0
+        self.num_flushes = 0
+        return
+
+    def start(self):
+        """
+
+        :return:
+        """
+        for stream_name, stream_fname in self.stream_fnames.items():
+            self.stream_files[stream_name] = open(stream_fname, 'a', encoding='utf-8')
+        self.running = True
+        self.write_thread = threading.Thread(target=self.__write_records, daemon=True)
+        self.write_thread.start()
+        return
+
+    def stop(self):
+        """
+        Writes every record still queued, then flushes and closes the stream files.
+
+        :return:
+        """
+        self.running = False
+        if self.write_thread is not None and self.write_thread.ident:
+            self.write_thread.join()
+        return
+
+    def write(self, stream_name: str, record: dict):
+        """
+        Queues a record to be appended to a stream without blocking.
+
+        :param stream_name:
+        :param record: JSON-serializable dictionary
+        :return: False if the record was dropped because the queue is full
+        """
+        if stream_name not in self.stream_fnames:
+            raise KeyError(f'Unknown session stream: {stream_name}')
+        try:
+            self.record_queue.put_nowait((stream_name, record))
+        except queue.Full:
+            self.num_dropped += 1
+            return False
+        return True
+
+    def get_stats(self):
+        """
+
+        :return:
+        """
+        stats = {
+            'num_written': dict(self.num_written),
+            'num_dropped': self.num_dropped,
+            'num_flushes': self.num_flushes,
+            'queue_depth': self.record_queue.qsize()
+        }
+        return stats
+
+    def __flush(self):
+        for each_file in self.stream_files.values():
+            each_file.flush()
+            os.fsync(each_file.fileno())
+        self.num_flushes += 1
+        return
+
+    def __write_records(self):
+        pending_count = 0
+        last_flush = time.time()
+        while self.running or not self.record_queue.empty():
+            try:
+                stream_name, record = self.record_queue.get(timeout=self.flush_interval)
+                record_str = json.dumps(record, default=str)
+                self.stream_files[stream_name].write(f'{record_str}\n')
+                self.num_written[stream_name] += 1
+                pending_count += 1
+            except queue.Empty:
+                pass
+
+            if pending_count > 0 and (pending_count >= self.flush_count or
+                                      time.time() - last_flush >= self.flush_interval):
+                self.__flush()
+                pending_count = 0
+                last_flush = time.time()
+
+        self.__flush()
+        for each_file in self.stream_files.values():
+            each_file.close()
+        return
+
+
+def read_session_log(log_fname: str):
+    """
+    Reads every complete record of a session stream file. A partially written last line is ignored.
+
+    :param log_fname:
+    :return: generator of records
+    """
+    with open(log_fname, 'r', encoding='utf-8') as log_file:
+        for each_line in log_file:
+            if each_line.endswith('\n'):
+                yield json.loads(each_line)
+    return
+
+
+def tail_session_log(log_fname: str, poll_interval: float = 0.2, stop_event: threading.Event = None):
+    """
+    Follows a session stream file that is still being written, yielding each record as it is appended.
+
+    Waits for the file to be created if it does not yet exist. Runs until `stop_event` is set, or forever
+    if no event is given.
+
+    :param log_fname:
+    :param poll_interval: seconds to wait before checking for new records
+    :param stop_event:
+    :return: generator of records
+    """
+    while not os.path.isfile(log_fname):
+        if stop_event is not None and stop_event.is_set():
+            return
+        time.sleep(poll_interval)
+
+    partial_line = ''
+    with open(log_fname, 'r', encoding='utf-8') as log_file:
+        while stop_event is None or not stop_event.is_set():
+            each_line = log_file.readline()
+            if not each_line:
+                time.sleep(poll_interval)
+                continue
+            partial_line += each_line
+            if partial_line.endswith('\n'):
+                yield json.loads(partial_line)
+                partial_line = ''
+    return
@@ -0,0 +1,565 @@
+"""
+@title
+@description
+"""
+import argparse
+import multiprocessing
+import queue
+import time
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+from auto_drone import TERMINAL_COLUMNS
+from auto_drone.frame_views import FrameView, FrameViewStats
+from auto_drone.latency_trace import LatencyTracer
+
+# magic, capacity, height, width, channels, next sequence number to be written, closed flag
+HEADER_DTYPE = np.dtype([
+    ('magic', '<u8'), ('capacity', '<i8'), ('height', '<i8'), ('width', '<i8'), ('channels', '<i8'),
+    ('write_seq', '<i8'), ('closed', '<i8')
+])
+# version counter of the slot, odd while the slot is being written; sequence number and time of its frame
+SLOT_DTYPE = np.dtype([('version', '<u8'), ('seq', '<i8'), ('timestamp', '<f8')])
+RING_MAGIC = 0x474e495254524453
+
+
+class SharedFrameRing:
+    """
+    Ring of fixed-size uint8 frames in a named block of shared memory, written by one producer and read
+    by any number of reader processes without copying.
+
+    Frames are identified by a sequence number that increases for the lifetime of the ring; frame `seq`
+    lives in slot `seq % capacity` until it is overwritten, as in FrameBuffer. Each slot is guarded by a
+    seqlock: the writer makes the version of the slot odd, writes the frame, then makes it even again, and
+    only then publishes the new write sequence number in the header. A reader notes the version before and
+    after reading a slot, and knows the frame it read is intact if the version was even and unchanged.
+
+    The writer never waits on readers. A reader that falls more than `capacity` frames behind finds the
+    frames it wanted overwritten and counts an overrun, rather than holding up the producer.
+
+    Writes are ordered by the seqlock on processors that do not reorder stores, such as x86; the ring
+    relies on this, as Python offers no memory barriers.
+    """
+
+    CAPACITY = 60
+
+    def __init__(self, shm: shared_memory.SharedMemory, owner: bool):
+        """
+        Use `create` or `attach` rather than calling this directly.
+
+        :param shm:
+        :param owner: whether this process created the ring, and unlinks it when closed
+        """
+        self.shm = shm
+        self.owner = owner
+        self.header = np.ndarray((1,), dtype=HEADER_DTYPE, buffer=shm.buf, offset=0)[0]
+        if int(self.header['magic']) != RING_MAGIC:
+            raise ValueError(f'Shared memory is not a frame ring: {shm.name}')
+        self.capacity = int(self.header['capacity'])
+        self.frame_shape = tuple(int(self.header[each_dim]) for each_dim in ('height', 'width', 'channels'))
+        slot_offset = HEADER_DTYPE.itemsize
+        self.slots = np.ndarray((self.capacity,), dtype=SLOT_DTYPE, buffer=shm.buf, offset=slot_offset)
+        frame_offset = slot_offset + self.capacity * SLOT_DTYPE.itemsize
+        self.frames = np.ndarray((self.capacity, *self.frame_shape), dtype=np.uint8, buffer=shm.buf,
+                                 offset=frame_offset)
+        self.versions = self.slots['version']
+        return
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @classmethod
+    def create(cls, frame_shape: tuple, capacity: int = CAPACITY, name: str = None):
+        """
+        Creates a ring for frames of the given shape.
+
+        :param frame_shape: (height, width, channels) of every frame
+        :param capacity: number of frames retained before the oldest is overwritten
+        :param name: name of the shared memory block; chosen by the system if None
+        :return:
+        """
+        if capacity <= 0:
+            raise ValueError(f'Frame ring capacity must be positive: {capacity}')
+        frame_shape = tuple(frame_shape) if len(frame_shape) == 3 else (*frame_shape, 1)
+        frame_size = int(np.prod(frame_shape))
+        ring_size = HEADER_DTYPE.itemsize + capacity * (SLOT_DTYPE.itemsize + frame_size)
+        shm = shared_memory.SharedMemory(name=name, create=True, size=ring_size)
+        header = np.ndarray((1,), dtype=HEADER_DTYPE, buffer=shm.buf, offset=0)
+        header[0] = (RING_MAGIC, capacity, *frame_shape, 0, 0)
+        np.ndarray((capacity,), dtype=SLOT_DTYPE, buffer=shm.buf, offset=HEADER_DTYPE.itemsize)[:] = (0, -1, 0.0)
+        del header
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name: str):
+        """
+        Attaches to a ring created by another process.
+
+        :param name:
+        :return:
+        """
+        return cls(shared_memory.SharedMemory(name=name, create=False), owner=False)
+
+    @property
+    def write_seq(self):
+        """
+        Sequence number the next frame will be written with; the number of frames written so far.
+
+        :return:
+        """
+        return int(self.header['write_seq'])
+
+    @property
+    def closed(self):
+        return bool(self.header['closed'])
+
+    def write(self, frame: np.ndarray, timestamp: float):
+        """
+        Copies a frame into the next slot of the ring, overwriting the oldest frame once full. Never blocks.
+
+        :param frame:
+        :param timestamp:
+        :return: sequence number assigned to the frame
+        """
+        if frame.shape != self.frame_shape and frame.shape != self.frame_shape[:2]:
+            raise ValueError(f'Frame shape {frame.shape} does not match ring shape {self.frame_shape}')
+        seq = self.write_seq
+        slot = seq % self.capacity
+        self.versions[slot] += 1
+        self.slots['seq'][slot] = seq
+        self.slots['timestamp'][slot] = timestamp
+        np.copyto(self.frames[slot], frame.reshape(self.frame_shape))
+        self.versions[slot] += 1
+        self.header['write_seq'] = seq + 1
+        return seq
+
+    def mark_closed(self):
+        """
+        Tells readers that no further frames will be written.
+
+        :return:
+        """
+        self.header['closed'] = 1
+        return
+
+    def close(self):
+        """
+        Releases this process's mapping of the ring, and removes the ring if this process created it.
+
+        :return:
+        """
+        self.header = None
+        self.slots = None
+        self.versions = None
+        self.frames = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # frames are still referenced, e.g. by a consumer's history; they are unmapped when the process exits
+            pass
+        if self.owner:
+            self.shm.unlink()
+        return
+
+
+class FrameRingWriter:
+    """
+    Frame output, in the sense of the `output_list` of TelloDrone, that publishes every frame it is given
+    to a SharedFrameRing. The ring is created on the first frame, once the frame shape is known, under the
+    name given, so reader processes can be started before the first frame arrives.
+
+    Latency traces cannot follow a frame into another process, so the trace of each frame ends when the
+    frame is published.
+    """
+
+    def __init__(self, name: str, capacity: int = SharedFrameRing.CAPACITY, frame_shape: tuple = None,
+                 latency_tracer: LatencyTracer = None):
+        """
+
+        :param name: name of the shared memory block readers attach to
+        :param capacity:
+        :param frame_shape: creates the ring straight away if given
+        :param latency_tracer:
+        """
+        self.name = name
+        self.capacity = capacity
+        self.latency_tracer = latency_tracer if latency_tracer is not None else LatencyTracer()
+        self.ring = None
+        if frame_shape is not None:
+            self.ring = SharedFrameRing.create(frame_shape, capacity=capacity, name=name)
+        self.num_written = 0
+        return
+
+    def add_frame(self, new_frame, trace_id: int = None):
+        """
+
+        :param new_frame: frame or FrameView
+        :param trace_id:
+        :return:
+        """
+        if isinstance(new_frame, FrameView):
+            frame, timestamp = new_frame.frame, new_frame.timestamp
+        else:
+            frame, timestamp = new_frame, None
+        if self.ring is None:
+            self.ring = SharedFrameRing.create(frame.shape, capacity=self.capacity, name=self.name)
+        self.ring.write(frame, timestamp if timestamp is not None else time.time())
+        self.num_written += 1
+        self.latency_tracer.finish(trace_id, LatencyTracer.QUEUED)
+        return
+
+    def cleanup(self):
+        if self.ring is not None:
+            self.ring.mark_closed()
+            self.ring.close()
+            self.ring = None
+        return
+
+
+class FrameRingReader:
+    """
+    Reads the frames of a SharedFrameRing in order, from the frame being written when the reader starts.
+
+    By default, frames are returned as read-only FrameViews of the shared memory, without copying them.
+    The seqlock then only shows that the slot held the frame when it was read: the pixels may be
+    overwritten as soon as the producer wraps around the ring to the slot again, so a consumer must check
+    `is_intact` once it is done with the frame. Frames read with `copy` are copied out of the slot, and the
+    seqlock is checked after the copy, so a copied frame is known to be intact and stays so.
+
+    When the reader finds that the frame it wanted was overwritten, it counts an overrun and skips ahead,
+    either to the newest frame, so a slow consumer works on current frames, or to the oldest frame still
+    retained, so it misses as few frames as it can. In the latter case it skips to a frame OLDEST_MARGIN
+    of the ring newer than the oldest, so it does not land on a slot about to be overwritten.
+    """
+
+    POLL_INTERVAL = 0.002
+    SKIP_TO_NEWEST = 'newest'
+    SKIP_TO_OLDEST = 'oldest'
+    OLDEST_MARGIN = 0.25
+
+    def __init__(self, ring: SharedFrameRing, skip_policy: str = SKIP_TO_NEWEST,
+                 poll_interval: float = POLL_INTERVAL):
+        """
+
+        :param ring:
+        :param skip_policy: SKIP_TO_NEWEST or SKIP_TO_OLDEST
+        :param poll_interval: seconds between checks for a new frame while waiting
+        """
+        if skip_policy not in (self.SKIP_TO_NEWEST, self.SKIP_TO_OLDEST):
+            raise ValueError(f'Unknown skip policy: {skip_policy}')
+        self.ring = ring
+        self.skip_policy = skip_policy
+        self.poll_interval = poll_interval
+        self.frame_view_stats = FrameViewStats()
+        self.next_seq = ring.write_seq
+
+        self.num_read = 0
+        self.num_overruns = 0
+        self.num_missed = 0
+        self.num_torn = 0
+        return
+
+    def __skip(self, write_seq: int):
+        if self.skip_policy == self.SKIP_TO_NEWEST:
+            skip_seq = write_seq - 1
+        else:
+            # the oldest frames are the next to be overwritten, so the reader would soon be overrun again
+            skip_margin = min(max(int(self.ring.capacity * self.OLDEST_MARGIN), 2), self.ring.capacity - 1)
+            skip_seq = max(write_seq - self.ring.capacity + skip_margin, self.next_seq)
+        self.num_overruns += 1
+        self.num_missed += skip_seq - self.next_seq
+        self.next_seq = skip_seq
+        return
+
+    def read(self, timeout: float = None, copy: bool = False):
+        """
+        Gets the next frame, waiting for it to be written if need be.
+
+        :param timeout: seconds to wait; waits indefinitely if None
+        :param copy: copy the frame out of the ring rather than returning a view of its slot
+        :return: FrameView, or None if the wait timed out or the ring was closed with no frames left to read
+        """
+        wait_end = time.perf_counter() + timeout if timeout is not None else None
+        ring = self.ring
+        while True:
+            write_seq = ring.write_seq
+            if self.next_seq >= write_seq:
+                if ring.closed or (wait_end is not None and time.perf_counter() >= wait_end):
+                    return None
+                time.sleep(self.poll_interval)
+                continue
+            if write_seq - self.next_seq > ring.capacity:
+                self.__skip(write_seq)
+
+            slot = self.next_seq % ring.capacity
+            version = int(ring.versions[slot])
+            slot_seq = int(ring.slots['seq'][slot])
+            timestamp = float(ring.slots['timestamp'][slot])
+            frame = ring.frames[slot].copy() if copy else ring.frames[slot]
+            if version % 2 == 1 or slot_seq != self.next_seq or int(ring.versions[slot]) != version:
+                # overwritten while being read
+                self.num_torn += 1
+                self.__skip(ring.write_seq)
+                continue
+
+            frame_view = FrameView(frame.squeeze(axis=2) if frame.shape[2] == 1 else frame, timestamp, slot_seq,
+                                   self.frame_view_stats)
+            self.next_seq += 1
+            self.num_read += 1
+            return frame_view
+
+    def is_intact(self, frame_view: FrameView):
+        """
+        Checks whether a frame returned by `read` has not since been overwritten by the producer.
+
+        :param frame_view:
+        :return:
+        """
+        slot = frame_view.seq % self.ring.capacity
+        return int(self.ring.slots['seq'][slot]) == frame_view.seq and int(self.ring.versions[slot]) % 2 == 0
+
+    def get_stats(self):
+        """
+
+        :return:
+        """
+        stats = {
+            'num_read': self.num_read,
+            'num_overruns': self.num_overruns,
+            'num_missed': self.num_missed,
+            'num_torn': self.num_torn,
+            'lag': self.ring.write_seq - self.next_seq if self.ring.header is not None else None,
+            'skip_policy': self.skip_policy
+        }
+        return stats
+
+
+def _run_consumer(ring_name: str, consumer_factory, skip_policy: str, copy_frames: bool, stop_event, stats_queue):
+    ring = None
+    for _ in range(FrameRingProcess.ATTACH_ATTEMPTS):
+        try:
+            ring = SharedFrameRing.attach(ring_name)
+            break
+        except FileNotFoundError:
+            if stop_event.is_set():
+                break
+            time.sleep(FrameRingProcess.ATTACH_INTERVAL)
+    if ring is None:
+        stats_queue.put({'error': f'Could not attach to frame ring: {ring_name}'})
+        return
+
+    frame_reader = FrameRingReader(ring, skip_policy=skip_policy)
+    consumer = consumer_factory()
+    start_func = getattr(consumer, 'start_process_thread', None)
+    if callable(start_func):
+        start_func()
+    frame_view = None
+    num_overwritten = 0
+    while not stop_event.is_set():
+        frame_view = frame_reader.read(timeout=FrameRingProcess.READ_TIMEOUT, copy=copy_frames)
+        if frame_view is None:
+            if ring.closed:
+                break
+            continue
+        consumer.add_frame(frame_view)
+        if not copy_frames and not frame_reader.is_intact(frame_view):
+            num_overwritten += 1
+            discard_func = getattr(consumer, 'discard_frame', None)
+            if callable(discard_func):
+                discard_func(frame_view)
+
+    cleanup_func = getattr(consumer, 'cleanup', None)
+    if callable(cleanup_func):
+        cleanup_func()
+    consumer_stats_func = getattr(consumer, 'get_stats', None)
+    stats_queue.put({
+        'reader': frame_reader.get_stats(),
+        'copy_frames': copy_frames,
+        'num_overwritten_in_use': num_overwritten,
+        'frame_views': frame_reader.frame_view_stats.get_stats(),
+        'consumer': consumer_stats_func() if callable(consumer_stats_func) else None
+    })
+    # views of the ring must be released before its memory can be unmapped
+    del frame_view, consumer
+    ring.close()
+    return
+
+
+class FrameRingProcess:
+    """
+    Runs a frame consumer, such as GestureControl, in a process of its own, fed from a SharedFrameRing.
+
+    The consumer is built in the child process by calling `consumer_factory`, which must be picklable, e.g.
+    a class or a module-level function. As with the outputs of TelloDrone, the consumer is given each frame
+    through its `add_frame` method; if it has `start_process_thread`, `cleanup` or `get_stats` methods, they
+    are called when the process starts, when it stops, and to gather its statistics.
+
+    Frames are copied out of the ring by default, as a consumer such as GestureControl queues the frames
+    it is given and derives views from them later, by when their slots may have been overwritten. A
+    consumer that is done with each frame by the time `add_frame` returns, such as FrameRecorder, can be
+    given views of the ring without copying, with `copy_frames` off. Each frame is then checked once
+    `add_frame` returns; a frame that was overwritten while in use is counted and, if the consumer has a
+    `discard_frame` method, passed to it so the consumer can disown any result computed from it.
+    """
+
+    ATTACH_ATTEMPTS = 500
+    ATTACH_INTERVAL = 0.01
+    READ_TIMEOUT = 0.25
+    STATS_TIMEOUT = 5
+
+    def __init__(self, ring_name: str, consumer_factory, skip_policy: str = FrameRingReader.SKIP_TO_NEWEST,
+                 copy_frames: bool = True):
+        """
+
+        :param ring_name: name of the ring to read frames from
+        :param consumer_factory:
+        :param skip_policy: what the reader skips to when it falls behind the ring
+        :param copy_frames: copy each frame out of the ring before giving it to the consumer
+        """
+        self.ring_name = ring_name
+        self.stop_event = multiprocessing.Event()
+        self.stats_queue = multiprocessing.Queue()
+        self.process = multiprocessing.Process(
+            target=_run_consumer,
+            args=(ring_name, consumer_factory, skip_policy, copy_frames, self.stop_event, self.stats_queue),
+            daemon=True
+        )
+        self.stats = None
+        return
+
+    def start(self):
+        self.process.start()
+        return
+
+    def stop(self):
+        """
+        Stops the consumer process.
+
+        :return: statistics of the reader and the consumer in the process
+        """
+        self.stop_event.set()
+        try:
+            self.stats = self.stats_queue.get(timeout=self.STATS_TIMEOUT)
+        except queue.Empty:
+            self.stats = None
+        self.process.join(timeout=self.STATS_TIMEOUT)
+        return self.stats
+
+
+class FrameRecorder:
+    """
+    Consumer that encodes every frame to an MJPG video, e.g. to record in a process of its own:
+    `FrameRingProcess(ring_name, functools.partial(FrameRecorder, video_fname), copy_frames=False)`. Frames
+    are encoded within `add_frame`, so they need not be copied out of the ring.
+    """
+
+    def __init__(self, video_fname: str, fps: float = 30):
+        """
+
+        :param video_fname:
+        :param fps:
+        """
+        self.video_fname = video_fname
+        self.fps = fps
+        self.video_writer = None
+        self.num_frames = 0
+        return
+
+    def add_frame(self, frame_view: FrameView, trace_id: int = None):
+        frame = frame_view.frame
+        if self.video_writer is None:
+            frame_height, frame_width = frame.shape[:2]
+            codec_str = 'MJPG'
+            self.video_writer = cv2.VideoWriter(
+                self.video_fname, cv2.VideoWriter_fourcc(*codec_str), self.fps, (frame_width, frame_height)
+            )
+        self.video_writer.write(frame)
+        self.num_frames += 1
+        return
+
+    def cleanup(self):
+        if self.video_writer is not None:
+            self.video_writer.release()
+        return
+
+    def get_stats(self):
+        return {'video_fname': self.video_fname, 'num_frames': self.num_frames}
+
+
+class FrameCounter:
+    """
+    Consumer that only reads each frame, used to measure how fast frames can be fanned out.
+    """
+
+    def __init__(self):
+        self.num_frames = 0
+        self.total_age = 0.0
+        self.checksum = 0
+        return
+
+    def add_frame(self, frame_view: FrameView, trace_id: int = None):
+        self.num_frames += 1
+        self.total_age += time.time() - frame_view.timestamp
+        self.checksum += int(frame_view.frame[0, 0, 0])
+        return
+
+    def get_stats(self):
+        return {
+            'num_frames': self.num_frames,
+            'mean_age': self.total_age / self.num_frames if self.num_frames > 0 else None
+        }
+
+
+def main(main_args):
+    ring_name = main_args.get('ring_name', 'auto_drone_frames')
+    num_readers = main_args.get('num_readers', 2)
+    num_frames = main_args.get('num_frames', 300)
+    fps = main_args.get('fps', 30)
+    ###################################
+    frame_shape = (720, 960, 3)
+    ring_writer = FrameRingWriter(ring_name, frame_shape=frame_shape)
+    reader_list = [FrameRingProcess(ring_name, FrameCounter, copy_frames=False) for _ in range(num_readers)]
+    for each_reader in reader_list:
+        each_reader.start()
+    # let the readers attach before frames are written
+    time.sleep(1)
+
+    frame = np.zeros(frame_shape, dtype=np.uint8)
+    write_times = []
+    next_write = time.perf_counter()
+    for frame_idx in range(num_frames):
+        frame[:] = frame_idx % 256
+        write_start = time.perf_counter()
+        ring_writer.add_frame(frame)
+        write_times.append(time.perf_counter() - write_start)
+        next_write += 1 / fps
+        sleep_time = next_write - time.perf_counter()
+        if sleep_time > 0:
+            time.sleep(sleep_time)
+
+    reader_stats = [each_reader.stop() for each_reader in reader_list]
+    ring_writer.cleanup()
+    print('-' * TERMINAL_COLUMNS)
+    print(f'frames written: {ring_writer.num_written} | mean write: {1000 * np.mean(write_times):0.3f} ms')
+    for reader_idx, each_stats in enumerate(reader_stats):
+        print(f'reader {reader_idx}: {each_stats}')
+    print('-' * TERMINAL_COLUMNS)
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fans frames out to reader processes through a shared memory ring.')
+    parser.add_argument('--ring_name', type=str, default='auto_drone_frames',
+                        help='Name of the shared memory block.')
+    parser.add_argument('--num_readers', type=int, default=2,
+                        help='Number of reader processes.')
+    parser.add_argument('--num_frames', type=int, default=300,
+                        help='Number of frames written.')
+    parser.add_argument('--fps', type=float, default=30,
+                        help='Rate frames are written at.')
+
+    args = parser.parse_args()
+    main(vars(args))
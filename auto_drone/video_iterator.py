@@ -3,19 +3,33 @@
 @description
 """
 import threading
+import time
 
 import cv2
 
+from auto_drone.frame_bus import FrameBus
+from auto_drone.frame_views import FrameView, FrameViewStats
+
 
 class ObservableVideo:
 
-    def __init__(self, video_fname, output):
+    def __init__(self, video_fname, output=None, frame_bus: FrameBus = None):
+        """
+        Frames read from the video are published on the FRAMES topic of `frame_bus`, and passed to the
+        add_frame method of `output`, if one is given.
+
+        :param video_fname:
+        :param output:
+        :param frame_bus:
+        """
         self.video_fname = video_fname
         self.video_thread = None
         self.output = output
+        self.frame_bus = frame_bus if frame_bus is not None else FrameBus()
 
         self.frame_delay = 30
         self.frame_history = []
+        self.frame_view_stats = FrameViewStats()
         return
 
     def start_video_thread(self):
@@ -40,7 +54,10 @@ class ObservableVideo:
         while self.video_capture.isOpened():
             read_success, video_frame = self.video_capture.read()
             if read_success:
-                self.output.add_frame(video_frame)
+                frame_view = FrameView(video_frame, time.time(), len(self.frame_history), self.frame_view_stats)
+                if self.output is not None:
+                    self.output.add_frame(frame_view)
+                self.frame_bus.publish(FrameBus.FRAMES, frame_view, timestamp=frame_view.timestamp)
                 self.frame_history.append(video_frame)
             cv2.waitKey(self.frame_delay)
         self.video_capture.release()
@@ -0,0 +1,41 @@
+"""
+@title
+@description
+"""
+import argparse
+import time
+
+from auto_drone import TERMINAL_COLUMNS
+from auto_drone.drone.replay_drone import ReplayDrone
+
+
+def main(main_args):
+    session_dir = main_args['session_dir']
+    speed = main_args.get('speed', 1.0)
+    ###################################
+    replay_drone = ReplayDrone(session_dir=session_dir, speed=speed)
+    replay_drone.connect()
+    time.sleep(1)
+    ###################################
+    while not replay_drone.wait(timeout=1):
+        print('-' * TERMINAL_COLUMNS)
+        print(f'Battery:        {replay_drone.get_battery()}')
+        print(f'Speed:          {replay_drone.get_speed()}')
+        print(f'height:         {replay_drone.get_height()}')
+        print(f'attitude:       {replay_drone.get_attitude()}')
+        print(f'replay:         {replay_drone.get_replay_stats()}')
+    replay_drone.cleanup()
+    print('-' * TERMINAL_COLUMNS)
+    print(f'replay:         {replay_drone.get_replay_stats()}')
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--session_dir', type=str, required=True,
+                        help='')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='')
+
+    args = parser.parse_args()
+    main(vars(args))
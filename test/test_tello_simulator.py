@@ -0,0 +1,66 @@
+"""
+@title
+@description
+"""
+import argparse
+import time
+
+from auto_drone import TERMINAL_COLUMNS
+from auto_drone.drone.tello_drone import TelloDrone
+from auto_drone.drone.tello_simulator import NetworkImpairment, TelloSimulator
+
+
+def main(main_args):
+    run_length = main_args.get('run_length', 10)
+    video_fname = main_args.get('video', None)
+    impairment = NetworkImpairment(
+        loss=main_args.get('loss', 0), reorder=main_args.get('reorder', 0), delay=main_args.get('delay', 0)
+    )
+    ###################################
+    simulator = TelloSimulator(
+        host='127.0.0.1', command_port=18889, state_port=18890, video_port=18891, video_fname=video_fname,
+        impairment=impairment
+    )
+    simulator.start()
+    tello_drone = TelloDrone(
+        host='127.0.0.1', command_port=18889, local_host='127.0.0.1', local_command_port=0,
+        state_port=18890, video_port=18891, video_relay_port=18892
+    )
+    while not tello_drone.connect():
+        time.sleep(1)
+    ###################################
+    tello_drone.control_takeoff()
+    tello_drone.set_rc(0, 20, 0, 10)
+    time.sleep(run_length)
+    tello_drone.control_land()
+    print('-' * TERMINAL_COLUMNS)
+    print(f'Battery:        {tello_drone.get_battery()}')
+    print(f'Speed:          {tello_drone.get_speed()}')
+    print(f'height:         {tello_drone.get_height()}')
+    print(f'attitude:       {tello_drone.get_attitude()}')
+    print(f'commands:       {tello_drone.get_command_stats()}')
+    print(f'rc:             {tello_drone.get_rc_stats()}')
+    print(f'states:         {tello_drone.get_state_stats()}')
+    print(f'video:          {tello_drone.get_video_stats()}')
+    print(f'simulator:      {simulator.get_stats()}')
+    print('-' * TERMINAL_COLUMNS)
+    tello_drone.cleanup()
+    simulator.stop()
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--run_length', type=float, default=10,
+                        help='')
+    parser.add_argument('--video', type=str, default=None,
+                        help='')
+    parser.add_argument('--loss', type=float, default=0,
+                        help='')
+    parser.add_argument('--reorder', type=float, default=0,
+                        help='')
+    parser.add_argument('--delay', type=float, default=0,
+                        help='')
+
+    args = parser.parse_args()
+    main(vars(args))
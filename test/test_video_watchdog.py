@@ -0,0 +1,52 @@
+"""
+@title
+@description
+"""
+import argparse
+
+import numpy as np
+
+from auto_drone import TERMINAL_COLUMNS
+from auto_drone.drone.video_watchdog import VideoWatchdog
+
+
+def main(main_args):
+    num_errors = main_args.get('num_errors', VideoWatchdog.ERROR_BURST_SIZE)
+    frame_interval = main_args.get('frame_interval', 1 / 30)
+    ###################################
+    clean_frame = np.random.default_rng(0).integers(0, 256, size=(72, 96, 3), dtype=np.uint8)
+    video_watchdog = VideoWatchdog(error_burst=num_errors)
+    frame_time = 0.0
+    video_watchdog.start(frame_time)
+    for _ in range(10):
+        frame_time += frame_interval
+        video_watchdog.frame_decoded(clean_frame, frame_time)
+    for _ in range(num_errors):
+        frame_time += frame_interval
+        video_watchdog.read_failed(frame_time)
+    watchdog_stats = video_watchdog.get_stats()
+    assert watchdog_stats['open_incident'] == VideoWatchdog.ERROR_BURST == 'error_burst', watchdog_stats
+    ###################################
+    video_watchdog.keyframe_received(frame_time + frame_interval)
+    frame_time += 2 * frame_interval
+    video_watchdog.frame_decoded(clean_frame, frame_time)
+    watchdog_stats = video_watchdog.get_stats()
+    assert watchdog_stats['incident_counts'] == {'error_burst': 1}, watchdog_stats
+    assert watchdog_stats['num_recovered'] == 1, watchdog_stats
+    print('-' * TERMINAL_COLUMNS)
+    print(f'incidents:      {watchdog_stats["incidents"]}')
+    print(f'counts:         {watchdog_stats["incident_counts"]}')
+    print(f'recovered:      {watchdog_stats["num_recovered"]}')
+    print('-' * TERMINAL_COLUMNS)
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--num_errors', type=int, default=VideoWatchdog.ERROR_BURST_SIZE,
+                        help='')
+    parser.add_argument('--frame_interval', type=float, default=1 / 30,
+                        help='')
+
+    args = parser.parse_args()
+    main(vars(args))
@@ -4,9 +4,24 @@
 """
 
 from bokeh.embed import server_document
-from flask import render_template
+from flask import Response, current_app, render_template
+
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
 
 
 def bkapp_page():
     script = server_document('http://localhost:5006/bkapp')
     return render_template('index.html', script=script, template="Flask")
+
+
+def metrics_page():
+    """
+    Serves the page most recently rendered by the MetricsCollector of the app. Nothing is collected while
+    serving the request.
+
+    :return:
+    """
+    metrics_collector = current_app.config.get('METRICS_COLLECTOR', None)
+    if metrics_collector is None:
+        return Response('', status=404, content_type=METRICS_CONTENT_TYPE)
+    return Response(metrics_collector.render(), content_type=METRICS_CONTENT_TYPE)
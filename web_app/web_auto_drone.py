@@ -8,6 +8,7 @@ import os
 import flask
 
 from auto_drone import PROJECT_PATH
+from auto_drone.metrics import MetricsCollector
 from web_app import routes
 
 
@@ -18,33 +19,71 @@ class WebAutoDrone:
     HOST = '127.0.0.1'
     PORT = 8080
 
-    def __init__(self):
+    def __init__(self, metrics_collector: MetricsCollector = None):
+        """
+
+        :param metrics_collector: source of the page served at /metrics
+        """
         self.app = flask.Flask(
             import_name=self.APP_NAME,
             template_folder=os.path.join(PROJECT_PATH, 'web_app', 'templates'),
             static_folder=os.path.join(PROJECT_PATH, 'web_app', 'static'),
             root_path=os.path.join(PROJECT_PATH, 'web_app')
         )
+        self.metrics_collector = metrics_collector
+        self.app.config['METRICS_COLLECTOR'] = metrics_collector
         return
 
     def add_get_routes(self):
         self.app.add_url_rule(rule='/bkapp', endpoint='bkapp', view_func=routes.bkapp_page, methods=['get'])
+        self.app.add_url_rule(rule='/metrics', endpoint='metrics', view_func=routes.metrics_page, methods=['get'])
         return
 
     def add_post_routes(self):
         return
 
     def start_app(self):
+        if self.metrics_collector is not None and self.metrics_collector.collect_thread is None:
+            self.metrics_collector.start()
         self.app.run(host=self.HOST, port=self.PORT)
         return
 
 
 def main(main_args):
+    from auto_drone.drone.tello_drone import TelloDrone
+    from auto_drone.drone.tello_simulator import TelloSimulator
+    ###################################
+    simulate = main_args.get('simulate', False)
+    ###################################
+    simulator = None
+    if simulate:
+        simulator = TelloSimulator(host='127.0.0.1', command_port=18889, state_port=18890, video_port=18891)
+        simulator.start()
+        tello_drone = TelloDrone(
+            host='127.0.0.1', command_port=18889, local_host='127.0.0.1', local_command_port=0,
+            state_port=18890, video_port=18891, video_relay_port=18892
+        )
+    else:
+        tello_drone = TelloDrone()
+    tello_drone.connect()
+    metrics_collector = MetricsCollector(drone=tello_drone)
+    web_drone = WebAutoDrone(metrics_collector=metrics_collector)
+    web_drone.add_get_routes()
+    web_drone.add_post_routes()
+    try:
+        web_drone.start_app()
+    finally:
+        metrics_collector.stop()
+        tello_drone.cleanup()
+        if simulator is not None:
+            simulator.stop()
     return
 
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='')
+    parser = argparse.ArgumentParser(description='Serve the web interface and live metrics of a drone.')
+    parser.add_argument('--simulate', action='store_true',
+                        help='connect to a simulated drone on the local host instead of a Tello')
 
     args = parser.parse_args()
     main(vars(args))